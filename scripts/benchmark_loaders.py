@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк способов загрузки upsert_data_to_supabase (batch, values, unnest, copy)
+и загрузчика psycopg 3 (psycopg3: pipeline mode и бинарный COPY, если psycopg установлен).
+
+Загружает синтетические записи со структурой planfix_analytics_produkty во
+временную таблицу _benchmark_loaders: сначала вставку в пустую таблицу, затем
+повторную загрузку тех же ключей (обновление). Подключение берется из тех же
+переменных окружения, что и у экспорта, либо из --dsn.
+
+Локальный Postgres почти не добавляет сетевой задержки, поэтому разница между
+построчной загрузкой и загрузкой одним запросом до удаленного Supabase будет
+заметно больше, чем здесь.
+
+Пример:
+    python scripts/benchmark_loaders.py --dsn postgresql://postgres@localhost/postgres --sizes 100,1000,10000
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import datetime
+
+import psycopg2
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scripts.planfix_utils as planfix_utils
+import scripts.planfix_psycopg3 as planfix_psycopg3
+
+BENCHMARK_TABLE = "_benchmark_loaders"
+BENCHMARK_LOADERS = ['batch', 'values', 'unnest', 'copy']
+
+BENCHMARK_TABLE_SQL = f'''
+DROP TABLE IF EXISTS "{BENCHMARK_TABLE}";
+CREATE TABLE "{BENCHMARK_TABLE}" (
+    "id" SERIAL PRIMARY KEY,
+    "composite_key" TEXT UNIQUE NOT NULL,
+    "task_id" INTEGER,
+    "task_name" TEXT,
+    "action_id" INTEGER,
+    "analytic_key" INTEGER,
+    "nazwa" TEXT,
+    "nazwa_handbook_id" INTEGER,
+    "cena" NUMERIC,
+    "waluta" TEXT,
+    "ilosc" NUMERIC,
+    "rabat_procent" NUMERIC,
+    "cena_po_rabacie" NUMERIC,
+    "wartosc_netto" NUMERIC,
+    "prowizja_pln" NUMERIC,
+    "laczna_masa_kg" NUMERIC,
+    "order_number" TEXT,
+    "updated_at" TIMESTAMP,
+    "is_deleted" BOOLEAN DEFAULT FALSE
+);
+'''
+
+BENCHMARK_COLUMNS = [
+    'composite_key', 'task_id', 'task_name', 'action_id', 'analytic_key', 'nazwa',
+    'nazwa_handbook_id', 'cena', 'waluta', 'ilosc', 'rabat_procent', 'cena_po_rabacie',
+    'wartosc_netto', 'prowizja_pln', 'laczna_masa_kg', 'order_number', 'updated_at', 'is_deleted',
+]
+
+
+def build_records(count):
+    """Синтетические записи Produkty в том виде, в каком их готовит экспорт"""
+    now = datetime.now()
+    records = []
+    for i in range(count):
+        task_id = 100000 + i // 5
+        records.append({
+            'composite_key': f'{task_id}_{300000 + i}_{200000 + i}',
+            'task_id': task_id,
+            'task_name': f'Zamówienie {i // 5}',
+            'action_id': 300000 + i,
+            'analytic_key': 200000 + i,
+            'nazwa': f'Produkt testowy {i % 300}',
+            'nazwa_handbook_id': 31337 + i % 300,
+            'cena': 12.5 + i % 7,
+            'waluta': 'PLN',
+            'ilosc': float(1 + i % 10),
+            'rabat_procent': 5.0,
+            'cena_po_rabacie': 11.88,
+            'wartosc_netto': 47.5,
+            'prowizja_pln': 2.1,
+            'laczna_masa_kg': 3.2,
+            'order_number': f'ZAM/{i // 5}/2025',
+            'updated_at': now,
+            'is_deleted': False,
+        })
+    return records
+
+
+def time_load(conn, loader, records, page_size, pg3_conn=None):
+    """Время загрузки (с) в пустую таблицу и повторной загрузки тех же ключей"""
+    with conn.cursor() as cur:
+        cur.execute(f'TRUNCATE "{BENCHMARK_TABLE}"')
+    conn.commit()
+
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        if loader == 'psycopg3':
+            planfix_psycopg3.upsert_data_to_supabase(
+                pg3_conn, BENCHMARK_TABLE, 'composite_key', BENCHMARK_COLUMNS, records
+            )
+        else:
+            planfix_utils.upsert_data_to_supabase(
+                conn, BENCHMARK_TABLE, 'composite_key', BENCHMARK_COLUMNS, records,
+                loader=loader, page_size=page_size
+            )
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmark(conn, sizes, loaders, repeat, page_size, pg3_conn=None):
+    with conn.cursor() as cur:
+        cur.execute(BENCHMARK_TABLE_SQL)
+    conn.commit()
+
+    results = {}
+    for size in sizes:
+        records = build_records(size)
+        for loader in loaders:
+            best = None
+            for _ in range(repeat):
+                insert_s, update_s = time_load(conn, loader, records, page_size, pg3_conn)
+                best = (insert_s, update_s) if best is None else (min(best[0], insert_s), min(best[1], update_s))
+            results[(size, loader)] = best
+    return results
+
+
+def print_results(results, sizes, loaders):
+    print(f"\n{'rows':>7} {'loader':<8} {'insert ms':>10} {'update ms':>10} {'rows/s':>10} {'vs batch':>9}")
+    for size in sizes:
+        baseline = results.get((size, 'batch'))
+        for loader in loaders:
+            insert_s, update_s = results[(size, loader)]
+            rate = size / update_s if update_s else 0
+            speedup = f"{baseline[1] / update_s:.1f}x" if baseline and update_s else '-'
+            print(f"{size:>7} {loader:<8} {insert_s * 1000:>10.1f} {update_s * 1000:>10.1f} {rate:>10.0f} {speedup:>9}")
+        print(f"{'':>7} auto -> {planfix_utils.choose_upsert_loader(size)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare upsert loader strategies against a Postgres database")
+    parser.add_argument('--dsn', help="Connection string (default: Supabase settings from the environment)")
+    parser.add_argument('--sizes', default='10,100,1000,10000', help="Comma-separated batch sizes")
+    parser.add_argument('--loaders', default=','.join(BENCHMARK_LOADERS), help="Comma-separated loaders to compare (add psycopg3 to include the psycopg 3 loader)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per size and loader (best is reported)")
+    parser.add_argument('--page-size', type=int, default=planfix_utils.SUPABASE_PAGE_SIZE, help="Rows per statement for batch/values")
+    args = parser.parse_args()
+
+    # upsert_data_to_supabase логирует каждую загрузку — в бенчмарке это только шум
+    logging.basicConfig(level=logging.WARNING)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    loaders = [loader.strip() for loader in args.loaders.split(',') if loader.strip()]
+
+    conn = psycopg2.connect(args.dsn) if args.dsn else planfix_utils.get_supabase_connection()
+    pg3_conn = None
+    try:
+        if 'psycopg3' in loaders:
+            pg3_conn = planfix_psycopg3.get_connection(args.dsn)
+        results = run_benchmark(conn, sizes, loaders, args.repeat, args.page_size, pg3_conn)
+        print_results(results, sizes, loaders)
+    finally:
+        if pg3_conn is not None:
+            pg3_conn.close()
+        with conn.cursor() as cur:
+            cur.execute(f'DROP TABLE IF EXISTS "{BENCHMARK_TABLE}"')
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк XML-бэкендов (stdlib vs lxml) на ответах Planfix.
+
+Сравнивает чистый разбор документа и функции парсинга экспортера на ответах
+task.getList, action.get и analitic.getDataByCondition. Поля аналитики
+декодируются по описанию из ответа analitic.getOptions (записанного или
+синтетического).
+
+Записанные ответы берутся из каталога --payload-dir: имя файла должно
+начинаться с имени метода, например task.getList_page1.xml,
+action.get_123.xml, analitic.getDataByCondition_page1.xml.
+Если каталог не указан, используются синтетические ответы той же структуры.
+
+Пример:
+    python scripts/benchmark_xml_parsers.py --payload-dir recorded/ --repeat 7
+"""
+
+import os
+import sys
+import time
+import glob
+import logging
+import argparse
+
+# Add the parent directory to the Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scripts.planfix_xml as planfix_xml
+import scripts.export_produkty_with_orders as exporter
+import scripts.planfix_analytic_registry as planfix_analytic_registry
+
+BENCHMARK_METHODS = ['task.getList', 'action.get', 'analitic.getDataByCondition']
+# Описание полей аналитики: не замеряется, нужно для декодера строк
+OPTIONS_METHOD = 'analitic.getOptions'
+
+# Поля синтетической аналитики Produkty: ID -> (название, тип поля, ID справочника, значение, valueId)
+SYNTHETIC_PRODUKTY_FIELDS = {
+    '27719': ('Nazwa', 11, '512', 'Produkt testowy', '31337'),
+    '27721': ('Cena', 1, None, '12,50', None),
+    '29133': ('Waluta', 6, None, 'PLN', '2'),
+    '28079': ('Ilość', 1, None, '4', None),
+    '28109': ('Rabat, %', 1, None, '5', None),
+    '28111': ('Cena po rabacie', 1, None, '11,88', None),
+    '28081': ('Wartość netto', 1, None, '47,50', None),
+    '29311': ('Prowizja PLN', 1, None, '2,10', None),
+    '32907': ('Łączna masa, kg', 1, None, '3,2', None),
+}
+
+
+def build_task_list_payload(task_count=100):
+    """Синтетический ответ task.getList с длинными описаниями и customData"""
+    tasks = []
+    for i in range(task_count):
+        tasks.append(
+            '<task>'
+            f'<id>{100000 + i}</id><name>Zamówienie {i}</name><number>{5000 + i}</number>'
+            f'<title>Zamówienie {i}</title>'
+            f'<description>{"Opis zamówienia &amp; uwagi klienta. " * 40}</description>'
+            '<status>2</status><statusName>W realizacji</statusName>'
+            '<template><id>2420917</id></template>'
+            f'<client><id>{700 + i % 50}</id><name>Klient {i % 50}</name></client>'
+            '<beginDateTime>01-03-2025 10:00</beginDateTime>'
+            '<customData>'
+            f'<customValue><field><id>1</id><name>Numer zamówienia</name></field><value>ZAM/{i}/2025</value></customValue>'
+            '<customValue><field><id>2</id><name>Uwagi</name></field><value>brak</value></customValue>'
+            '</customData>'
+            '</task>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<response status="ok"><tasks totalCount="{task_count}" count="{task_count}">'
+        + ''.join(tasks) +
+        '</tasks></response>'
+    )
+
+
+def build_action_payload(analytic_count=3):
+    """Синтетический ответ action.get с прикрепленными аналитиками"""
+    analytics = []
+    for i in range(analytic_count):
+        analytic_id = exporter.PRODUKTY_ANALYTIC_KEY if i == analytic_count - 1 else 1000 + i
+        analytics.append(
+            f'<analitic><id>{analytic_id}</id><name>Produkty {i}</name><key>{90000 + i}</key></analitic>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<response status="ok"><action>'
+        '<id>555</id><description>Dodano produkty do zamówienia</description>'
+        '<task><id>100001</id></task><dateTime>01-03-2025 10:05</dateTime>'
+        f'<analitics>{"".join(analytics)}</analitics>'
+        '</action></response>'
+    )
+
+
+def build_analytics_by_condition_payload(row_count=100, task_count=100):
+    """Синтетический ответ analitic.getDataByCondition с полями Produkty"""
+    rows = []
+    for i in range(row_count):
+        items = []
+        for field_id, (name, _, _, value, value_id) in SYNTHETIC_PRODUKTY_FIELDS.items():
+            value_id_xml = f'<valueId>{value_id}</valueId>' if value_id else ''
+            items.append(f'<itemData><id>{field_id}</id><name>{name}</name><value>{value}</value>{value_id_xml}</itemData>')
+        rows.append(
+            '<analiticData>'
+            f'<key>{200000 + i}</key>'
+            f'<task><id>{100000 + i % task_count}</id></task><action><id>{300000 + i}</id></action>'
+            + ''.join(items) +
+            '</analiticData>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<response status="ok"><analiticDatas>{"".join(rows)}</analiticDatas></response>'
+    )
+
+
+def build_analytic_options_payload():
+    """Синтетический ответ analitic.getOptions с описанием полей Produkty"""
+    fields = []
+    for field_id, (name, field_type, handbook_id, _, _) in SYNTHETIC_PRODUKTY_FIELDS.items():
+        handbook_xml = f'<handbook><id>{handbook_id}</id></handbook>' if handbook_id else ''
+        fields.append(f'<field><id>{field_id}</id><name>{name}</name><type>{field_type}</type>{handbook_xml}</field>')
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<response status="ok"><analitic><id>{exporter.PRODUKTY_ANALYTIC_KEY}</id><name>Produkty</name>'
+        f'<fields>{"".join(fields)}</fields></analitic></response>'
+    )
+
+
+def load_payloads(payload_dir):
+    """Загружает записанные ответы из каталога, группируя их по методу API"""
+    payloads = {method: [] for method in BENCHMARK_METHODS + [OPTIONS_METHOD]}
+    for path in sorted(glob.glob(os.path.join(payload_dir, '*.xml'))):
+        file_name = os.path.basename(path)
+        for method in BENCHMARK_METHODS + [OPTIONS_METHOD]:
+            if file_name.startswith(method + '_') or file_name == method + '.xml':
+                with open(path, 'rb') as f:
+                    payloads[method].append(f.read().decode('utf-8'))
+                break
+    return payloads
+
+
+def synthetic_payloads():
+    return {
+        'task.getList': [build_task_list_payload()],
+        'action.get': [build_action_payload()],
+        'analitic.getDataByCondition': [build_analytics_by_condition_payload()],
+        OPTIONS_METHOD: [build_analytic_options_payload()],
+    }
+
+
+def build_tasks_dict(payloads):
+    """Словарь задач для parse_analytics_data_by_condition из ответов task.getList"""
+    tasks = []
+    for xml_text in payloads.get('task.getList', []):
+        tasks.extend(exporter.parse_task_list(xml_text))
+    if not tasks:
+        tasks = [{'id': 100000 + i, 'name': f'Zamówienie {i}', 'order_number': f'ZAM/{i}/2025'} for i in range(100)]
+    return {task['id']: task for task in tasks}
+
+
+def build_decoder(payloads):
+    """Декодер строк аналитики из ответа analitic.getOptions (синтетического, если он не записан)"""
+    documents = payloads.get(OPTIONS_METHOD) or [build_analytic_options_payload()]
+    definition = planfix_analytic_registry.parse_analytic_options(documents[0], exporter.PRODUKTY_ANALYTIC_KEY)
+    return definition.decoder()
+
+
+def time_call(func, repeat, number):
+    """Лучшее время одного вызова (мс) из repeat серий по number вызовов"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def run_benchmark(payloads, backends, repeat, number):
+    tasks_dict = build_tasks_dict(payloads)
+    decoder = build_decoder(payloads)
+    consumers = {
+        'task.getList': lambda xml_text: exporter.parse_task_list(xml_text),
+        'action.get': lambda xml_text: exporter.has_produkty_analytics_in_action(xml_text),
+        'analitic.getDataByCondition': lambda xml_text: exporter.parse_analytics_data_by_condition(xml_text, tasks_dict, decoder),
+    }
+
+    results = {}
+    for backend in backends:
+        planfix_xml.set_xml_backend(backend)
+        for method in BENCHMARK_METHODS:
+            documents = payloads.get(method) or []
+            if not documents:
+                continue
+            parse_ms = sum(time_call(lambda d=d: planfix_xml.fromstring(d), repeat, number) for d in documents)
+            consume_ms = sum(time_call(lambda d=d: consumers[method](d), repeat, number) for d in documents)
+            size_kb = sum(len(d.encode('utf-8')) for d in documents) / 1024
+            results[(backend, method)] = (len(documents), size_kb, parse_ms, consume_ms)
+    return results
+
+
+def print_results(results, backends):
+    print(f"\n{'method':<30} {'backend':<8} {'docs':>5} {'KB':>9} {'fromstring ms':>14} {'parse fn ms':>12} {'speedup':>8}")
+    for method in BENCHMARK_METHODS:
+        baseline = results.get(('stdlib', method))
+        for backend in backends:
+            row = results.get((backend, method))
+            if not row:
+                continue
+            docs, size_kb, parse_ms, consume_ms = row
+            speedup = f"{baseline[3] / consume_ms:.2f}x" if baseline and consume_ms else '-'
+            print(f"{method:<30} {backend:<8} {docs:>5} {size_kb:>9.1f} {parse_ms:>14.3f} {consume_ms:>12.3f} {speedup:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare XML parser backends on Planfix payloads")
+    parser.add_argument('--payload-dir', help="Directory with recorded responses (<method>_*.xml)")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of timing series (best is reported)")
+    parser.add_argument('--number', type=int, default=20, help="Calls per timing series")
+    args = parser.parse_args()
+
+    # Экспортер подробно логирует каждую запись — в бенчмарке это только шум
+    logging.basicConfig(level=logging.WARNING)
+
+    payloads = load_payloads(args.payload_dir) if args.payload_dir else synthetic_payloads()
+    if not any(payloads.values()):
+        print(f"No payloads found in {args.payload_dir}")
+        sys.exit(1)
+
+    backends = ['stdlib']
+    if planfix_xml.lxml_etree is not None:
+        backends.append('lxml')
+    else:
+        print("lxml is not installed, benchmarking stdlib backend only")
+
+    results = run_benchmark(payloads, backends, args.repeat, args.number)
+    print_results(results, backends)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,16 @@
 """
 Скрипт для создания таблицы в Supabase на основе структуры аналитики из Planfix.
 Используется после получения структуры аналитики через Postman.
+С --analytic-id колонки берутся из описания полей аналитики
+(analitic.getOptions, см. planfix_analytic_registry), а не угадываются
+по значениям строки данных с ключом --analytic-key (или введенным ключом).
 """
 
 import os
 import sys
 import logging
+import argparse
 from datetime import datetime
-import xml.etree.ElementTree as ET
 import requests
 from dotenv import load_dotenv
 
@@ -18,6 +21,9 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import scripts.planfix_utils as planfix_utils
+import scripts.planfix_xml as planfix_xml
+import scripts.planfix_partitions as planfix_partitions
+import scripts.planfix_analytic_registry as planfix_analytic_registry
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +51,7 @@ def parse_analytics_structure(xml_text):
     Парсит XML ответ от API analitic.getData для определения структуры полей
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -87,7 +93,7 @@ def parse_analytics_structure(xml_text):
         
         return fields_structure
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError: {e}")
         raise
     except Exception as e:
@@ -143,49 +149,265 @@ def is_date_string(value):
     
     return False
 
-def generate_table_sql(table_name, fields_structure, analytic_key):
+# Индексы под реальную нагрузку на таблицу:
+#   (суффикс имени, уникальный, метод доступа, колонка, только неудаленные строки)
+# Уникальный composite_key нужен для ON CONFLICT в export_produkty_with_orders.
+# Выборки по заказу идут только по неудаленным строкам, поэтому индексы
+# частичные (WHERE NOT is_deleted), а отдельный индекс по is_deleted
+# с двумя значениями не нужен. updated_at растет вместе с физическим
+# порядком строк, для него достаточно компактного BRIN.
+TABLE_INDEXES = [
+    ('composite_key', True, 'btree', 'composite_key', False),
+    ('task_id_live', False, 'btree', 'task_id', True),
+    ('order_number_live', False, 'btree', 'order_number', True),
+    ('updated_at_brin', False, 'brin', 'updated_at', False),
+]
+
+def table_indexes(partitioned=False):
+    """
+    Индексы из TABLE_INDEXES для обычной или секционированной таблицы.
+    В секционированной уникальность composite_key обеспечивает ограничение
+    (composite_key, order_date): уникальный индекс обязан включать колонку секционирования.
+    """
+    if not partitioned:
+        return TABLE_INDEXES
+    return [index for index in TABLE_INDEXES if not index[1]]
+
+def index_name(table_name, suffix):
+    """
+    Имя индекса (не длиннее 63 символов — ограничение Postgres)
+    """
+    return f"idx_{table_name}_{suffix}"[:63]
+
+def index_sql(table_name, index, concurrently=False):
     """
-    Генерирует SQL для создания таблицы на основе структуры аналитики
+    SQL создания одного индекса из TABLE_INDEXES
+    """
+    suffix, unique, method, column, live_only = index
+    return (
+        f'CREATE {"UNIQUE " if unique else ""}INDEX {"CONCURRENTLY " if concurrently else ""}'
+        f'IF NOT EXISTS "{index_name(table_name, suffix)}" ON "{table_name}" '
+        f'USING {method} ("{column}"){" WHERE NOT is_deleted" if live_only else ""};'
+    )
+
+def partitioned_index_sql(table_name, index, partitions):
+    """
+    SQL создания индекса на секционированной таблице без блокировки записи.
+    CREATE INDEX CONCURRENTLY на родительской таблице не поддерживается, поэтому
+    индекс создается на ней через ON ONLY (пока невалидный), затем CONCURRENTLY
+    на каждой секции и присоединяется к родительскому — после присоединения
+    индексов всех секций он становится валидным.
+    """
+    suffix, unique, method, column, live_only = index
+    parent_index = index_name(table_name, suffix)
+    where_sql = " WHERE NOT is_deleted" if live_only else ""
+    statements = [
+        f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{parent_index}" '
+        f'ON ONLY "{table_name}" USING {method} ("{column}"){where_sql};'
+    ]
+    for partition in sorted(partitions):
+        partition_index = index_name(partition, suffix)
+        statements.append(index_sql(partition, index, concurrently=True))
+        statements.append(f'ALTER INDEX "{parent_index}" ATTACH PARTITION "{partition_index}";')
+    return statements
+
+def generate_index_sql(table_name, columns, partitioned=False, primary_key=None):
     """
-    # Базовые колонки
+    Генерирует CREATE INDEX для колонок из TABLE_INDEXES, которые есть в таблице.
+    Уникальный индекс по колонке первичного ключа primary_key не нужен — его дает ключ.
+    """
+    return [
+        index_sql(table_name, index) for index in table_indexes(partitioned)
+        if index[3] in columns and not (index[1] and index[3] == primary_key)
+    ]
+
+def generate_table_sql(table_name, fields_structure, analytic_key=None, partitioned=False, analytic_id=None):
+    """
+    Генерирует SQL для создания таблицы на основе структуры аналитики.
+    analytic_id или analytic_key — откуда взята структура (ID аналитики или ключ
+    строки данных), попадает в комментарий к таблице.
+    partitioned — таблица секционируется по месяцам даты заказа (order_date),
+    см. planfix_partitions.
+    """
+    # Базовые колонки — те, что пишет export_produkty_with_orders. Строка
+    # идентифицируется составным ключом (task_id_action_id_analytic_key), по нему
+    # идет upsert. В секционированной таблице первичный ключ обязан включать
+    # колонку секционирования, поэтому уникальность держит ограничение (composite_key, order_date)
     columns = [
-        f'"{table_name}_id" TEXT PRIMARY KEY',
-        f'"analitic_key" INTEGER NOT NULL',
-        f'"item_id" INTEGER',
+        f'"composite_key" TEXT NOT NULL' if partitioned else f'"composite_key" TEXT PRIMARY KEY',
+        f'"analytic_key" TEXT',
+        f'"task_id" INTEGER',
+        f'"task_name" TEXT',
+        f'"action_id" INTEGER',
+        f'"order_number" TEXT',
+        f'"{planfix_utils.RUN_ID_COLUMN}" TEXT',
+        f'"{planfix_utils.ROW_HASH_COLUMN}" TEXT',
         f'"updated_at" TIMESTAMP DEFAULT NOW()',
         f'"is_deleted" BOOLEAN DEFAULT FALSE'
     ]
+    if partitioned:
+        columns.append(f'"{planfix_partitions.PARTITION_COLUMN}" DATE')
     
     # Добавляем колонки на основе структуры аналитики
     for field_name, field_info in fields_structure.items():
-        # Очищаем название поля для SQL
+        # Очищаем название поля для SQL (описание из реестра аналитик задает колонку явно)
         clean_field_name = field_name.replace(' ', '_').replace('-', '_').replace('.', '_')
         clean_field_name = ''.join(c for c in clean_field_name if c.isalnum() or c == '_')
+        clean_field_name = field_info.get('column', clean_field_name)
         
         # Добавляем колонку
         columns.append(f'"{clean_field_name}" {field_info["type"]}')
         
         # Если есть value_id, добавляем отдельную колонку
         if field_info['has_value_id']:
-            columns.append(f'"{clean_field_name}_id" TEXT')
+            columns.append(f'"{field_info.get("value_id_column", clean_field_name + "_id")}" TEXT')
     
+    column_names = [column.split('"')[1] for column in columns]
+    if partitioned:
+        columns.append(planfix_partitions.unique_constraint_sql(table_name, 'composite_key'))
+    columns_sql = ',\n    '.join(columns)
+    indexes_sql = '\n'.join(generate_index_sql(
+        table_name, column_names, partitioned, primary_key=None if partitioned else 'composite_key'
+    ))
+    partition_sql = ''
+    if partitioned:
+        partition_sql = (
+            f' PARTITION BY RANGE ("{planfix_partitions.PARTITION_COLUMN}");\n\n'
+            f'-- Строки без даты заказа; секции по месяцам создает экспорт\n'
+            f'CREATE TABLE IF NOT EXISTS "{planfix_partitions.partition_name(table_name, None)}" '
+            f'PARTITION OF "{table_name}" DEFAULT'
+        )
+
+    if analytic_id:
+        source_comment = f'Данные аналитики Planfix {analytic_id}'
+    else:
+        source_comment = f'Данные аналитики Planfix с ключом {analytic_key}'.replace("'", "''")
+
     # Создаем SQL
     sql = f'''CREATE TABLE IF NOT EXISTS "{table_name}" (
-    {',\n    '.join(columns)}
-);
+    {columns_sql}
+){partition_sql};
 
--- Создаем индексы для оптимизации
-CREATE INDEX IF NOT EXISTS idx_{table_name}_analitic_key ON "{table_name}" (analitic_key);
-CREATE INDEX IF NOT EXISTS idx_{table_name}_item_id ON "{table_name}" (item_id);
-CREATE INDEX IF NOT EXISTS idx_{table_name}_updated_at ON "{table_name}" (updated_at);
-CREATE INDEX IF NOT EXISTS idx_{table_name}_is_deleted ON "{table_name}" (is_deleted);
+-- Создаем индексы под запросы экспорта и дашбордов
+{indexes_sql}
 
 -- Добавляем комментарии к таблице
-COMMENT ON TABLE "{table_name}" IS 'Данные аналитики Planfix с ключом {analytic_key}';
+COMMENT ON TABLE "{table_name}" IS '{source_comment}';
 '''
     
     return sql
 
+def get_existing_indexes(conn, table_name):
+    """
+    Возвращает индексы таблицы: имя -> (уникальный, метод, колонки, частичный, валидный)
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT i.relname, ix.indisunique, am.amname,
+                   array_agg(a.attname ORDER BY k.ord), ix.indpred IS NOT NULL, ix.indisvalid
+            FROM pg_index ix
+            JOIN pg_class i ON i.oid = ix.indexrelid
+            JOIN pg_am am ON am.oid = i.relam
+            CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)
+            JOIN pg_attribute a ON a.attrelid = ix.indrelid AND a.attnum = k.attnum
+            WHERE ix.indrelid = %s::regclass
+            GROUP BY i.relname, ix.indisunique, am.amname, ix.indpred, ix.indisvalid;
+        """, (f'"{table_name}"',))
+        return {row[0]: (row[1], row[2], list(row[3]), row[4], row[5]) for row in cur.fetchall()}
+
+def ensure_table_indexes(conn, table_name):
+    """
+    Создает недостающие индексы из TABLE_INDEXES на существующей таблице
+    через CREATE INDEX CONCURRENTLY, не блокируя запись в таблицу.
+    Индекс считается существующим, если есть валидный индекс с тем же
+    методом, колонкой, уникальностью и частичностью (под любым именем).
+    На секционированной таблице индекс строится по секциям (partitioned_index_sql).
+    Возвращает список созданных индексов.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s;
+        """, (table_name,))
+        columns = {row[0] for row in cur.fetchall()}
+    if not columns:
+        raise ValueError(f"Table {table_name} does not exist")
+
+    partitioned = planfix_partitions.is_partitioned(conn, table_name)
+    partitions = planfix_partitions.get_partitions(conn, table_name) if partitioned else set()
+    existing = get_existing_indexes(conn, table_name)
+    conn.commit()
+
+    created = []
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for index in table_indexes(partitioned):
+                suffix, unique, method, column, live_only = index
+                if column not in columns:
+                    continue
+                name = index_name(table_name, suffix)
+                spec = (unique, method, [column], live_only)
+                if any(info[:4] == spec and info[4] for info in existing.values()):
+                    continue
+                if partitioned:
+                    # Невалидный индекс секционированной таблицы достраивается тем же SQL:
+                    # уже созданные индексы секций пропускаются (IF NOT EXISTS)
+                    statements = partitioned_index_sql(table_name, index, partitions)
+                else:
+                    # Прерванное построение CONCURRENTLY оставляет невалидный индекс — пересоздаем его
+                    if name in existing and not existing[name][4]:
+                        logger.warning(f"Index {name} is invalid, rebuilding it")
+                        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                    statements = [index_sql(table_name, index, concurrently=True)]
+                try:
+                    for statement in statements:
+                        logger.info(f"Creating index: {statement}")
+                        cur.execute(statement)
+                    created.append(name)
+                except Exception as e:
+                    # Например, дубликаты composite_key не дают построить уникальный индекс
+                    logger.error(f"Could not create index {name}: {e}")
+                    if not partitioned:
+                        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+            obsolete = [
+                name for name, info in existing.items()
+                if info[1] == 'btree' and info[2] == ['is_deleted']
+            ]
+            if obsolete:
+                logger.info(f"Indexes on is_deleted alone are no longer needed and can be dropped: {obsolete}")
+    finally:
+        conn.autocommit = False
+
+    return created
+
+def convert_table_to_partitioned(conn, table_name):
+    """
+    Переводит существующую таблицу на помесячное секционирование по order_date
+    (planfix_partitions.convert_to_partitioned) и создает на ней индексы из TABLE_INDEXES
+    """
+    if planfix_partitions.is_partitioned(conn, table_name):
+        print(f"Таблица {table_name} уже секционирована")
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s;
+        """, (table_name,))
+        columns = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    if not columns:
+        raise ValueError(f"Table {table_name} does not exist")
+
+    old_name = planfix_partitions.convert_to_partitioned(
+        conn, table_name, index_sql=generate_index_sql(table_name, columns, partitioned=True)
+    )
+    print(f"Таблица {table_name} секционирована по месяцам {planfix_partitions.PARTITION_COLUMN}.")
+    print(f"Старая таблица сохранена как {old_name} — удалите ее после проверки.")
+    print("Запустите экспорт с --full-refresh, чтобы заполнить order_date и разложить строки по месяцам.")
+
 def create_table_in_supabase(table_name, sql):
     """
     Создает таблицу в Supabase
@@ -209,6 +431,53 @@ def main():
     """
     Главная функция для создания таблицы в Supabase
     """
+    parser = argparse.ArgumentParser(description="Create a Supabase table for a Planfix analytic")
+    parser.add_argument(
+        '--ensure-indexes',
+        metavar='TABLE',
+        help="Only create missing indexes on an existing table (CREATE INDEX CONCURRENTLY) and exit"
+    )
+    parser.add_argument(
+        '--partitioned',
+        action='store_true',
+        help="Create the table partitioned by order month (order_date)"
+    )
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument(
+        '--analytic-id',
+        type=int,
+        help="Take the columns from the field definition of this analytic (analitic.getOptions) "
+             "instead of sampling a data row by its key"
+    )
+    source_group.add_argument(
+        '--analytic-key',
+        help="Key of the analytic data row to sample the columns from (analitic.getData); "
+             "asked for if neither --analytic-id nor --analytic-key is given"
+    )
+    parser.add_argument(
+        '--partition-by-month',
+        metavar='TABLE',
+        help="Convert an existing table into a table partitioned by order month and exit"
+    )
+    args = parser.parse_args()
+
+    if args.partition_by_month:
+        conn = planfix_utils.get_supabase_connection()
+        try:
+            convert_table_to_partitioned(conn, args.partition_by_month)
+        finally:
+            conn.close()
+        return
+
+    if args.ensure_indexes:
+        conn = planfix_utils.get_supabase_connection()
+        try:
+            created = ensure_table_indexes(conn, args.ensure_indexes)
+            print(f"Создано индексов: {len(created)} {created if created else ''}")
+        finally:
+            conn.close()
+        return
+
     logger.info("--- Starting Supabase table creation ---")
     
     # Проверяем обязательные переменные окружения
@@ -219,22 +488,30 @@ def main():
     })
 
     try:
-        # Запрашиваем у пользователя ключ аналитики
-        analytic_key = input("Введите ключ аналитики из Planfix: ").strip()
-        if not analytic_key:
-            logger.error("Analytic key is required")
-            return
+        # Ключ строки данных аналитики нужен, только если не задан ID аналитики
+        analytic_key = None
+        if not args.analytic_id:
+            analytic_key = args.analytic_key or input("Введите ключ строки данных аналитики из Planfix: ").strip()
+            if not analytic_key:
+                logger.error("Analytic data key is required (or pass --analytic-id)")
+                return
         
         # Запрашиваем название таблицы
         table_name = input("Введите название таблицы для Supabase (по умолчанию: planfix_analytics_produkty): ").strip()
         if not table_name:
             table_name = "planfix_analytics_produkty"
         
-        logger.info(f"Getting analytics structure for key: {analytic_key}")
-        
-        # Получаем структуру аналитики
-        xml_response = get_analytics_structure(analytic_key)
-        fields_structure = parse_analytics_structure(xml_response)
+        if args.analytic_id:
+            # Типы колонок — из типов полей аналитики
+            logger.info(f"Getting field definition of analytic {args.analytic_id}")
+            definition = planfix_analytic_registry.fetch_analytic_definition(args.analytic_id)
+            fields_structure = definition.fields_structure()
+        else:
+            logger.info(f"Getting analytics structure for key: {analytic_key}")
+            
+            # Получаем структуру аналитики
+            xml_response = get_analytics_structure(analytic_key)
+            fields_structure = parse_analytics_structure(xml_response)
         
         if not fields_structure:
             logger.warning("No fields found in analytics structure")
@@ -252,7 +529,10 @@ def main():
             print()
         
         # Генерируем SQL для создания таблицы
-        sql = generate_table_sql(table_name, fields_structure, analytic_key)
+        sql = generate_table_sql(
+            table_name, fields_structure, analytic_key,
+            partitioned=args.partitioned, analytic_id=args.analytic_id
+        )
         
         # Выводим SQL
         print("=== SQL для создания таблицы ===")
@@ -8,7 +8,6 @@ import os
 import sys
 import logging
 from datetime import datetime
-import xml.etree.ElementTree as ET
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -17,6 +16,8 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import scripts.planfix_utils as planfix_utils
+import scripts.planfix_xml as planfix_xml
+import scripts.planfix_schema as planfix_schema
 
 logger = logging.getLogger(__name__)
 
@@ -48,7 +49,7 @@ def parse_produkty_analytics_data(xml_text, table_name):
     Парсит XML ответ от API analitic.getData для аналитики "x Produkty"
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -96,7 +97,7 @@ def parse_produkty_analytics_data(xml_text, table_name):
         
         return analytics_data
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError: {e}")
         raise
     except Exception as e:
@@ -105,13 +106,11 @@ def parse_produkty_analytics_data(xml_text, table_name):
 
 def get_table_columns(conn, table_name):
     """
-    Получает список колонок таблицы из Supabase
+    Получает список колонок таблицы из реестра схем, не меняя его отпечаток:
+    схемой таблицы управляет export_produkty_with_orders
     """
     try:
-        with conn.cursor() as cur:
-            cur.execute(f'SELECT * FROM "{table_name}" LIMIT 0')
-            columns = [desc[0] for desc in cur.description]
-            return columns
+        return planfix_schema.get_registered_columns(conn, table_name)
     except Exception as e:
         logger.error(f"Error getting table columns: {e}")
         raise
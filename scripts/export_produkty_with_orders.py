@@ -7,10 +7,9 @@
 import os
 import sys
 import logging
+import argparse
 from datetime import datetime
-import xml.etree.ElementTree as ET
-import requests
-import time
+import psycopg2
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -19,6 +18,19 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import scripts.planfix_utils as planfix_utils
+import scripts.planfix_xml as planfix_xml
+import scripts.planfix_spool as planfix_spool
+import scripts.planfix_page_cache as planfix_page_cache
+import scripts.planfix_schema as planfix_schema
+import scripts.planfix_rollups as planfix_rollups
+import scripts.planfix_partitions as planfix_partitions
+import scripts.planfix_psycopg3 as planfix_psycopg3
+import scripts.planfix_handbooks as planfix_handbooks
+import scripts.planfix_mirror as planfix_mirror
+import scripts.planfix_analytic_registry as planfix_analytic_registry
+import scripts.planfix_task_resolver as planfix_task_resolver
+import scripts.planfix_dimensions as planfix_dimensions
+import scripts.create_supabase_table as create_supabase_table
 
 logger = logging.getLogger(__name__)
 
@@ -26,147 +38,236 @@ logger = logging.getLogger(__name__)
 PRODUKTY_ANALYTIC_KEY = 4867  # ID аналитики "Produkty"
 PRODUKTY_TABLE_NAME = "planfix_analytics_produkty"
 
-def get_tasks_with_produkty_analytics():
+# Справочник товаров, на записи которого ссылается nazwa_handbook_id: его поля
+# добавляются в строки Produkty (колонка таблицы = название поля справочника).
+# Без PRODUKTY_HANDBOOK_ID обогащение выключено.
+PRODUKTY_HANDBOOK_ID = int(os.environ['PRODUKTY_HANDBOOK_ID']) if os.environ.get('PRODUKTY_HANDBOOK_ID') else None
+PRODUKTY_HANDBOOK_COLUMNS = planfix_handbooks.parse_columns_spec(
+    os.environ.get('PRODUKTY_HANDBOOK_FIELDS', 'sku=SKU,kategoria=Kategoria')
+)
+
+# Таблицы измерений planfix_orders и planfix_clients (см. planfix_dimensions):
+# список заказов запрашивается с профилем 'enrich'. 0 — выключено.
+PRODUKTY_SYNC_DIMENSIONS = os.environ.get('PRODUKTY_SYNC_DIMENSIONS', '1') != '0'
+
+TASK_LIST_PAGE_SIZE = 100
+ANALYTICS_PAGE_SIZE = 100
+
+# Поля компактной строки задачи, которую возвращает parse_task_rows
+# (begin_datetime, статус, шаблон и клиент заполняются только профилем 'enrich')
+TASK_ROW_FIELDS = (
+    'id', 'name', 'number', 'order_number', 'begin_datetime',
+    'status', 'status_name', 'template_id', 'client_id', 'client_name',
+)
+
+# Профили полей task.getList: каждый потребитель запрашивает только те поля,
+# которые он разбирает (description не нужен никому и бывает очень большим)
+TASK_FIELD_PROFILES = {
+    # Поиск заказов: id, название и номер заказа из customData (parse_task_rows)
+    'scan': ('id', 'title', 'customData'),
+    # Обогащение: дополнительно статус, клиент, шаблон и дата начала заказа
+    'enrich': ('id', 'title', 'customData', 'status', 'statusName', 'template', 'client', 'beginDateTime'),
+}
+TASK_FIELD_PROFILE = 'scan'
+
+def get_task_fields(profile):
+    """
+    Возвращает список полей task.getList для профиля
+    """
+    if profile not in TASK_FIELD_PROFILES:
+        raise ValueError(f"Unknown task field profile '{profile}'. Expected one of: {', '.join(TASK_FIELD_PROFILES)}")
+    return TASK_FIELD_PROFILES[profile]
+
+# Параметры постраничных запросов в ключах спула и хешей страниц
+def task_list_spool_params(profile=TASK_FIELD_PROFILE):
+    return f'template=2420917;fields={profile}'
+
+def task_list_stream_key(profile=TASK_FIELD_PROFILE):
+    # Поля строки входят в ключ: страницы, сохраненные со строками другого состава, разбираются заново
+    return f'task.getList|{task_list_spool_params(profile)}|{",".join(TASK_ROW_FIELDS)}'
+
+def analytics_spool_params(page_size=ANALYTICS_PAGE_SIZE):
+    return f'analitic={PRODUKTY_ANALYTIC_KEY};pageSize={page_size}'
+
+ANALYTICS_STREAM_KEY = f'analitic.getDataByCondition|{analytics_spool_params()}'
+
+def build_task_list_body(page, profile=TASK_FIELD_PROFILE):
+    """
+    Формирует XML-запрос task.getList для страницы заказов (шаблон 2420917)
+    с полями из профиля profile
+    """
+    fields_xml = ''.join(f'<field>{field}</field>' for field in get_task_fields(profile))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<request method="task.getList">'
+        f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
+        f'<pageCurrent>{page}</pageCurrent>'
+        f'<pageSize>{TASK_LIST_PAGE_SIZE}</pageSize>'
+        '<filters>'
+        '  <filter>'
+        '    <type>51</type>'
+        '    <operator>equal</operator>'
+        '    <value>2420917</value>'
+        '  </filter>'
+        '</filters>'
+        f'<fields>{fields_xml}</fields>'
+        '</request>'
+    )
+
+def fetch_task_list_page(page, profile=TASK_FIELD_PROFILE):
+    """
+    Запрашивает страницу списка заказов, возвращает сырые байты ответа.
+    Повторяет запрос при ошибках лимитов API.
+    """
+    body = build_task_list_body(page, profile)
+
+    # Делаем запрос с повторными попытками при ошибках лимитов
+    max_retries = 3
+    retry_count = 0
+
+    while True:
+        try:
+            response_xml = planfix_utils.post_planfix_xml('task.getList', body, task_list_spool_params(profile), page)
+            logger.info(f"Got page {page} of orders, response length: {len(response_xml)}")
+            return response_xml
+        except Exception as e:
+            retry_count += 1
+            if retry_count < max_retries:
+                logger.warning(f"API error on orders page {page}, retry {retry_count}/{max_retries}: {e}")
+                logger.info(f"Waiting 10 seconds before retry...")
+                planfix_utils.api_pause(10)
+                continue
+            logger.error(f"Failed to get orders page {page} after {max_retries} retries: {e}")
+            raise
+
+def iter_parsed_pages(fetch_page, parse_rows, page_size, parse_pool, page_delay=0, page_stream=None, parse_retries=0):
+    """
+    Постранично запрашивает ответы API и разбирает их в parse_pool.
+
+    Пока страница N разбирается в процессе-воркере, основной процесс уже
+    запрашивает страницу N+1 (при параллельном пуле это стоит одного лишнего
+    запроса после последней страницы). Генерирует тройки
+    (номер страницы, строки, запись кеша) и останавливается на первой
+    неполной странице.
+
+    Если передан page_stream (planfix_page_cache) и страница не изменилась
+    с прошлого запуска, она не разбирается: строки равны None, а запись кеша
+    содержит состояние страницы из прошлого запуска.
+
+    Ошибка разбора страницы не считается концом списка: страница
+    запрашивается заново до parse_retries раз, после чего исключение
+    пробрасывается — иначе непройденные страницы были бы помечены удаленными.
+    """
+    def start(page, data):
+        cached = page_stream.check(page, data) if page_stream is not None else None
+        if cached is not None:
+            return cached, None
+        return None, parse_pool.submit(parse_rows, data)
+
+    page = 1
+    cached, pending = start(page, fetch_page(page))
+    while True:
+        prefetched = None
+        if parse_pool.parallel:
+            if page_delay:
+                planfix_utils.api_pause(page_delay)
+            try:
+                prefetched = fetch_page(page + 1)
+            except Exception as e:
+                # Страница может и не понадобиться; если понадобится — запросим еще раз
+                logger.debug(f"Prefetch of page {page + 1} failed: {e}")
+
+        rows = None
+        attempt = 0
+        while cached is None:
+            try:
+                rows = pending.result()
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > parse_retries:
+                    logger.error(f"Failed to parse page {page}: {e}")
+                    raise
+                logger.warning(f"Failed to parse page {page}, retry {attempt}/{parse_retries}: {e}")
+                planfix_utils.api_pause(10)
+                # Повторный ответ заново сверяется с кешем: хеш страницы должен быть от него, а не от ответа с ошибкой
+                cached, pending = start(page, fetch_page(page))
+        row_count = cached['row_count'] if cached is not None else len(rows)
+
+        yield page, rows, cached
+
+        if row_count < page_size:
+            logger.info(f"Last page reached (got {row_count} rows on page {page}, page size {page_size})")
+            return
+
+        page += 1
+        if prefetched is None:
+            if page_delay:
+                logger.info(f"Waiting {page_delay} seconds before fetching page {page}...")
+                planfix_utils.api_pause(page_delay)
+            prefetched = fetch_page(page)
+        cached, pending = start(page, prefetched)
+
+def get_orders(parse_pool=None, page_cache=None, field_profile=TASK_FIELD_PROFILE, mirror=None):
     """
-    Получает список задач (заказов) с прикрепленной аналитикой "Produkty"
+    Получает список всех заказов (задач по шаблону 2420917) в формате parse_task_list.
+    page_cache — хеши страниц прошлого запуска: неизменные страницы не разбираются.
+    field_profile — профиль полей task.getList (см. TASK_FIELD_PROFILES).
+    mirror — локальное зеркало (planfix_mirror): в него сохраняются заказы списка.
     """
     try:
-        # Используем правильный подход с ручным формированием XML
         # Ищем только задачи-заказы по шаблону 2420917 (как в рабочем примере)
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
-        body = (
-            '<?xml version="1.0" encoding="UTF-8"?>'
-            '<request method="task.getList">'
-            f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
-            '<pageCurrent>1</pageCurrent>'
-            '<pageSize>100</pageSize>'
-            '<filters>'
-            '  <filter>'
-            '    <type>51</type>'
-            '    <operator>equal</operator>'
-            '    <value>2420917</value>'
-            '  </filter>'
-            '</filters>'
-            '<fields>'
-            '  <field>id</field>'
-            '  <field>title</field>'
-            '  <field>description</field>'
-            '  <field>status</field>'
-            '  <field>statusName</field>'
-            '  <field>template</field>'
-            '  <field>client</field>'
-            '  <field>beginDateTime</field>'
-            '  <field>customData</field>'  # Добавляем customData для получения номера заказа
-            '</fields>'
-            '</request>'
-        )
-        
         logger.info("Fetching ALL orders (tasks with template 2420917) for Produkty analytics...")
         
         # Добавляем задержку перед первым запросом
         logger.info("Waiting 2 seconds before first API call to avoid rate limits...")
-        time.sleep(2)
-        
-        # Делаем запрос с повторными попытками при ошибках лимитов
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                response = requests.post(
-                    planfix_utils.PLANFIX_API_URL,
-                    data=body.encode('utf-8'),
-                    headers=headers,
-                    auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-                )
-                response.raise_for_status()
-                response_xml = response.text
-                break
-            except Exception as e:
-                retry_count += 1
-                if "limit" in str(e).lower() or retry_count < max_retries:
-                    logger.warning(f"API limit error on first request, retry {retry_count}/{max_retries}")
-                    logger.info(f"Waiting 10 seconds before retry...")
-                    time.sleep(10)
-                    continue
-                else:
-                    logger.error(f"Failed to get first page after {max_retries} retries: {e}")
-                    raise
-        
-        logger.info(f"Successfully got first page, response length: {len(response_xml)}")
+        planfix_utils.api_pause(2)
         
-        # Логируем ответ для отладки
-        logger.info(f"API response length: {len(response_xml)}")
-        logger.debug(f"API response preview: {response_xml[:500]}...")
-        
-        # Парсим список задач
+        if parse_pool is None:
+            parse_pool = planfix_xml.ParsePool(workers=0)
+
+        task_stream = page_cache.stream(task_list_stream_key(field_profile)) if page_cache else None
+
         all_tasks = []
-        page = 1
-        max_retries = 3
-        
-        while True:
-            logger.info(f"Fetching page {page} of orders...")
-            
-            # Обновляем номер страницы в запросе
-            if page > 1:
-                body = body.replace(f'<pageCurrent>{page-1}</pageCurrent>', f'<pageCurrent>{page}</pageCurrent>')
-                
-                # Добавляем задержку перед каждым запросом страницы
-                logger.info(f"Waiting 3 seconds before fetching page {page}...")
-                time.sleep(3)
-                
-                response = requests.post(
-                    planfix_utils.PLANFIX_API_URL,
-                    data=body.encode('utf-8'),
-                    headers=headers,
-                    auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-                )
-                response.raise_for_status()
-                response_xml = response.text
-            
-            # Парсим задачи с повторными попытками при ошибках лимитов
-            page_tasks = []
-            retry_count = 0
-            
-            while retry_count < max_retries:
-                try:
-                    page_tasks = parse_task_list(response_xml)
-                    break
-                except Exception as e:
-                    retry_count += 1
-                    if "limit" in str(e).lower() or retry_count < max_retries:
-                        logger.warning(f"API limit error on page {page}, retry {retry_count}/{max_retries}")
-                        logger.info(f"Waiting 5 seconds before retry...")
-                        time.sleep(5)
-                        continue
-                    else:
-                        logger.error(f"Failed to parse page {page} after {max_retries} retries: {e}")
-                        break
-            
-            if not page_tasks:
+        pages = iter_parsed_pages(
+            lambda page: fetch_task_list_page(page, field_profile),
+            parse_task_rows, TASK_LIST_PAGE_SIZE, parse_pool,
+            page_delay=3, page_stream=task_stream, parse_retries=2
+        )
+        for page, task_rows, cached in pages:
+            if cached is not None:
+                logger.info(f"Orders page {page} unchanged since last run, reusing its rows")
+                task_rows = [tuple(row) for row in cached['payload']]
+                task_stream.carry(page, cached)
+            elif task_stream is not None:
+                task_stream.remember(page, len(task_rows), task_rows)
+
+            if not task_rows:
                 logger.info(f"No more orders found on page {page}")
                 break
-                
-            all_tasks.extend(page_tasks)
-            logger.info(f"Found {len(page_tasks)} orders on page {page}")
-            
-            # Если получили меньше задач чем размер страницы, значит это последняя страница
-            if len(page_tasks) < 100:
-                logger.info(f"Last page reached (got {len(page_tasks)} orders, expected 100)")
-                break
-                
-            # Получаем следующую страницу
-            page += 1
+            all_tasks.extend(dict(zip(TASK_ROW_FIELDS, row)) for row in task_rows)
+            logger.info(f"Found {len(task_rows)} orders on page {page}")
         
         if not all_tasks:
             logger.info("No orders found with template 2420917")
             return []
-        
-        logger.info(f"Found {len(all_tasks)} total orders, checking for Produkty analytics in actions...")
+        if mirror is not None:
+            mirror.put_orders(all_tasks)
+        logger.info(f"Found {len(all_tasks)} total orders")
+        return all_tasks
+
+    except Exception as e:
+        logger.error(f"Error getting orders: {e}")
+        raise
+
+def get_tasks_with_produkty_analytics(all_tasks, mirror=None):
+    """
+    Отбирает из заказов all_tasks те, в действиях которых есть аналитика "Produkty"
+    (action.getList и action.get по каждому заказу — только для запасного пути).
+    mirror — локальное зеркало (planfix_mirror): действия берутся из него, пока не устарели.
+    """
+    try:
+        logger.info(f"Checking {len(all_tasks)} orders for Produkty analytics in actions...")
         
         # Фильтруем задачи, которые имеют аналитику "Produkty" в действиях
         tasks_with_analytics = []
@@ -176,14 +277,19 @@ def get_tasks_with_produkty_analytics():
                 task_id = task['id']
                 logger.info(f"Checking order {task_id} for Produkty analytics in actions... ({i}/{len(all_tasks)})")
                 
-                # Добавляем задержку каждые 5 задач для избежания превышения лимитов API
-                if i % 5 == 0:
-                    logger.info(f"  Adding delay to avoid API limits...")
-                    time.sleep(2)  # 2 секунды задержки каждые 5 задач
-                
-                # Получаем список действий в задаче
-                actions_xml = get_task_actions(task_id)
-                actions = parse_task_actions(actions_xml)
+                # Список действий из зеркала, если он не устарел
+                actions = mirror.get_task_actions(task_id) if mirror is not None else None
+                if actions is None:
+                    # Добавляем задержку каждые 5 задач для избежания превышения лимитов API
+                    if i % 5 == 0:
+                        logger.info(f"  Adding delay to avoid API limits...")
+                        planfix_utils.api_pause(2)  # 2 секунды задержки каждые 5 задач
+
+                    # Получаем список действий в задаче
+                    actions_xml = get_task_actions(task_id)
+                    actions = parse_task_actions(actions_xml)
+                    if mirror is not None:
+                        mirror.put_task_actions(task_id, actions)
                 
                 logger.info(f"Order {task_id} has {len(actions)} actions")
                 
@@ -199,7 +305,7 @@ def get_tasks_with_produkty_analytics():
                             logger.info(f"  Progress: {i}/{len(actions)} actions checked...")
                         
                         # Получаем детали действия
-                        action_details_xml = get_action_details(action_id)
+                        action_details_xml = get_action_details_cached(action, task_id, mirror)
                         if has_produkty_analytics_in_action(action_details_xml):
                             logger.info(f"  ✅ Action {action_id} has Produkty analytics!")
                             actions_with_produkty.append(action)
@@ -229,7 +335,7 @@ def has_produkty_analytics(task_xml):
     Проверяет, есть ли в задаче аналитика "Produkty"
     """
     try:
-        root = ET.fromstring(task_xml)
+        root = planfix_xml.fromstring(task_xml)
         
         # Логируем структуру XML для отладки
         logger.info(f"XML root tag: {root.tag}")
@@ -269,11 +375,6 @@ def get_task_details(task_id):
     Получает детали задачи (заказа) с аналитикой
     """
     try:
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
         body = (
             '<?xml version="1.0" encoding="UTF-8"?>'
             '<request method="task.get">'
@@ -286,94 +387,106 @@ def get_task_details(task_id):
         
         logger.info(f"Fetching task details for ID: {task_id}")
         
-        response = requests.post(
-            planfix_utils.PLANFIX_API_URL,
-            data=body.encode('utf-8'),
-            headers=headers,
-            auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-        )
-        response.raise_for_status()
-        return response.text
+        return planfix_utils.post_planfix_xml('task.get', body, f'task={task_id}')
         
     except Exception as e:
         logger.error(f"Error getting task details for ID {task_id}: {e}")
         raise
 
-def get_produkty_analytics_data_by_condition(task_ids=None, page_size=100):
+def get_produkty_analytics_data_by_condition(task_ids=None, page_size=ANALYTICS_PAGE_SIZE, page=1):
     """
-    Получает все данные аналитики "Produkty" по условию (значительно быстрее)
+    Получает страницу данных аналитики "Produkty" по условию (значительно быстрее).
+    Возвращает сырые байты ответа.
     """
     try:
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
         # Формируем запрос для получения всех данных аналитики Produkty
         body = (
             '<?xml version="1.0" encoding="UTF-8"?>'
             '<request method="analitic.getDataByCondition">'
             f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
             f'<analitic><id>{PRODUKTY_ANALYTIC_KEY}</id></analitic>'
-            '<pageSize>100</pageSize>'
-            '<pageCurrent>1</pageCurrent>'
+            f'<pageSize>{page_size}</pageSize>'
+            f'<pageCurrent>{page}</pageCurrent>'
             '</request>'
         )
         
-        logger.info(f"Fetching all Produkty analytics data by condition (page size: {page_size})")
+        logger.info(f"Fetching Produkty analytics data by condition (page {page}, page size: {page_size})")
         
-        response = requests.post(
-            planfix_utils.PLANFIX_API_URL,
-            data=body.encode('utf-8'),
-            headers=headers,
-            auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
+        return planfix_utils.post_planfix_xml(
+            'analitic.getDataByCondition', body, analytics_spool_params(page_size), page
         )
-        response.raise_for_status()
-        return response.text
         
     except Exception as e:
         logger.error(f"Error getting analytics data by condition: {e}")
         raise
 
+def parse_task_rows(xml_data):
+    """
+    Разбирает страницу task.getList в компактные кортежи (см. TASK_ROW_FIELDS).
+    Вызывается и в процессах пула парсинга, поэтому возвращает только примитивы.
+    """
+    root = planfix_xml.fromstring(xml_data)
+    if root.attrib.get("status") == "error":
+        # Ответ с ошибкой — не пустая страница: список заказов не должен на ней обрываться
+        code = root.findtext("code")
+        message = root.findtext("message")
+        raise ValueError(f"Planfix API error: code={code}, message={message}")
+
+    rows = []
+    for task in root.iter('task'):
+        task_id = None
+        name = None
+        number = None
+        order_number = None
+        begin_datetime = None
+        status = None
+        status_name = None
+        template_id = None
+        client_id = None
+        client_name = None
+        for child in task:
+            tag = child.tag
+            if tag == 'id':
+                task_id = child.text
+            elif tag == 'name':
+                name = child.text
+            elif tag == 'number':
+                number = child.text
+            elif tag == 'beginDateTime':
+                begin_datetime = child.text
+            elif tag == 'status':
+                status = child.text
+            elif tag == 'statusName':
+                status_name = child.text
+            elif tag == 'template':
+                template_id = child.findtext('id')
+            elif tag == 'client':
+                client_id = child.findtext('id')
+                client_name = child.findtext('name')
+            elif tag == 'customData' and order_number is None:
+                # Извлекаем номер заказа из customData
+                for cv in child.findall('customValue'):
+                    if cv.findtext('field/name') == "Numer zamówienia":
+                        order_number = cv.findtext('value')
+                        break
+
+        if task_id:
+            rows.append((
+                int(task_id), name, number, order_number, begin_datetime,
+                int(status) if status and status.strip().isdigit() else None, status_name,
+                int(template_id) if template_id else None, int(client_id) if client_id else None, client_name,
+            ))
+
+    return rows
+
 def parse_task_list(xml_text):
     """
     Парсит список задач с аналитикой и извлекает номер заказа из customData
     """
     try:
-        root = ET.fromstring(xml_text)
-        if root.attrib.get("status") == "error":
-            code = root.findtext("code")
-            message = root.findtext("message")
-            logger.error(f"Planfix API error: code={code}, message={message}")
-            return []
-        
-        tasks = []
-        for task in root.findall('.//task'):
-            task_id = task.findtext('id')
-            name = task.findtext('name')
-            number = task.findtext('number')
-            
-            # Извлекаем номер заказа из customData
-            order_number = None
-            custom_data_root = task.find('customData')
-            if custom_data_root is not None:
-                for cv in custom_data_root.findall('customValue'):
-                    field_name = cv.findtext('field/name')
-                    if field_name == "Numer zamówienia":
-                        order_number = cv.findtext('value')
-                        break
-            
-            if task_id:
-                tasks.append({
-                    'id': int(task_id),
-                    'name': name,
-                    'number': number,
-                    'order_number': order_number
-                })
-        
-        return tasks
+        return [dict(zip(TASK_ROW_FIELDS, row)) for row in parse_task_rows(xml_text)]
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError: {e}")
         raise
 
@@ -382,7 +495,7 @@ def parse_task_details(xml_text):
     Парсит детали задачи
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -403,7 +516,7 @@ def parse_task_details(xml_text):
         
         return task_info
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError: {e}")
         raise
 
@@ -412,7 +525,7 @@ def parse_produkty_analytics_data(xml_text, task_id, order_number):
     Парсит данные аналитики "Produkty" для конкретной задачи
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -461,41 +574,19 @@ def parse_produkty_analytics_data(xml_text, task_id, order_number):
         
         return analytics_data
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError: {e}")
         raise
 
-def clean_field_name(field_name):
-    """
-    Очищает название поля для использования в SQL
-    """
-    # Заменяем польские символы и специальные символы
-    replacements = {
-        'ą': 'a', 'ć': 'c', 'ę': 'e', 'ł': 'l', 'ń': 'n', 'ó': 'o', 'ś': 's', 'ź': 'z', 'ż': 'z',
-        'Ą': 'A', 'Ć': 'C', 'Ę': 'E', 'Ł': 'L', 'Ń': 'N', 'Ó': 'O', 'Ś': 'S', 'Ź': 'Z', 'Ż': 'Z',
-        ' ': '_', '-': '_', '.': '_', ',': '_', '%': 'procent'
-    }
-    
-    clean_name = field_name
-    for old, new in replacements.items():
-        clean_name = clean_name.replace(old, new)
-    
-    # Убираем все неалфавитно-цифровые символы
-    clean_name = ''.join(c for c in clean_name if c.isalnum() or c == '_')
-    
-    # Приводим к нижнему регистру
-    return clean_name.lower()
+# Перенесены в planfix_utils: ими пользуется и реестр полей аналитик (planfix_analytic_registry)
+clean_field_name = planfix_utils.clean_field_name
+convert_polish_number = planfix_utils.convert_polish_number
 
 def get_task_actions(task_id):
     """
     Получает список действий в задаче через action.getList с обработкой лимитов
     """
     try:
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
         body = (
             '<?xml version="1.0" encoding="UTF-8"?>'
             '<request method="action.getList">'
@@ -509,16 +600,9 @@ def get_task_actions(task_id):
         )
         
         # Добавляем задержку для избежания превышения лимитов API
-        time.sleep(0.5)  # 500ms задержка между запросами
+        planfix_utils.api_pause(0.5)  # 500ms задержка между запросами
         
-        response = requests.post(
-            planfix_utils.PLANFIX_API_URL,
-            data=body.encode('utf-8'),
-            headers=headers,
-            auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-        )
-        response.raise_for_status()
-        return response.text
+        return planfix_utils.post_planfix_xml('action.getList', body, f'task={task_id}')
         
     except Exception as e:
         logger.error(f"Error getting actions for task {task_id}: {e}")
@@ -529,7 +613,7 @@ def parse_task_actions(xml_text):
     Парсит список действий из XML ответа action.getList
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -558,11 +642,6 @@ def get_action_details(action_id):
     Получает детали действия через action.get с обработкой лимитов
     """
     try:
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
         body = (
             '<?xml version="1.0" encoding="UTF-8"?>'
             '<request method="action.get">'
@@ -574,27 +653,35 @@ def get_action_details(action_id):
         )
         
         # Добавляем задержку для избежания превышения лимитов API
-        time.sleep(0.3)  # 300ms задержка между запросами
+        planfix_utils.api_pause(0.3)  # 300ms задержка между запросами
         
-        response = requests.post(
-            planfix_utils.PLANFIX_API_URL,
-            data=body.encode('utf-8'),
-            headers=headers,
-            auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-        )
-        response.raise_for_status()
-        return response.text
+        return planfix_utils.post_planfix_xml('action.get', body, f'action={action_id}')
         
     except Exception as e:
         logger.error(f"Error getting action details for {action_id}: {e}")
         raise
 
+def get_action_details_cached(action, task_id, mirror=None):
+    """
+    Детали действия из локального зеркала, если они не устарели, иначе
+    через action.get (ответ сохраняется в зеркало)
+    """
+    action_id = action.get('id')
+    if mirror is not None:
+        cached = mirror.get_action_xml(action_id)
+        if cached is not None:
+            return cached
+    action_xml = get_action_details(action_id)
+    if mirror is not None:
+        mirror.put_action(action_id, task_id, action.get('dateTime'), has_produkty_analytics_in_action(action_xml), action_xml)
+    return action_xml
+
 def has_produkty_analytics_in_action(xml_text):
     """
     Проверяет, есть ли аналитика "Produkty" в действии
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -633,12 +720,12 @@ def has_produkty_analytics_in_action(xml_text):
         logger.error(f"Error checking analytics in action: {e}")
         return False
 
-def extract_produkty_analytics_data_from_action(action_xml, task, action):
+def extract_produkty_analytics_data_from_action(action_xml, task, action, decoder):
     """
     Извлекает данные аналитики "Produkty" из действия
     """
     try:
-        root = ET.fromstring(action_xml)
+        root = planfix_xml.fromstring(action_xml)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -679,7 +766,7 @@ def extract_produkty_analytics_data_from_action(action_xml, task, action):
                 if analytic_data:
                     logger.info(f"✅ Got analytics data for key {analytic_key}, length: {len(analytic_data)}")
                     logger.info(f"Parsing analytics data...")
-                    parsed_data = parse_analytics_data(analytic_data, task, action)
+                    parsed_data = parse_analytics_data(analytic_data, task, action, decoder)
                     if parsed_data:
                         analytics_data.extend(parsed_data)
                         logger.info(f"✅ Successfully parsed {len(parsed_data)} records from analytics key {analytic_key}")
@@ -701,11 +788,6 @@ def get_analytics_data(analytic_key):
     Получает данные аналитики через analitic.getData используя ключ строки данных
     """
     try:
-        headers = {
-            'Content-Type': 'application/xml',
-            'Accept': 'application/xml'
-        }
-        
         body = (
             '<?xml version="1.0" encoding="UTF-8"?>'
             '<request method="analitic.getData">'
@@ -719,14 +801,7 @@ def get_analytics_data(analytic_key):
         logger.info(f"Requesting analytics data for key {analytic_key}...")
         logger.debug(f"Request body: {body}")
         
-        response = requests.post(
-            planfix_utils.PLANFIX_API_URL,
-            data=body.encode('utf-8'),
-            headers=headers,
-            auth=(planfix_utils.PLANFIX_API_KEY, planfix_utils.PLANFIX_TOKEN)
-        )
-        response.raise_for_status()
-        response_text = response.text
+        response_text = planfix_utils.post_planfix_xml('analitic.getData', body, f'key={analytic_key}')
         
         # Детальное логирование ответа
         logger.info(f"Analytics data response length: {len(response_text)}")
@@ -738,123 +813,74 @@ def get_analytics_data(analytic_key):
         logger.error(f"Error getting analytics data for key {analytic_key}: {e}")
         return None
 
-def convert_polish_number(value):
+def make_composite_key(record):
     """
-    Преобразует польские числа (запятая как разделитель) в английский формат (точка как разделитель)
-    для корректной записи в Supabase numeric поля
+    Составной ключ записи для upsert: task_id_action_id_analytic_key
     """
-    if not value or value == '':
-        return None
-    
-    try:
-        # Убираем пробелы
-        value = str(value).strip()
-        
-        # Если пустая строка, возвращаем None
-        if value == '':
-            return None
-        
-        # Заменяем запятую на точку
-        value = value.replace(',', '.')
-        
-        # Убираем лишние пробелы
-        value = value.replace(' ', '')
-        
-        # Проверяем, что это число
-        float(value)
-        
-        return value
-        
-    except (ValueError, TypeError):
-        # Если не удалось преобразовать в число, возвращаем None
-        logger.warning(f"Could not convert value '{value}' to number, setting to None")
-        return None
+    return f"{record.get('task_id', '')}_{record.get('action_id', '')}_{record.get('analytic_key', '')}"
+
+def build_analytics_records(rows, tasks_dict, decoder, handbook=None):
+    """
+    Превращает компактные строки аналитики (см. decoder.row_fields) в записи
+    для Supabase, дополняя их данными заказа из tasks_dict (словарь или
+    planfix_task_resolver.TaskResolver) и атрибутами товара
+    из справочника handbook (planfix_handbooks.HandbookLookup), если он задан
+    """
+    analytics_records = []
+    for row in rows:
+        record = dict(zip(decoder.row_fields, row))
+
+        # Находим задачу по ID
+        task = tasks_dict.get(record['task_id']) if record['task_id'] else None
+        if not task:
+            logger.warning(f"Task {record['task_id']} not found in tasks dictionary, skipping...")
+            continue
+
+        record['task_name'] = task.get('name', '')
+        record['order_number'] = task.get('order_number', '')  # Используем номер заказа из customData
+        # Дата заказа — ключ секционирования таблицы по месяцам (если она секционирована)
+        begin_datetime = planfix_utils.parse_planfix_date_string(task.get('begin_datetime'))
+        record[planfix_partitions.PARTITION_COLUMN] = begin_datetime.date() if begin_datetime else None
+        if handbook is not None:
+            record.update(handbook.attributes(record.get('nazwa_handbook_id')))
+        record['updated_at'] = datetime.now()
+        record['is_deleted'] = False
+        analytics_records.append(record)
+
+    return analytics_records
+
+def prepare_upsert_records(records, upsert_columns, keys=None):
+    """
+    Приводит записи к колонкам таблицы (отсутствующие — значения по умолчанию)
+    и добавляет составной ключ. Генератор: записи готовятся по одной.
+    Если передан список keys, в него добавляются составные ключи записей.
+    """
+    for record in records:
+        prepared_record = {}
+        for col in upsert_columns:  # Используем колонки без 'id'
+            if col in record:
+                prepared_record[col] = record[col]
+            else:
+                # Устанавливаем значения по умолчанию
+                if col == 'is_deleted':
+                    prepared_record[col] = False
+                elif col == 'updated_at':
+                    prepared_record[col] = datetime.now()
+                else:
+                    prepared_record[col] = None
+        # Составной ключ: task_id_action_id_analytic_key
+        prepared_record['composite_key'] = make_composite_key(prepared_record)
+        if keys is not None:
+            keys.append(prepared_record['composite_key'])
+        yield prepared_record
 
-def parse_analytics_data_by_condition(xml_text, tasks_dict):
+def parse_analytics_data_by_condition(xml_text, tasks_dict, decoder):
     """
     Парсит данные аналитики из XML ответа analitic.getDataByCondition
+    декодером полей decoder (planfix_analytic_registry.AnalyticRowDecoder)
     """
     try:
-        root = ET.fromstring(xml_text)
-        if root.attrib.get("status") == "error":
-            code = root.findtext("code")
-            message = root.findtext("message")
-            logger.error(f"Planfix API error: code={code}, message={message}")
-            return []
-        
-        logger.info(f"Parsing analytics data by condition XML...")
-        logger.debug(f"XML root tag: {root.tag}")
-        logger.debug(f"XML root attributes: {root.attrib}")
-        
-        analytics_records = []
-        
-        # Ищем данные аналитики
-        analitic_data_nodes = root.findall('.//analiticData')
-        logger.info(f"Found {len(analitic_data_nodes)} analiticData nodes")
-        
-        if not analitic_data_nodes:
-            logger.warning("No analiticData nodes found in XML")
-            return []
-        
-        for analitic_data in analitic_data_nodes:
-            key = analitic_data.findtext('key')
-            task_id = analitic_data.findtext('.//task/id')
-            action_id = analitic_data.findtext('.//action/id')
-            
-            logger.info(f"Processing analiticData with key: {key}, task_id: {task_id}, action_id: {action_id}")
-            
-            # Находим задачу по ID
-            task = tasks_dict.get(int(task_id)) if task_id else None
-            if not task:
-                logger.warning(f"Task {task_id} not found in tasks dictionary, skipping...")
-                continue
-            
-            # Собираем данные полей
-            field_data = {}
-            item_data_nodes = analitic_data.findall('.//itemData')
-            logger.info(f"Found {len(item_data_nodes)} itemData nodes")
-            
-            for item_data in item_data_nodes:
-                field_id = item_data.findtext('id')
-                field_name = item_data.findtext('name')
-                field_value = item_data.findtext('value')
-                field_value_id = item_data.findtext('valueId')
-                
-                logger.debug(f"Field: ID={field_id}, Name={field_name}, Value={field_value}, ValueID={field_value_id}")
-                
-                if field_id:
-                    field_data[field_id] = {
-                        'name': field_name,
-                        'value': field_value,
-                        'valueId': field_value_id
-                    }
-            
-            logger.info(f"Collected field data: {field_data}")
-            
-            # Создаем запись для Supabase с правильными названиями полей
-            record = {
-                'task_id': int(task_id),
-                'task_name': task.get('name', ''),
-                'action_id': int(action_id) if action_id else None,
-                'analytic_key': key,
-                'nazwa': field_data.get('27719', {}).get('value', ''),
-                'nazwa_handbook_id': field_data.get('27719', {}).get('valueId', ''),
-                'cena': convert_polish_number(field_data.get('27721', {}).get('value', '')),
-                'waluta': field_data.get('29133', {}).get('value', ''),
-                'ilosc': convert_polish_number(field_data.get('28079', {}).get('value', '')),
-                'rabat_procent': convert_polish_number(field_data.get('28109', {}).get('value', '')),
-                'cena_po_rabacie': convert_polish_number(field_data.get('28111', {}).get('value', '')),
-                'wartosc_netto': convert_polish_number(field_data.get('28081', {}).get('value', '')),
-                'prowizja_pln': convert_polish_number(field_data.get('29311', {}).get('value', '')),
-                'laczna_masa_kg': convert_polish_number(field_data.get('32907', {}).get('value', '')),
-                'order_number': task.get('order_number', ''),  # Используем номер заказа из customData
-                'updated_at': datetime.now(),
-                'is_deleted': False
-            }
-            
-            logger.info(f"Created record: {record}")
-            analytics_records.append(record)
-        
+        analytics_records = build_analytics_records(decoder(xml_text), tasks_dict, decoder)
         logger.info(f"Total records parsed: {len(analytics_records)}")
         return analytics_records
         
@@ -863,12 +889,12 @@ def parse_analytics_data_by_condition(xml_text, tasks_dict):
         logger.error(f"XML content: {xml_text[:500]}...")
         return []
 
-def parse_analytics_data(xml_text, task, action):
+def parse_analytics_data(xml_text, task, action, decoder):
     """
     Парсит данные аналитики из XML ответа analitic.getData (для обратной совместимости)
     """
     try:
-        root = ET.fromstring(xml_text)
+        root = planfix_xml.fromstring(xml_text)
         if root.attrib.get("status") == "error":
             code = root.findtext("code")
             message = root.findtext("message")
@@ -892,7 +918,7 @@ def parse_analytics_data(xml_text, task, action):
             logger.info(f"Alternative search: found {len(alternative_nodes)} analitic nodes")
             if alternative_nodes:
                 for node in alternative_nodes:
-                    logger.debug(f"Analytic node: {ET.tostring(node, encoding='unicode')}")
+                    logger.debug(f"Analytic node: {planfix_xml.tostring(node)}")
         
         for analitic_data in analitic_data_nodes:
             key = analitic_data.findtext('key')
@@ -926,16 +952,7 @@ def parse_analytics_data(xml_text, task, action):
                 'task_name': task.get('name', ''),
                 'action_id': action.get('id'),
                 'analytic_key': key,
-                'nazwa': field_data.get('27719', {}).get('value', ''),
-                'nazwa_handbook_id': field_data.get('27719', {}).get('valueId', ''),
-                'cena': convert_polish_number(field_data.get('27721', {}).get('value', '')),
-                'waluta': field_data.get('29133', {}).get('value', ''),
-                'ilosc': convert_polish_number(field_data.get('28079', {}).get('value', '')),
-                'rabat_procent': convert_polish_number(field_data.get('28109', {}).get('value', '')),
-                'cena_po_rabacie': convert_polish_number(field_data.get('28111', {}).get('value', '')),
-                'wartosc_netto': convert_polish_number(field_data.get('28081', {}).get('value', '')),
-                'prowizja_pln': convert_polish_number(field_data.get('29311', {}).get('value', '')),
-                'laczna_masa_kg': convert_polish_number(field_data.get('32907', {}).get('value', '')),
+                **decoder.decode_record(field_data),
                 'order_number': task.get('order_number', ''),  # Используем номер заказа из customData
                 'updated_at': datetime.now(),
                 'is_deleted': False
@@ -952,217 +969,456 @@ def parse_analytics_data(xml_text, task, action):
         logger.error(f"XML content: {xml_text[:500]}...")
         return []
 
-def export_produkty_with_orders():
+def export_produkty_with_orders(spool_path=None, from_spool=None, full_refresh=False, partition_by_month=False, write_workers=None):
     """
-    Главная функция экспорта аналитики "Produkty" с привязкой к заказам
+    Главная функция экспорта аналитики "Produkty" с привязкой к заказам.
+    spool_path — записать сырые ответы API в спул; from_spool — взять ответы
+    из ранее записанного спула вместо запросов к API; full_refresh —
+    обработать все страницы, даже не изменившиеся с прошлого запуска;
+    partition_by_month — перевести таблицу на помесячное секционирование
+    по дате заказа (если она еще не секционирована) и загрузить все заново;
+    write_workers — число параллельных соединений для загрузки
+    (по умолчанию SUPABASE_WRITE_WORKERS).
     """
     logger.info("--- Starting Produkty Analytics Export with Orders ---")
     
-    # Проверяем обязательные переменные окружения
-    planfix_utils.check_required_env_vars({
-        'PLANFIX_API_KEY': planfix_utils.PLANFIX_API_KEY,
-        'PLANFIX_TOKEN': planfix_utils.PLANFIX_TOKEN,
-        'PLANFIX_ACCOUNT': planfix_utils.PLANFIX_ACCOUNT,
-    })
+    if from_spool:
+        logger.info(f"Replaying Planfix responses from spool {from_spool}, no API calls will be made")
+        planfix_utils.set_response_spool(reader=planfix_spool.ResponseSpoolReader(from_spool))
+    else:
+        # Проверяем обязательные переменные окружения
+        planfix_utils.check_required_env_vars({
+            'PLANFIX_API_KEY': planfix_utils.PLANFIX_API_KEY,
+            'PLANFIX_TOKEN': planfix_utils.PLANFIX_TOKEN,
+            'PLANFIX_ACCOUNT': planfix_utils.PLANFIX_ACCOUNT,
+        })
+        if spool_path:
+            planfix_utils.set_response_spool(writer=planfix_spool.ResponseSpoolWriter(spool_path))
 
     conn = None
+    pg3_conn = None
+    # Локальное зеркало (PLANFIX_MIRROR_PATH): при повторе из спула ответы берутся только из спула
+    mirror = None if from_spool else planfix_mirror.open_mirror()
+    # Пул процессов для разбора больших страниц (PLANFIX_PARSE_WORKERS, 0 — без пула)
+    parse_pool = planfix_xml.ParsePool()
     try:
-        # Подключаемся к Supabase
-        conn = planfix_utils.get_supabase_connection()
-        
-        # Получаем список заказов с аналитикой "Produkty"
-        logger.info("Getting orders with Produkty analytics...")
-        tasks = get_tasks_with_produkty_analytics()
-        
-        if not tasks:
-            logger.info("No orders found with Produkty analytics")
+        # Подключаемся к Supabase (соединение из общего пула)
+        conn = planfix_utils.get_pooled_connection()
+
+        # Секционированная по месяцам таблица: нужна дата заказа (профиль 'enrich'),
+        # а upsert идет по (composite_key, order_date)
+        if partition_by_month and not planfix_partitions.is_partitioned(conn, PRODUKTY_TABLE_NAME):
+            create_supabase_table.convert_table_to_partitioned(conn, PRODUKTY_TABLE_NAME)
+            full_refresh = True
+        partitioned = planfix_partitions.is_partitioned(conn, PRODUKTY_TABLE_NAME)
+        if partitioned:
+            logger.info(f"Table '{PRODUKTY_TABLE_NAME}' is partitioned by {planfix_partitions.PARTITION_COLUMN} month")
+
+        # Хеши страниц прошлого запуска: неизменные страницы не разбираются и не загружаются.
+        # Если таблица пуста (создана заново или очищена), переносить нечего — обрабатываем все.
+        use_page_cache = not full_refresh and planfix_page_cache.table_has_live_rows(conn, PRODUKTY_TABLE_NAME)
+        if not full_refresh and not use_page_cache:
+            logger.info(f"Table '{PRODUKTY_TABLE_NAME}' has no live rows, processing all pages")
+        page_cache = planfix_page_cache.PageHashCache(conn, enabled=use_page_cache)
+
+        # Поля аналитики и их колонки — из реестра (analitic.getOptions не чаще раза в TTL)
+        definition = planfix_analytic_registry.get_analytic_definition(conn, PRODUKTY_ANALYTIC_KEY)
+        decoder = definition.decoder()
+        
+        # Получаем список заказов; действия заказов перебираются только в запасном пути
+        logger.info("Getting orders...")
+        orders = get_orders(
+            parse_pool, page_cache,
+            field_profile='enrich' if partitioned or PRODUKTY_SYNC_DIMENSIONS else TASK_FIELD_PROFILE,
+            mirror=mirror
+        )
+        if mirror is not None:
+            logger.info(f"Local mirror: {mirror.hits} entries reused, {mirror.misses} fetched from the API")
+
+        # Каждый запуск помечает записанные строки своим идентификатором, а хеш
+        # содержимого строки позволяет не переписывать строки без изменений
+        run_id = planfix_utils.new_run_id()
+
+        if not orders:
+            logger.info("No orders found")
             logger.info("This might mean:")
-            logger.info("1. No orders have Produkty analytics attached")
-            logger.info("2. Orders template ID might be incorrect")
-            logger.info("3. Produkty analytics ID might be incorrect")
-            logger.info("4. Analytics might be attached to different objects")
+            logger.info("1. Orders template ID might be incorrect")
+            logger.info("2. The API user cannot see the orders")
             return
+
+        # Заказы и клиенты из того же списка заказов — в таблицы измерений.
+        # Ошибка измерений не останавливает загрузку строк Produkty
+        if PRODUKTY_SYNC_DIMENSIONS:
+            try:
+                planfix_dimensions.sync_order_dimensions(conn, orders, run_id)
+            except (psycopg2.Error, ValueError) as e:
+                logger.error(f"❌ Error updating order dimensions: {e}")
+                conn.rollback()
         
-        logger.info(f"Found {len(tasks)} tasks with Produkty analytics")
         logger.info("Starting data extraction process...")
-        
-        all_analytics_data = []
-        
-        # Создаем словарь задач для быстрого поиска
-        tasks_dict = {task['id']: task for task in tasks}
+
+        # Ключи записей с неизменных страниц: не загружаются, но не должны помечаться удаленными
+        carried_keys = []
+
+        # Создаем словарь задач для быстрого поиска: строки аналитики ссылаются на заказы списка
+        tasks_dict = {task['id']: task for task in orders}
         logger.info(f"Created tasks dictionary with {len(tasks_dict)} tasks")
-        
-        # Используем оптимизированный подход - получаем все данные аналитики одним запросом
-        logger.info("Using optimized approach: getting all Produkty analytics data by condition...")
-        
-        try:
-            # Получаем все данные аналитики Produkty одним запросом
-            analytics_xml = get_produkty_analytics_data_by_condition()
-            
-            # Парсим данные аналитики
-            all_analytics_data = parse_analytics_data_by_condition(analytics_xml, tasks_dict)
-            
-            logger.info(f"✅ Successfully extracted {len(all_analytics_data)} analytics records using optimized approach")
-            
-        except Exception as e:
-            logger.error(f"Error using optimized approach: {e}")
-            logger.info("Falling back to traditional approach...")
-            
-            # Fallback к традиционному подходу
-            all_analytics_data = []
-            for task in tasks:
-                task_id = task['id']
-                logger.info(f"Processing task ID: {task_id}, Name: {task.get('name', 'Unknown')}")
-                
-                try:
-                    # Используем уже найденные действия с аналитикой Produkty
-                    actions_with_produkty = task.get('actions_with_produkty', [])
-                    
-                    if not actions_with_produkty:
-                        logger.warning(f"⚠️ Task {task_id} has no actions with Produkty analytics")
-                        continue
-                    
-                    logger.info(f"Task {task_id} has {len(actions_with_produkty)} actions with Produkty analytics")
-                    
-                    # Обрабатываем только действия с аналитикой Produkty
-                    found_analytics_in_task = False
-                    for action in actions_with_produkty:
-                        action_id = action.get('id')
-                        if action_id:
-                            logger.info(f"  Processing action {action_id} for Produkty analytics data...")
-                            
-                            # Получаем детали действия
-                            action_details_xml = get_action_details(action_id)
-                            
-                            # Извлекаем данные аналитики "Produkty" из действия
-                            analytics_data = extract_produkty_analytics_data_from_action(action_details_xml, task, action)
-                            if analytics_data:
-                                all_analytics_data.extend(analytics_data)
-                                logger.info(f"  ✅ Extracted {len(analytics_data)} analytics records from action {action_id}")
-                                found_analytics_in_task = True
-                            else:
-                                logger.warning(f"  ⚠️ No Produkty analytics data found in action {action_id}")
-                    
-                    if found_analytics_in_task:
-                        logger.info(f"✅ Task {task_id} successfully processed with analytics data")
-                    else:
-                        logger.warning(f"⚠️ Task {task_id} processed but no analytics data extracted")
-                        
-                except Exception as e:
-                    logger.error(f"Error processing task {task_id}: {e}")
-                    continue
-        
-        logger.info("Data extraction process completed.")
-        logger.info(f"Total analytics records collected: {len(all_analytics_data)}")
-        
-        if not all_analytics_data:
-            logger.warning("⚠️ No analytics data to export!")
-            logger.warning("This means the analytics were found but data extraction failed.")
-            return
-        
-        logger.info(f"✅ Total analytics records to export: {len(all_analytics_data)}")
-        logger.info("Starting Supabase export process...")
-        
-        # Получаем структуру таблицы
-        with conn.cursor() as cur:
-            cur.execute(f'SELECT * FROM "{PRODUKTY_TABLE_NAME}" LIMIT 0')
-            table_columns = [desc[0] for desc in cur.description]
-        
+        # Задачи строк аналитики, которых нет в списке заказов, дозапрашиваются пачками
+        task_resolver = planfix_task_resolver.TaskResolver(tasks_dict, parse_task_rows, TASK_ROW_FIELDS, mirror=mirror)
+
+        # Справочник товаров скачивается целиком один раз, атрибуты строк берутся из памяти
+        handbook = None
+        if PRODUKTY_HANDBOOK_ID:
+            handbook = planfix_handbooks.load_handbook(conn, PRODUKTY_HANDBOOK_ID, PRODUKTY_HANDBOOK_COLUMNS, run_id)
+
+        # Получаем структуру таблицы из реестра схем (DDL-проверки — только при изменении схемы).
+        # Колонки известны до чтения страниц: записи загружаются по мере извлечения
+        required_columns = {
+            planfix_utils.RUN_ID_COLUMN: 'TEXT',
+            planfix_utils.ROW_HASH_COLUMN: 'TEXT',
+        }
+        # Новые поля аналитики добавляются в таблицу колонками
+        required_columns.update(definition.column_types())
+        if handbook is not None:
+            required_columns.update({column: 'TEXT' for column in handbook.columns})
+        table_columns = planfix_schema.ensure_table_schema(conn, PRODUKTY_TABLE_NAME, required_columns)
+
         logger.info(f"Table columns: {table_columns}")
-        
+
         # Исключаем поле 'id' из upsert (оно автоинкрементное)
         upsert_columns = [col for col in table_columns if col != 'id']
         logger.info(f"Upsert columns (excluding 'id'): {upsert_columns}")
-        
-        # Подготавливаем данные для upsert
-        prepared_data = []
-        for record in all_analytics_data:
-            prepared_record = {}
-            for col in upsert_columns:  # Используем колонки без 'id'
-                if col in record:
-                    prepared_record[col] = record[col]
-                else:
-                    # Устанавливаем значения по умолчанию
-                    if col == 'is_deleted':
-                        prepared_record[col] = False
-                    elif col == 'updated_at':
-                        prepared_record[col] = datetime.now()
-                    else:
-                        prepared_record[col] = None
-            prepared_data.append(prepared_record)
-        
+
+        # Число извлеченных записей, несколько заказов для примера и месяцы, секции которых уже есть
+        extracted = {'records': 0, 'task_ids': set(), 'months': None}
+
+        def emit(records):
+            """Учитывает записи и создает секции их месяцев до того, как записи уйдут в загрузку."""
+            if partitioned:
+                months = {
+                    planfix_partitions.month_start(record[planfix_partitions.PARTITION_COLUMN])
+                    for record in records if record.get(planfix_partitions.PARTITION_COLUMN) is not None
+                }
+                if extracted['months'] is None or months - extracted['months']:
+                    planfix_partitions.ensure_month_partitions(
+                        conn, PRODUKTY_TABLE_NAME, months - (extracted['months'] or set())
+                    )
+                    extracted['months'] = (extracted['months'] or set()) | months
+            extracted['records'] += len(records)
+            for record in records:
+                if len(extracted['task_ids']) < 5 and record.get('task_id'):
+                    extracted['task_ids'].add(record['task_id'])
+            return records
+
+        def extract_analytics_records():
+            """
+            Генератор записей аналитики: страницы analitic.getDataByCondition по одной,
+            при ошибке — запасной путь по действиям заказов. Записи отдаются в загрузку
+            сразу, в памяти остаются только текущая страница и пачка загрузчика.
+            """
+            # Используем оптимизированный подход - получаем все данные аналитики постранично по условию
+            logger.info("Using optimized approach: getting all Produkty analytics data by condition...")
+
+            try:
+                # Страница зависит и от данных заказов, к которым привязаны ее строки,
+                # а также от описания полей аналитики и версии справочника
+                context_version = definition.version + (f":{handbook.version()}" if handbook else '')
+                analytics_stream = page_cache.stream(
+                    ANALYTICS_STREAM_KEY,
+                    planfix_page_cache.tasks_context_fn(task_resolver, context_version)
+                )
+                pages = iter_parsed_pages(
+                    lambda page: get_produkty_analytics_data_by_condition(page=page),
+                    decoder,
+                    ANALYTICS_PAGE_SIZE,
+                    parse_pool,
+                    page_stream=analytics_stream
+                )
+                for page, analytics_rows, cached in pages:
+                    if cached is not None:
+                        analytics_stream.carry(page, cached)
+                        carried_keys.extend(cached['payload'])
+                        logger.info(f"Page {page} unchanged since last run, carrying {len(cached['payload'])} keys forward")
+                        continue
+
+                    # Парсим данные аналитики и связываем их с заказами
+                    task_resolver.resolve(row[1] for row in analytics_rows)
+                    page_records = build_analytics_records(analytics_rows, task_resolver, decoder, handbook)
+                    if mirror is not None:
+                        mirror.put_analytics(page_records, make_composite_key)
+                    analytics_stream.remember(
+                        page,
+                        len(analytics_rows),
+                        [make_composite_key(record) for record in page_records],
+                        context_ids=[row[1] for row in analytics_rows if row[1]]
+                    )
+                    logger.info(f"Page {page}: {len(analytics_rows)} analytics rows, {len(page_records)} linked to orders")
+                    yield from emit(page_records)
+
+                logger.info(f"✅ Successfully extracted {extracted['records']} analytics records using optimized approach")
+                if task_resolver.requests:
+                    logger.info(f"Resolved {task_resolver.resolved} tasks missing from the order list in {task_resolver.requests} requests")
+                if carried_keys:
+                    logger.info(f"Skipped {len(carried_keys)} unchanged analytics records")
+
+            except Exception as e:
+                logger.error(f"Error using optimized approach: {e}")
+                logger.info("Falling back to traditional approach...")
+
+                # Fallback к традиционному подходу. Записи, уже загруженные быстрым путем,
+                # будут загружены повторно (upsert идемпотентен), страницы заново не переносятся
+                page_cache.discard(ANALYTICS_STREAM_KEY)
+                carried_keys.clear()
+                extracted['records'] = 0
+                tasks = get_tasks_with_produkty_analytics(orders, mirror)
+                logger.info(f"Found {len(tasks)} tasks with Produkty analytics")
+                for task in tasks:
+                    task_id = task['id']
+                    logger.info(f"Processing task ID: {task_id}, Name: {task.get('name', 'Unknown')}")
+
+                    task_records = []
+                    try:
+                        # Используем уже найденные действия с аналитикой Produkty
+                        actions_with_produkty = task.get('actions_with_produkty', [])
+
+                        if not actions_with_produkty:
+                            logger.warning(f"⚠️ Task {task_id} has no actions with Produkty analytics")
+                            continue
+
+                        logger.info(f"Task {task_id} has {len(actions_with_produkty)} actions with Produkty analytics")
+
+                        # Обрабатываем только действия с аналитикой Produkty
+                        for action in actions_with_produkty:
+                            action_id = action.get('id')
+                            if action_id:
+                                logger.info(f"  Processing action {action_id} for Produkty analytics data...")
+
+                                # Получаем детали действия
+                                action_details_xml = get_action_details_cached(action, task_id, mirror)
+
+                                # Извлекаем данные аналитики "Produkty" из действия
+                                analytics_data = extract_produkty_analytics_data_from_action(action_details_xml, task, action, decoder)
+                                if handbook is not None:
+                                    for record in analytics_data:
+                                        record.update(handbook.attributes(record.get('nazwa_handbook_id')))
+                                if analytics_data:
+                                    task_records.extend(analytics_data)
+                                    logger.info(f"  ✅ Extracted {len(analytics_data)} analytics records from action {action_id}")
+                                else:
+                                    logger.warning(f"  ⚠️ No Produkty analytics data found in action {action_id}")
+
+                        if task_records:
+                            logger.info(f"✅ Task {task_id} successfully processed with analytics data")
+                        else:
+                            logger.warning(f"⚠️ Task {task_id} processed but no analytics data extracted")
+
+                    except Exception as e:
+                        logger.error(f"Error processing task {task_id}: {e}")
+                    # Записи задачи уходят в загрузку, когда ее действия разобраны
+                    yield from emit(task_records)
+
+            logger.info("Data extraction process completed.")
+            if handbook is not None and handbook.misses:
+                logger.warning(f"{handbook.misses} analytics rows reference records missing from handbook {PRODUKTY_HANDBOOK_ID}")
+            logger.info(f"Total analytics records collected: {extracted['records']}")
+
+        logger.info("Starting Supabase export process...")
+
+        run_started_at = planfix_rollups.database_now(conn)
+
+        # Записи готовятся и загружаются пачками по мере чтения страниц: в памяти только
+        # текущая страница и пачка, а составные ключи собираются для пометки удаленных записей
+        live_keys = []
+        prepared_records = prepare_upsert_records(extract_analytics_records(), upsert_columns, live_keys)
+        upsert_key = 'composite_key'
+        if partitioned:
+            # Секции месяцев создаются по мере чтения страниц, до загрузки их строк (emit)
+            upsert_key = ('composite_key', planfix_partitions.PARTITION_COLUMN)
+
         # Обновляем данные в Supabase
         logger.info("Starting Supabase upsert...")
-        try:
-            # Создаем составной ключ для каждой записи
-            logger.info("Creating composite keys for upsert...")
-            
-            for record in prepared_data:
-                # Создаем составной ключ: task_id_action_id_analytic_key
-                record['composite_key'] = f"{record.get('task_id', '')}_{record.get('action_id', '')}_{record.get('analytic_key', '')}"
-                logger.debug(f"Created composite key: {record['composite_key']}")
-            
-            # Используем составной ключ для upsert
-            planfix_utils.upsert_data_to_supabase(
-                conn,
-                PRODUKTY_TABLE_NAME,
-                'composite_key',  # Primary key для upsert
-                upsert_columns,  # Используем колонки без 'id'
-                prepared_data
+        write_workers = write_workers or planfix_utils.SUPABASE_WRITE_WORKERS
+        if planfix_utils.SUPABASE_DB_BACKEND not in planfix_utils.DB_BACKENDS:
+            raise ValueError(
+                f"Unknown SUPABASE_DB_BACKEND '{planfix_utils.SUPABASE_DB_BACKEND}'. "
+                f"Expected one of: {', '.join(planfix_utils.DB_BACKENDS)}"
             )
-            logger.info(f"✅ Successfully upserted {len(prepared_data)} records to Supabase")
+        if planfix_utils.SUPABASE_DB_BACKEND == 'psycopg3':
+            # Загрузка, пометка удаленных и пересчет агрегатов — через pipeline mode psycopg 3
+            logger.info("Using the psycopg 3 backend (pipeline mode, binary COPY) for writes")
+            if write_workers > 1:
+                logger.warning("Parallel write workers are only supported by the psycopg2 backend, loading over one connection")
+            pg3_conn = planfix_psycopg3.get_connection()
+        try:
+            if pg3_conn is not None:
+                upsert_stats = planfix_psycopg3.upsert_stream_to_supabase(
+                    pg3_conn,
+                    PRODUKTY_TABLE_NAME,
+                    upsert_key,
+                    upsert_columns,
+                    prepared_records,
+                    run_id=run_id,
+                    detect_changes=True
+                )
+            elif write_workers > 1:
+                # Записи делятся по хешу ключа между соединениями пула: каждая строка
+                # пишется ровно одним потоком, каждая пачка — отдельная транзакция
+                upsert_stats = planfix_utils.upsert_parallel_to_supabase(
+                    PRODUKTY_TABLE_NAME,
+                    upsert_key,
+                    upsert_columns,
+                    prepared_records,
+                    workers=write_workers,
+                    run_id=run_id,
+                    detect_changes=True,
+                    quarantine=True
+                )
+            else:
+                # Используем составной ключ для upsert, каждая пачка — отдельная транзакция
+                upsert_stats = planfix_utils.upsert_stream_to_supabase(
+                    conn,
+                    PRODUKTY_TABLE_NAME,
+                    upsert_key,  # Составной ключ (и дата заказа для секционированной таблицы)
+                    upsert_columns,  # Используем колонки без 'id'
+                    prepared_records,
+                    run_id=run_id,
+                    detect_changes=True,
+                    quarantine=True  # Плохие строки — в карантин, остальное загружается
+                )
+            logger.info(f"✅ Successfully upserted {upsert_stats['rows']} records to Supabase")
+            if not extracted['records'] and not carried_keys:
+                # Без записей пометка удаленных сняла бы с учета всю таблицу
+                logger.warning("⚠️ No analytics data to export!")
+                logger.warning("This means the analytics were found but data extraction failed.")
+                return
+            if upsert_stats['quarantined']:
+                # Страницы с незагруженными строками обрабатываются заново в следующий раз
+                quarantined_keys = [
+                    row.get('composite_key')
+                    for row in planfix_utils.get_quarantined_rows(conn, PRODUKTY_TABLE_NAME, run_id)
+                ]
+                analytics_stream = page_cache.streams.get(ANALYTICS_STREAM_KEY)
+                if analytics_stream is not None:
+                    analytics_stream.forget_pages_with(quarantined_keys)
+                logger.warning(
+                    f"⚠️ {upsert_stats['quarantined']} records could not be loaded and were moved to "
+                    f"'{planfix_utils.QUARANTINE_TABLE}'"
+                )
+            if partitioned:
+                # Строки заказов, у которых сменилась дата, записаны в новую секцию
+                planfix_partitions.remove_moved_rows(conn, PRODUKTY_TABLE_NAME, 'composite_key', run_id)
         except Exception as e:
             logger.error(f"❌ Error during Supabase upsert: {e}")
             raise
         
-        # Получаем список всех составных ключей для пометки удаленных записей
-        all_composite_keys = [item['composite_key'] for item in prepared_data if item.get('composite_key')]
-        
-        # Помечаем записи как удаленные
-        if all_composite_keys:
-            logger.info("Marking old records as deleted...")
-            try:
+        # Помечаем записи как удаленные — один раз после того, как все пачки (и все потоки)
+        # зафиксированы. Неизмененные строки не получают run_id, поэтому передаются
+        # все актуальные ключи, включая ключи с неизменных страниц (anti-join по временной таблице)
+        all_composite_keys = live_keys + carried_keys
+        logger.info("Marking old records as deleted...")
+        try:
+            if pg3_conn is not None:
+                planfix_psycopg3.mark_items_as_deleted_in_supabase(
+                    pg3_conn, PRODUKTY_TABLE_NAME, 'composite_key', all_composite_keys
+                )
+            else:
                 planfix_utils.mark_items_as_deleted_in_supabase(
                     conn,
                     PRODUKTY_TABLE_NAME,
                     'composite_key',  # Используем составной ключ
                     all_composite_keys
                 )
-                logger.info("✅ Successfully marked old records as deleted")
-            except Exception as e:
-                logger.error(f"❌ Error marking records as deleted: {e}")
-        else:
-            logger.warning("⚠️ No composite keys found for deletion marking")
+            logger.info("✅ Successfully marked old records as deleted")
+        except Exception as e:
+            logger.error(f"❌ Error marking records as deleted: {e}")
+
+        # Пересчитываем агрегаты по заказам, продуктам и валютам только для заказов,
+        # строки которых изменились в этом запуске (при --full-refresh — полностью)
+        try:
+            touched_tasks = None if full_refresh else planfix_rollups.touched_task_ids(
+                conn, PRODUKTY_TABLE_NAME, run_id, run_started_at
+            )
+            if pg3_conn is not None:
+                planfix_psycopg3.refresh_rollups(pg3_conn, PRODUKTY_TABLE_NAME, touched_tasks)
+            else:
+                planfix_rollups.refresh_rollups(conn, PRODUKTY_TABLE_NAME, touched_tasks)
+            logger.info("✅ Rollup tables refreshed")
+        except Exception as e:
+            logger.error(f"❌ Error refreshing rollup tables: {e}")
+
+        # Данные загружены — сохраняем хеши страниц для следующего запуска
+        page_cache.save()
         
         logger.info("--- Produkty Analytics Export with Orders finished successfully ---")
         
         # Выводим статистику
         print(f"\n=== Статистика экспорта ===")
-        print(f"Обработано задач: {len(tasks)}")
-        print(f"Экспортировано записей: {len(all_analytics_data)}")
+        print(f"Обработано задач: {len(orders)}")
+        print(f"Экспортировано записей: {extracted['records']}")
+        if upsert_stats['inserted'] is not None:
+            print(f"  новых: {upsert_stats['inserted']}, изменено: {upsert_stats['updated']}, без изменений: {upsert_stats['unchanged']}")
+        if upsert_stats['quarantined']:
+            print(f"В карантине ({planfix_utils.QUARANTINE_TABLE}): {upsert_stats['quarantined']}")
+        if upsert_stats['collapsed']:
+            print(f"Повторов составного ключа (оставлена последняя запись): {upsert_stats['collapsed']}")
+        print(f"Пропущено без изменений: {len(carried_keys)}")
         print(f"Таблица: {PRODUKTY_TABLE_NAME}")
         print(f"Ключ аналитики: {PRODUKTY_ANALYTIC_KEY}")
         print(f"Время экспорта: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
         # Показываем примеры заказов
-        if all_analytics_data:
+        if extracted['task_ids']:
             print(f"\n=== Примеры заказов ===")
-            task_ids = set(item['task_id'] for item in all_analytics_data if item.get('task_id'))
-            for task_id in list(task_ids)[:5]:  # Показываем первые 5
+            for task_id in extracted['task_ids']:  # Первые 5 заказов, попавших в выгрузку
                 print(f"Заказ (Task ID): {task_id}")
 
     except Exception as e:
         logger.critical(f"An error occurred during export: {e}", exc_info=True)
         sys.exit(1)
     finally:
+        parse_pool.close()
+        planfix_utils.close_response_spool()
+        if pg3_conn is not None:
+            pg3_conn.close()
+        if mirror is not None:
+            mirror.close()
         if conn:
-            conn.close()
-            logger.info("Supabase connection closed.")
+            planfix_utils.release_connection(conn)
+        planfix_utils.close_connection_pool()
 
 def main():
     """
     Точка входа в программу
     """
+    parser = argparse.ArgumentParser(description="Export Planfix 'Produkty' analytics with orders to Supabase")
+    spool_group = parser.add_mutually_exclusive_group()
+    spool_group.add_argument(
+        '--spool',
+        default=os.environ.get('PLANFIX_SPOOL_PATH'),
+        help="Record raw Planfix responses of this run to a spool file (default: $PLANFIX_SPOOL_PATH)"
+    )
+    spool_group.add_argument(
+        '--from-spool',
+        help="Reprocess responses from a spool file recorded earlier instead of calling the Planfix API"
+    )
+    parser.add_argument(
+        '--full-refresh',
+        action='store_true',
+        help="Process every page even if it is unchanged since the last run"
+    )
+    parser.add_argument(
+        '--partition-by-month',
+        action='store_true',
+        help="Convert the table to monthly partitions by order date if needed (implies --full-refresh)"
+    )
+    parser.add_argument(
+        '--write-workers',
+        type=int,
+        default=planfix_utils.SUPABASE_WRITE_WORKERS,
+        help="Parallel database connections for the upsert (default: $SUPABASE_WRITE_WORKERS or 1)"
+    )
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -1170,7 +1426,13 @@ def main():
     )
     
     try:
-        export_produkty_with_orders()
+        export_produkty_with_orders(
+            spool_path=args.spool,
+            from_spool=args.from_spool,
+            full_refresh=args.full_refresh,
+            partition_by_month=args.partition_by_month,
+            write_workers=args.write_workers
+        )
     except KeyboardInterrupt:
         print("\nЭкспорт прерван пользователем")
         sys.exit(0)
@@ -0,0 +1,428 @@
+"""
+Реестр полей аналитик Planfix.
+
+Раньше ID полей аналитики Produkty (27719, 27721, ...) и их колонки были
+прописаны в коде экспорта, а create_supabase_table угадывал типы колонок
+по значениям одной записи. Теперь описание полей аналитики берется из
+метаданных Planfix (analitic.getOptions): ID, название, тип поля и
+справочник, на который оно ссылается. Описание хранится в Supabase
+(таблица planfix_analytic_registry) вместе с версией — хешем описания — и
+перечитывается из API не чаще раза в PLANFIX_ANALYTIC_REGISTRY_TTL секунд.
+
+Из описания строятся:
+  - колонки таблицы и их SQL-типы (column_types, fields_structure для DDL);
+  - декодер строк (AnalyticRowDecoder): разбирает страницы
+    analitic.getDataByCondition в компактные кортежи и передается в
+    процессы пула парсинга через pickle.
+
+Колонка и тип значения назначаются полю один раз и хранятся в реестре по
+ID поля (колонка "columns"): переименование поля в Planfix колонку не меняет.
+Новое поле получает колонку по очищенному названию (clean_field_name):
+"Ilość" -> ilosc, "Rabat, %" -> rabat_procent. Поля Produkty, колонки которых
+были прописаны в коде экспорта (на них завязаны planfix_rollups и справочник
+товаров), засеяны прежними колонками — KNOWN_FIELD_COLUMNS. Если Planfix
+меняет тип поля так, что меняется тип значения колонки, в журнал пишется
+ошибка, а поле по-прежнему приводится к типу колонки: в ней уже лежат
+значения старого типа. Поле-ссылка на справочник дает еще колонку
+{колонка}_handbook_id с ID записи справочника (valueId); у засеянных полей-ссылок
+(KNOWN_HANDBOOK_FIELDS) она есть всегда. Если описания нет ни в реестре, ни
+в ответе Planfix, экспорт идет по засеянным полям (seed_definition).
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import requests
+
+try:
+    import scripts.planfix_utils as planfix_utils
+    import scripts.planfix_xml as planfix_xml
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+    import planfix_xml
+
+logger = logging.getLogger(__name__)
+
+ANALYTIC_REGISTRY_TABLE = "planfix_analytic_registry"
+PLANFIX_ANALYTIC_REGISTRY_TTL = int(os.environ.get('PLANFIX_ANALYTIC_REGISTRY_TTL', '86400'))
+
+ANALYTIC_REGISTRY_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{ANALYTIC_REGISTRY_TABLE}" (
+    "analytic_id" INTEGER PRIMARY KEY,
+    "name" TEXT,
+    "version" TEXT NOT NULL,
+    "fields" JSONB NOT NULL,
+    "columns" JSONB,
+    "fetched_at" TIMESTAMP DEFAULT NOW()
+);
+ALTER TABLE "{ANALYTIC_REGISTRY_TABLE}" ADD COLUMN IF NOT EXISTS "columns" JSONB;
+'''
+
+# Коды типов полей Planfix (field/type), которые хранятся не текстом;
+# остальные типы (строка, текст, список, контакт, ...) — TEXT
+FIELD_TYPE_KINDS = {
+    1: 'number',
+    3: 'datetime',  # дата
+    5: 'datetime',  # дата и время
+    7: 'boolean',   # флажок
+}
+
+KIND_SQL_TYPES = {
+    'text': 'TEXT',
+    'number': 'NUMERIC',
+    'datetime': 'TIMESTAMP',
+    'boolean': 'BOOLEAN',
+}
+
+# Базовые поля строки перед колонками полей аналитики
+ROW_KEY_FIELDS = ('analytic_key', 'task_id', 'action_id')
+
+# Колонки полей Produkty, прописанные в коде экспорта до реестра: ID поля -> (колонка, тип значения)
+KNOWN_FIELD_COLUMNS = {
+    '27719': ('nazwa', 'text'),
+    '27721': ('cena', 'number'),
+    '29133': ('waluta', 'text'),
+    '28079': ('ilosc', 'number'),
+    '28109': ('rabat_procent', 'number'),
+    '28111': ('cena_po_rabacie', 'number'),
+    '28081': ('wartosc_netto', 'number'),
+    '29311': ('prowizja_pln', 'number'),
+    '32907': ('laczna_masa_kg', 'number'),
+}
+
+# Засеянные поля-ссылки на справочник: колонка {колонка}_handbook_id есть, даже если
+# analitic.getOptions не сообщил о справочнике (на nazwa_handbook_id завязаны
+# planfix_rollups и HandbookLookup)
+KNOWN_HANDBOOK_FIELDS = frozenset({'27719'})
+
+
+def _parse_boolean(value):
+    if value is None or not str(value).strip():
+        return None
+    return str(value).strip().lower() in ('1', 'true', 'tak', 'да', 'yes')
+
+
+def _convert(kind: str, value):
+    """Приводит текст поля к значению колонки (пустое число или дата — None)."""
+    if kind == 'number':
+        return planfix_utils.convert_polish_number(value)
+    if kind == 'datetime':
+        return planfix_utils.parse_planfix_date_string(value)
+    if kind == 'boolean':
+        return _parse_boolean(value)
+    return value
+
+
+def field_kind(field: dict) -> str:
+    """Тип значения поля: по коду типа Planfix, формулы считаются числами."""
+    if field.get('formula'):
+        return 'number'
+    return FIELD_TYPE_KINDS.get(field.get('type'), 'text')
+
+
+def has_handbook(field: dict) -> bool:
+    """Поле ссылается на справочник: по описанию Planfix или по засеянным полям."""
+    return bool(field.get('handbook_id')) or field['id'] in KNOWN_HANDBOOK_FIELDS
+
+
+def field_column(field: dict) -> str:
+    """Имя колонки поля: очищенное название без повторяющихся '_'."""
+    column = planfix_utils.clean_field_name(field['name'])
+    while '__' in column:
+        column = column.replace('__', '_')
+    return column.strip('_') or f"field_{field['id']}"
+
+
+def assign_columns(fields: list[dict], assigned: dict | None = None) -> dict:
+    """
+    Колонки полей: {ID поля: {'column': колонка, 'kind': тип значения, 'type': код типа Planfix}}.
+    Поля из assigned (назначения из реестра) сохраняют колонку и тип; новые
+    поля получают колонку из KNOWN_FIELD_COLUMNS или по названию. Назначения
+    пропавших полей сохраняются — вернувшееся поле получит прежнюю колонку.
+    Если код типа поля сменился и с ним тип значения, пишется ошибка, а поле
+    сохраняет тип значения (и код типа) колонки.
+    """
+    result = {field_id: dict(entry) for field_id, entry in (assigned or {}).items()}
+    used = {entry['column'] for entry in result.values()}
+    for field in fields:
+        kind = field_kind(field)
+        entry = result.get(field['id'])
+        if entry is None:
+            column, kind = KNOWN_FIELD_COLUMNS.get(field['id'], (field_column(field), kind))
+            if column in used:
+                column = f"{column}_{field['id']}"
+            used.add(column)
+            result[field['id']] = {'column': column, 'kind': kind, 'type': field.get('type')}
+        elif entry.get('type') != field.get('type'):
+            # У засеянного поля кода типа еще нет: он запоминается при первом описании из Planfix
+            if entry.get('type') is not None and kind != entry['kind']:
+                # Значения по-прежнему приводятся к типу колонки (неприводимые — None),
+                # колонку нужно перевести на новый тип вручную
+                logger.error(
+                    f"Type of analytic field {field['id']} ({field['name']}) changed from {entry['type']} "
+                    f"to {field.get('type')}: column '{entry['column']}' holds {entry['kind']} values, not {kind}; "
+                    f"keeping {entry['kind']}"
+                )
+                continue
+            entry['type'] = field.get('type')
+    return result
+
+
+class AnalyticRowDecoder:
+    """
+    Декодер страниц analitic.getDataByCondition, собранный из описания полей.
+    columns — кортежи (ID поля, колонка, тег itemData, тип значения).
+    Объект передается в процессы пула парсинга, поэтому хранит только примитивы.
+    """
+
+    def __init__(self, columns):
+        self.columns = tuple(tuple(column) for column in columns)
+        self.row_fields = ROW_KEY_FIELDS + tuple(column for _, column, _, _ in self.columns)
+        self.field_ids = frozenset(field_id for field_id, _, _, _ in self.columns)
+
+    def decode_fields(self, field_data: dict) -> list:
+        """Значения колонок из {ID поля: {тег: текст}} в порядке columns."""
+        values = []
+        for field_id, _, tag, kind in self.columns:
+            values.append(_convert(kind, field_data.get(field_id, {}).get(tag, '')))
+        return values
+
+    def decode_record(self, field_data: dict) -> dict:
+        """То же, что decode_fields, но словарем {колонка: значение}."""
+        return dict(zip(self.row_fields[len(ROW_KEY_FIELDS):], self.decode_fields(field_data)))
+
+    def __call__(self, xml_data) -> list[tuple]:
+        """
+        Разбирает страницу analitic.getDataByCondition в компактные кортежи
+        (см. row_fields). Вызывается и в процессах пула парсинга.
+        """
+        root = planfix_xml.fromstring(xml_data)
+        if root.attrib.get("status") == "error":
+            # Ответ с ошибкой — не последняя страница: ошибка уводит экспорт в запасной путь
+            code = root.findtext("code")
+            message = root.findtext("message")
+            raise ValueError(f"Planfix API error: code={code}, message={message}")
+
+        rows = []
+        for analitic_data in root.iter('analiticData'):
+            key = analitic_data.findtext('key')
+            task_id = analitic_data.findtext('.//task/id')
+            action_id = analitic_data.findtext('.//action/id')
+
+            # Собираем значения полей: ID поля -> {тег: текст}
+            field_data = {}
+            for item_data in analitic_data.iter('itemData'):
+                values = {child.tag: child.text for child in item_data}
+                field_id = values.get('id')
+                if field_id in self.field_ids:
+                    field_data[field_id] = values
+
+            logger.debug(f"analiticData key={key}, task_id={task_id}, action_id={action_id}, fields={field_data}")
+
+            row = [key, int(task_id) if task_id else None, int(action_id) if action_id else None]
+            row.extend(self.decode_fields(field_data))
+            rows.append(tuple(row))
+
+        return rows
+
+
+class AnalyticDefinition:
+    """Описание полей одной аналитики: ID, название и поля в порядке Planfix."""
+
+    def __init__(self, analytic_id: int, name: str | None, fields: list[dict], assigned: dict | None = None):
+        self.analytic_id = int(analytic_id)
+        self.name = name
+        # Поле: {'id': str, 'name': str, 'type': int | None, 'handbook_id': str | None, 'formula': bool}
+        self.fields = [dict(field) for field in fields]
+        # Колонки полей (см. assign_columns); assigned — назначения из реестра
+        self.assigned = assign_columns(self.fields, assigned)
+        payload = json.dumps([self.fields, self.assigned], sort_keys=True, ensure_ascii=False)
+        self.version = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+    def with_assignments(self, assigned: dict | None) -> 'AnalyticDefinition':
+        """То же описание с колонками, назначенными ранее (из реестра)."""
+        return AnalyticDefinition(self.analytic_id, self.name, self.fields, assigned)
+
+    def columns(self) -> list[tuple]:
+        """Колонки полей: (ID поля, колонка, тег itemData, тип значения)."""
+        columns = []
+        for field in self.fields:
+            entry = self.assigned[field['id']]
+            column = entry['column']
+            columns.append((field['id'], column, 'value', entry['kind']))
+            if has_handbook(field):
+                columns.append((field['id'], f"{column}_handbook_id", 'valueId', 'text'))
+        return columns
+
+    def column_types(self) -> dict:
+        """{колонка: SQL-тип} для колонок полей аналитики."""
+        return {column: KIND_SQL_TYPES[kind] for _, column, _, kind in self.columns()}
+
+    def fields_structure(self) -> dict:
+        """
+        Описание полей в формате create_supabase_table.generate_table_sql
+        (с явными именами колонок вместо выведенных из названия).
+        """
+        structure = {}
+        for field in self.fields:
+            entry = self.assigned[field['id']]
+            column = entry['column']
+            structure[field['name']] = {
+                'type': KIND_SQL_TYPES[entry['kind']],
+                'examples': [],
+                'has_value_id': has_handbook(field),
+                'column': column,
+                'value_id_column': f"{column}_handbook_id",
+            }
+        return structure
+
+    def decoder(self) -> AnalyticRowDecoder:
+        return AnalyticRowDecoder(self.columns())
+
+    def to_json(self) -> list[dict]:
+        return self.fields
+
+
+def build_analytic_options_body(analytic_id: int) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<request method="analitic.getOptions">'
+        f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
+        f'<analitic><id>{analytic_id}</id></analitic>'
+        '</request>'
+    )
+
+
+def parse_analytic_options(xml_data, analytic_id: int) -> AnalyticDefinition:
+    """Разбирает ответ analitic.getOptions в AnalyticDefinition."""
+    root = planfix_xml.fromstring(xml_data)
+    if root.attrib.get("status") == "error":
+        code = root.findtext("code")
+        message = root.findtext("message")
+        raise ValueError(f"Planfix API error: code={code}, message={message}")
+
+    analitic = root.find('.//analitic')
+    if analitic is None:
+        raise ValueError(f"No analitic element in analitic.getOptions response for analytic {analytic_id}")
+
+    fields = []
+    for field in analitic.iter('field'):
+        field_id = field.findtext('id')
+        name = field.findtext('name')
+        if not field_id or not name:
+            continue
+        field_type = field.findtext('type')
+        fields.append({
+            'id': field_id.strip(),
+            'name': name.strip(),
+            'type': int(field_type) if field_type and field_type.strip().isdigit() else None,
+            'handbook_id': field.findtext('handbook/id') or None,
+            'formula': bool((field.findtext('formula') or '').strip()),
+        })
+    if not fields:
+        raise ValueError(f"Analytic {analytic_id} has no fields in analitic.getOptions response")
+    return AnalyticDefinition(analytic_id, analitic.findtext('name'), fields)
+
+
+def seed_definition(analytic_id: int) -> AnalyticDefinition:
+    """
+    Описание из засеянных полей KNOWN_FIELD_COLUMNS (название поля — его колонка,
+    код типа неизвестен) — на случай, когда описания нет ни в реестре, ни у Planfix.
+    """
+    fields = [
+        {'id': field_id, 'name': column, 'type': None, 'handbook_id': None, 'formula': False}
+        for field_id, (column, _) in KNOWN_FIELD_COLUMNS.items()
+    ]
+    return AnalyticDefinition(analytic_id, None, fields)
+
+
+def fetch_analytic_definition(analytic_id: int) -> AnalyticDefinition:
+    """Запрашивает описание полей аналитики у Planfix (analitic.getOptions)."""
+    data = planfix_utils.post_planfix_xml(
+        'analitic.getOptions', build_analytic_options_body(analytic_id), f'analitic={analytic_id}'
+    )
+    definition = parse_analytic_options(data, analytic_id)
+    logger.info(f"Fetched {len(definition.fields)} fields of analytic {analytic_id} ({definition.name}), version {definition.version}")
+    return definition
+
+
+def load_stored_definition(conn, analytic_id: int) -> tuple[AnalyticDefinition, float] | None:
+    """Возвращает (описание, возраст в секундах) из реестра или None."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f'SELECT "name", "fields", "columns", EXTRACT(EPOCH FROM NOW() - "fetched_at") '
+                f'FROM "{ANALYTIC_REGISTRY_TABLE}" WHERE "analytic_id" = %s',
+                (analytic_id,)
+            )
+            row = cur.fetchone()
+        conn.commit()
+    except (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedColumn):
+        # Реестра нет или он создан до колонки "columns": store_definition его дополнит
+        conn.rollback()
+        return None
+    if row is None:
+        return None
+    return AnalyticDefinition(analytic_id, row[0], row[1], row[2]), float(row[3])
+
+
+def store_definition(conn, definition: AnalyticDefinition) -> None:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(ANALYTIC_REGISTRY_TABLE_SQL)
+            cur.execute(f'''
+                INSERT INTO "{ANALYTIC_REGISTRY_TABLE}" ("analytic_id", "name", "version", "fields", "columns", "fetched_at")
+                VALUES (%s, %s, %s, %s, %s, NOW())
+                ON CONFLICT ("analytic_id") DO UPDATE SET
+                    "name" = EXCLUDED."name",
+                    "version" = EXCLUDED."version",
+                    "fields" = EXCLUDED."fields",
+                    "columns" = EXCLUDED."columns",
+                    "fetched_at" = NOW();
+            ''', (
+                definition.analytic_id, definition.name, definition.version,
+                psycopg2.extras.Json(definition.to_json()), psycopg2.extras.Json(definition.assigned)
+            ))
+        conn.commit()
+    except psycopg2.Error as e:
+        # Без записи в реестре следующий запуск просто запросит описание еще раз
+        logger.warning(f"Could not save analytic registry entry for {definition.analytic_id}: {e}")
+        conn.rollback()
+
+
+def get_analytic_definition(conn, analytic_id: int, refresh: bool = False) -> AnalyticDefinition:
+    """
+    Returns the field definition of an analytic from the registry, fetching it
+    from Planfix when it is missing, older than PLANFIX_ANALYTIC_REGISTRY_TTL or
+    refresh=True. If the fetch fails, the stored definition is used, or the
+    seeded fields (seed_definition) when nothing is stored yet; the seeded
+    definition is not stored, so the next run fetches again. Fields keep the
+    columns and value kinds assigned to them in the registry.
+    """
+    stored = load_stored_definition(conn, analytic_id)
+    if stored is not None and not refresh and stored[1] <= PLANFIX_ANALYTIC_REGISTRY_TTL:
+        logger.info(f"Analytic {analytic_id} fields are up to date (registry version {stored[0].version})")
+        return stored[0]
+
+    try:
+        definition = fetch_analytic_definition(analytic_id)
+    except (requests.exceptions.RequestException, ValueError, *planfix_xml.ParseError) as e:
+        if stored is None:
+            logger.warning(f"Could not fetch fields of analytic {analytic_id} and none are stored, using the known fields: {e}")
+            return seed_definition(analytic_id)
+        logger.warning(f"Could not fetch fields of analytic {analytic_id}, using registry version {stored[0].version}: {e}")
+        return stored[0]
+    # Поля сохраняют колонки и типы значений, назначенные им ранее
+    if stored is not None:
+        definition = definition.with_assignments(stored[0].assigned)
+
+    if stored is not None and stored[0].version != definition.version:
+        logger.info(f"Fields of analytic {analytic_id} changed: version {stored[0].version} -> {definition.version}")
+    store_definition(conn, definition)
+    return definition
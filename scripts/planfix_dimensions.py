@@ -0,0 +1,158 @@
+"""
+Таблицы измерений заказов и клиентов.
+
+Список заказов (task.getList, профиль полей 'enrich') уже содержит статус,
+шаблон, клиента и дату начала каждого заказа. Раньше в строки Produkty
+попадало только название заказа, остальное отбрасывалось. Теперь тот же
+проход по списку заказов обновляет две узкие таблицы:
+
+  planfix_orders  — заказ: номер, статус и его название, шаблон, клиент, дата;
+  planfix_clients — клиент: ID и имя.
+
+Обе таблицы пишутся с хешем строки (неизмененные строки не переписываются).
+Заказы, которых больше нет в списке, помечаются удаленными; клиенты не
+удаляются — на них ссылаются и старые заказы. Строки Produkty связываются
+с заказами по task_id, заказы с клиентами — по client_id.
+"""
+
+import logging
+from datetime import datetime
+
+try:
+    import scripts.planfix_utils as planfix_utils
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+
+logger = logging.getLogger(__name__)
+
+ORDERS_TABLE = "planfix_orders"
+CLIENTS_TABLE = "planfix_clients"
+
+ORDERS_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{ORDERS_TABLE}" (
+    "task_id" INTEGER PRIMARY KEY,
+    "task_name" TEXT,
+    "number" TEXT,
+    "order_number" TEXT,
+    "status" INTEGER,
+    "status_name" TEXT,
+    "template_id" INTEGER,
+    "client_id" INTEGER,
+    "begin_datetime" TIMESTAMP,
+    "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+    "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    "is_deleted" BOOLEAN DEFAULT FALSE
+);
+CREATE INDEX IF NOT EXISTS "{ORDERS_TABLE}_client_id_idx" ON "{ORDERS_TABLE}" ("client_id");
+CREATE INDEX IF NOT EXISTS "{ORDERS_TABLE}_order_number_idx" ON "{ORDERS_TABLE}" ("order_number");
+'''
+
+CLIENTS_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{CLIENTS_TABLE}" (
+    "client_id" INTEGER PRIMARY KEY,
+    "name" TEXT,
+    "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+    "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    "is_deleted" BOOLEAN DEFAULT FALSE
+);
+'''
+
+ORDER_COLUMNS = [
+    'task_id', 'task_name', 'number', 'order_number', 'status', 'status_name',
+    'template_id', 'client_id', 'begin_datetime', 'updated_at', 'is_deleted',
+]
+CLIENT_COLUMNS = ['client_id', 'name', 'updated_at', 'is_deleted']
+
+
+def build_order_rows(tasks) -> list[dict]:
+    """
+    Строки planfix_orders из заказов в формате parse_task_list. Если в ответе
+    нет названия статуса, оно берется из кеша статусов (get_planfix_status_name),
+    в который загружаются только наборы статусов шаблонов заказов.
+    """
+    now = datetime.now()
+    template_ids = sorted({str(task['template_id']) for task in tasks if task.get('template_id') is not None})
+    rows = []
+    for task in tasks:
+        status = task.get('status')
+        status_name = task.get('status_name')
+        if status is not None and not status_name:
+            status_name = planfix_utils.get_planfix_status_name(str(status), template_ids)
+        rows.append({
+            'task_id': task['id'],
+            'task_name': task.get('name'),
+            'number': task.get('number'),
+            'order_number': task.get('order_number'),
+            'status': status,
+            'status_name': status_name,
+            'template_id': task.get('template_id'),
+            'client_id': task.get('client_id'),
+            'begin_datetime': planfix_utils.parse_planfix_date_string(task.get('begin_datetime')),
+            'updated_at': now,
+            'is_deleted': False,
+        })
+    return rows
+
+
+def build_client_rows(tasks) -> list[dict]:
+    """Строки planfix_clients: клиенты заказов без повторов (имя — из последнего заказа)."""
+    now = datetime.now()
+    clients = {}
+    for task in tasks:
+        if task.get('client_id') is not None:
+            clients[task['client_id']] = {
+                'client_id': task['client_id'],
+                'name': task.get('client_name'),
+                'updated_at': now,
+                'is_deleted': False,
+            }
+    return list(clients.values())
+
+
+def mark_missing_orders_deleted(conn, task_ids: list) -> int:
+    """
+    Помечает удаленными заказы, которых нет в task_ids. Возвращает их число.
+    Пустой список не считается полным: без заказов ничего не помечается.
+    """
+    if not task_ids:
+        logger.warning(f"Order list is empty, not marking orders in {ORDERS_TABLE} as deleted")
+        return 0
+    # Хеш сбрасывается, чтобы вернувшийся заказ снова записался с is_deleted = FALSE
+    return planfix_utils.mark_items_as_deleted_in_supabase(
+        conn, ORDERS_TABLE, 'task_id', task_ids, reset_row_hash=True
+    )
+
+
+def sync_order_dimensions(conn, tasks, run_id: str) -> dict:
+    """
+    Обновляет planfix_orders и planfix_clients по полному списку заказов tasks
+    (формат parse_task_list). Возвращает {'orders': статистика upsert с числом
+    удаленных, 'clients': статистика upsert}.
+    """
+    planfix_utils.create_table_if_not_exists(conn, ORDERS_TABLE_SQL)
+    planfix_utils.create_table_if_not_exists(conn, CLIENTS_TABLE_SQL)
+
+    client_stats = planfix_utils.upsert_data_to_supabase(
+        conn, CLIENTS_TABLE, 'client_id', CLIENT_COLUMNS, build_client_rows(tasks),
+        run_id=run_id, detect_changes=True
+    )
+    order_rows = build_order_rows(tasks)
+    order_stats = planfix_utils.upsert_data_to_supabase(
+        conn, ORDERS_TABLE, 'task_id', ORDER_COLUMNS, order_rows,
+        run_id=run_id, detect_changes=True
+    )
+    order_stats['deleted'] = mark_missing_orders_deleted(conn, [row['task_id'] for row in order_rows])
+
+    logger.info(
+        f"Dimensions: {order_stats['rows']} orders, {order_stats['deleted']} marked deleted; "
+        f"{client_stats['rows']} clients"
+    )
+    if order_stats['inserted'] is not None:
+        logger.info(
+            f"Dimensions: orders {order_stats['inserted']} new, {order_stats['updated']} changed, "
+            f"{order_stats['unchanged']} unchanged; clients {client_stats['inserted']} new, "
+            f"{client_stats['updated']} changed, {client_stats['unchanged']} unchanged"
+        )
+    return {'orders': order_stats, 'clients': client_stats}
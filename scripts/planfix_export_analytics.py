@@ -1,8 +1,8 @@
 import os
+import itertools
 import sys
 import logging
 from datetime import datetime
-import xml.etree.ElementTree as ET
 import psycopg2
 import requests
 from dotenv import load_dotenv
@@ -13,6 +13,8 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import scripts.planfix_utils as planfix_utils
+import scripts.planfix_xml as planfix_xml
+import scripts.planfix_schema as planfix_schema
 
 # Константы для скрипта
 ANALYTICS_TABLE_NAME = "planfix_analytics"
@@ -63,18 +65,19 @@ def get_planfix_analytics_data(analytic_keys):
     response.raise_for_status()
     return response.text
 
-def parse_analytics_data(xml_text):
+def parse_analytics_data(xml_text, ids=None):
     """
-    Парсит XML ответ от API analitic.getData
+    Парсит XML ответ от API analitic.getData. Генератор: записи отдаются
+    в загрузку по одной. Если передан список ids, в него добавляются ID записей.
     """
-    root = ET.fromstring(xml_text)
+    root = planfix_xml.fromstring(xml_text)
     if root.attrib.get("status") == "error":
         code = root.findtext("code")
         message = root.findtext("message")
         logger.error(f"Ошибка Planfix API: code={code}, message={message}")
-        return []
+        return
     
-    analytics_data = []
+    count = 0
     
     # Парсим analiticDatas
     for analitic_data in root.findall('.//analiticData'):
@@ -89,8 +92,8 @@ def parse_analytics_data(xml_text):
             value = item_data.findtext('value')
             value_id = item_data.findtext('valueId')
             
-            analytics_data.append({
-                "id": f"{key}_{item_id}" if item_id else f"{key}_{len(analytics_data)}",
+            record = {
+                "id": f"{key}_{item_id}" if item_id else f"{key}_{count}",
                 "analitic_key": int(key) if key else None,
                 "item_id": int(item_id) if item_id else None,
                 "name": name,
@@ -98,9 +101,11 @@ def parse_analytics_data(xml_text):
                 "value_id": value_id,
                 "updated_at": datetime.now(),
                 "is_deleted": False
-            })
-    
-    return analytics_data
+            }
+            count += 1
+            if ids is not None:
+                ids.append(record["id"])
+            yield record
 
 def get_create_table_sql(table_name, pk_column, columns_map):
     """
@@ -138,11 +143,13 @@ def main():
         
         # Получаем данные аналитик из ПланФикса
         xml_text = get_planfix_analytics_data(ANALYTIC_KEYS)
-        analytics_data = parse_analytics_data(xml_text)
-        
-        logger.info(f"Total analytics records processed: {len(analytics_data)}")
+        # Записи разбираются по мере загрузки пачками, собираются только их ID
+        # для пометки удаленных записей
+        all_ids = []
+        analytics_data = parse_analytics_data(xml_text, all_ids)
+        first_record = next(analytics_data, None)
 
-        if not analytics_data:
+        if first_record is None:
             logger.info("No analytics data to update. Exiting.")
             return
 
@@ -158,34 +165,32 @@ def main():
             "value": "TEXT",
             "value_id": "TEXT",
             "updated_at": "TIMESTAMP",
-            "is_deleted": "BOOLEAN"
+            "is_deleted": "BOOLEAN",
+            planfix_utils.RUN_ID_COLUMN: "TEXT",
+            planfix_utils.ROW_HASH_COLUMN: "TEXT"
         }
 
-        # Создаем таблицу если она не существует
+        # Создаем таблицу и добавляем недостающие колонки, только если схема изменилась
+        # с прошлого запуска; финальный список колонок берется из реестра схем
         create_sql = get_create_table_sql(ANALYTICS_TABLE_NAME, ANALYTICS_PK_COLUMN, columns_map)
-        planfix_utils.create_table_if_not_exists(conn, create_sql)
-
-        # Добавляем недостающие колонки
-        planfix_utils.add_missing_columns(conn, ANALYTICS_TABLE_NAME, columns_map)
+        db_column_names = planfix_schema.ensure_table_schema(conn, ANALYTICS_TABLE_NAME, columns_map, create_sql)
 
-        # Получаем финальный список колонок из БД
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT * FROM {ANALYTICS_TABLE_NAME} LIMIT 0")
-            db_column_names = [desc[0] for desc in cur.description]
-
-        # Обновляем данные в Supabase
-        planfix_utils.upsert_data_to_supabase(
+        # Обновляем данные в Supabase пачками (каждая — отдельная транзакция),
+        # отмечая строки идентификатором запуска
+        run_id = planfix_utils.new_run_id()
+        planfix_utils.upsert_stream_to_supabase(
             conn,
             ANALYTICS_TABLE_NAME,
             ANALYTICS_PK_COLUMN,
             db_column_names,
-            analytics_data
+            itertools.chain([first_record], analytics_data),
+            run_id=run_id,
+            detect_changes=True
         )
+        logger.info(f"Total analytics records processed: {len(all_ids)}")
 
-        # Получаем список всех ID для пометки удаленных записей
-        all_ids = [item["id"] for item in analytics_data if item.get("id")]
-        
-        # Помечаем записи как удаленные
+        # Помечаем записи как удаленные по ID всех записей ответа
+        # (неизмененные строки не переписываются и run_id не получают)
         planfix_utils.mark_items_as_deleted_in_supabase(
             conn,
             ANALYTICS_TABLE_NAME,
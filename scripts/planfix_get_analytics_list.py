@@ -2,7 +2,6 @@ import os
 import sys
 import logging
 from datetime import datetime
-import xml.etree.ElementTree as ET
 import requests
 from dotenv import load_dotenv
 
@@ -12,6 +11,7 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import scripts.planfix_utils as planfix_utils
+import scripts.planfix_xml as planfix_xml
 
 logger = logging.getLogger(__name__)
 
@@ -80,7 +80,7 @@ def parse_actions_list(xml_text):
     """
     Парсит XML ответ от API action.getList
     """
-    root = ET.fromstring(xml_text)
+    root = planfix_xml.fromstring(xml_text)
     if root.attrib.get("status") == "error":
         code = root.findtext("code")
         message = root.findtext("message")
@@ -105,7 +105,7 @@ def parse_action_details(xml_text):
     """
     Парсит XML ответ от API action.get для получения аналитик
     """
-    root = ET.fromstring(xml_text)
+    root = planfix_xml.fromstring(xml_text)
     if root.attrib.get("status") == "error":
         code = root.findtext("code")
         message = root.findtext("message")
@@ -0,0 +1,240 @@
+"""
+Кеш записей справочников Planfix для обогащения строк аналитики.
+
+Строки Produkty содержат только ID записи справочника товаров
+(nazwa_handbook_id) и ее название. Остальные атрибуты товара (артикул,
+категория и т.п.) берутся из справочника: он целиком скачивается
+постранично (handbook.getRecords), сохраняется в таблицу
+planfix_handbook_records с ключом (handbook_id, record_key) и хешем строки
+(неизмененные записи не переписываются), а при разборе строк аналитики
+атрибуты подставляются из словаря в памяти — без запросов на каждую строку.
+
+Если справочник не удалось скачать (ошибка API, повтор из спула без его
+страниц), используется копия из таблицы, сохраненная прошлым запуском.
+"""
+
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+import psycopg2
+import psycopg2.errors
+import requests
+
+try:
+    import scripts.planfix_utils as planfix_utils
+    import scripts.planfix_xml as planfix_xml
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+    import planfix_xml
+
+logger = logging.getLogger(__name__)
+
+HANDBOOK_TABLE = "planfix_handbook_records"
+HANDBOOK_PAGE_SIZE = 100
+
+HANDBOOK_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{HANDBOOK_TABLE}" (
+    "handbook_id" INTEGER NOT NULL,
+    "record_key" TEXT NOT NULL,
+    "parent_key" TEXT,
+    "is_group" BOOLEAN DEFAULT FALSE,
+    "fields" JSONB NOT NULL,
+    "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+    "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    "is_deleted" BOOLEAN DEFAULT FALSE,
+    PRIMARY KEY ("handbook_id", "record_key")
+);
+'''
+
+HANDBOOK_COLUMNS = ['handbook_id', 'record_key', 'parent_key', 'is_group', 'fields', 'updated_at', 'is_deleted']
+
+
+def parse_columns_spec(spec: str) -> dict:
+    """Разбирает 'колонка=Поле справочника,...' в {колонка: поле}."""
+    columns = {}
+    for item in spec.split(','):
+        column, sep, field_name = item.partition('=')
+        if not sep or not column.strip() or not field_name.strip():
+            raise ValueError(f"Invalid handbook column mapping '{item}', expected column=Field name")
+        columns[column.strip()] = field_name.strip()
+    return columns
+
+
+def handbook_spool_params(handbook_id: int, page_size: int = HANDBOOK_PAGE_SIZE) -> str:
+    return f'handbook={handbook_id};pageSize={page_size}'
+
+
+def build_handbook_records_body(handbook_id: int, page: int, page_size: int = HANDBOOK_PAGE_SIZE) -> str:
+    """Формирует XML-запрос handbook.getRecords для страницы записей справочника."""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<request method="handbook.getRecords">'
+        f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
+        f'<handbook><id>{handbook_id}</id></handbook>'
+        f'<pageCurrent>{page}</pageCurrent>'
+        f'<pageSize>{page_size}</pageSize>'
+        '</request>'
+    )
+
+
+def parse_handbook_records(xml_data) -> list[tuple]:
+    """
+    Разбирает страницу handbook.getRecords в кортежи
+    (record_key, parent_key, is_group, {название поля: значение}).
+    """
+    root = planfix_xml.fromstring(xml_data)
+    if root.attrib.get("status") == "error":
+        code = root.findtext("code")
+        message = root.findtext("message")
+        raise ValueError(f"Planfix API error: code={code}, message={message}")
+
+    records = []
+    for record in root.iter('record'):
+        key = record.findtext('key')
+        if not key:
+            continue
+        fields = {}
+        for custom_value in record.iter('customValue'):
+            name = custom_value.findtext('field/name')
+            if name:
+                # text — отображаемое значение (для ссылок и списков), value — сырое
+                text = custom_value.findtext('text')
+                fields[name] = text if text else custom_value.findtext('value')
+        records.append((key.strip(), record.findtext('parentKey') or None, record.findtext('isGroup') == '1', fields))
+    return records
+
+
+def fetch_handbook_records(handbook_id: int, page_size: int = HANDBOOK_PAGE_SIZE) -> list[tuple]:
+    """Скачивает все записи справочника постранично (см. parse_handbook_records)."""
+    records = []
+    page = 1
+    while True:
+        data = planfix_utils.post_planfix_xml(
+            'handbook.getRecords',
+            build_handbook_records_body(handbook_id, page, page_size),
+            handbook_spool_params(handbook_id, page_size),
+            page
+        )
+        page_records = parse_handbook_records(data)
+        records.extend(page_records)
+        if len(page_records) < page_size:
+            break
+        page += 1
+        planfix_utils.api_pause(1)
+    logger.info(f"Fetched {len(records)} records of handbook {handbook_id} ({page} pages)")
+    return records
+
+
+def store_handbook_records(conn, handbook_id: int, records: list[tuple], run_id: str) -> dict:
+    """
+    Сохраняет записи справочника в HANDBOOK_TABLE. Неизмененные записи не
+    переписываются (хеш строки), записи, которых больше нет в справочнике,
+    помечаются удаленными (если справочник вернул хоть одну запись).
+    Возвращает статистику upsert и число удаленных.
+    """
+    planfix_utils.create_table_if_not_exists(conn, HANDBOOK_TABLE_SQL)
+    now = datetime.now()
+    rows = [
+        {
+            'handbook_id': handbook_id,
+            'record_key': key,
+            'parent_key': parent_key,
+            'is_group': is_group,
+            # Ключи сортируются, чтобы хеш строки не зависел от порядка полей в ответе
+            'fields': json.dumps(fields, ensure_ascii=False, sort_keys=True),
+            'updated_at': now,
+            'is_deleted': False,
+        }
+        for key, parent_key, is_group, fields in records
+    ]
+    stats = planfix_utils.upsert_data_to_supabase(
+        conn, HANDBOOK_TABLE, ('handbook_id', 'record_key'), HANDBOOK_COLUMNS, rows,
+        run_id=run_id, detect_changes=True
+    )
+
+    if not records:
+        # Пустой ответ скорее сбой, чем пустой справочник: копия прошлого запуска остается
+        logger.warning(f"Handbook {handbook_id} returned no records, not marking stored records as deleted")
+        stats['deleted'] = 0
+        return stats
+    # Хеш сбрасывается, чтобы вернувшаяся запись снова записалась с is_deleted = FALSE
+    stats['deleted'] = planfix_utils.mark_items_as_deleted_in_supabase(
+        conn, HANDBOOK_TABLE, 'record_key', [key for key, _, _, _ in records],
+        scope={'handbook_id': handbook_id}, reset_row_hash=True
+    )
+    return stats
+
+
+def load_handbook_records(conn, handbook_id: int) -> list[tuple]:
+    """Читает сохраненную копию справочника (без удаленных записей) в формате parse_handbook_records."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'''
+                SELECT "record_key", "parent_key", "is_group", "fields" FROM "{HANDBOOK_TABLE}"
+                WHERE "handbook_id" = %s AND NOT "is_deleted"
+            ''', (handbook_id,))
+            records = [tuple(row) for row in cur.fetchall()]
+        conn.commit()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return []
+    return records
+
+
+class HandbookLookup:
+    """
+    Атрибуты записей одного справочника для обогащения строк.
+    columns — {колонка таблицы: название поля справочника}.
+    """
+
+    def __init__(self, handbook_id: int, columns: dict, records: list[tuple]):
+        self.handbook_id = handbook_id
+        self.columns = dict(columns)
+        field_names = list(self.columns.values())
+        self._attributes = {
+            key: tuple(fields.get(name) for name in field_names)
+            for key, _, is_group, fields in records if not is_group
+        }
+        self._empty = (None,) * len(field_names)
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._attributes)
+
+    def attributes(self, record_key) -> dict:
+        """Возвращает {колонка: значение} для записи (None для неизвестной записи)."""
+        values = self._attributes.get(str(record_key).strip()) if record_key else None
+        if values is None:
+            if record_key:
+                self.misses += 1
+            values = self._empty
+        return dict(zip(self.columns, values))
+
+    def version(self) -> str:
+        """Хеш атрибутов всех записей: меняется, когда нужно заново обогатить строки."""
+        payload = json.dumps(sorted(self._attributes.items()), ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_handbook(conn, handbook_id: int, columns: dict, run_id: str) -> HandbookLookup:
+    """
+    Скачивает справочник и обновляет его копию в HANDBOOK_TABLE; если скачать
+    не удалось, берет копию прошлого запуска. Возвращает HandbookLookup.
+    """
+    try:
+        records = fetch_handbook_records(handbook_id)
+    except (requests.exceptions.RequestException, ValueError, *planfix_xml.ParseError) as e:
+        logger.warning(f"Could not fetch handbook {handbook_id}, using the stored copy: {e}")
+        records = load_handbook_records(conn, handbook_id)
+    else:
+        stats = store_handbook_records(conn, handbook_id, records, run_id)
+        logger.info(
+            f"Handbook {handbook_id}: {stats['inserted']} new, {stats['updated']} changed, "
+            f"{stats['unchanged']} unchanged, {stats['deleted']} deleted records"
+        )
+    lookup = HandbookLookup(handbook_id, columns, records)
+    logger.info(f"Loaded {len(lookup)} records of handbook {handbook_id} for enrichment")
+    return lookup
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Локальное зеркало сущностей Planfix в SQLite (режим WAL).
+
+Экспорт Produkty больше всего запросов тратит на action.getList и action.get
+для каждого заказа. Если задан PLANFIX_MIRROR_PATH, экспорт читает списки
+действий и детали действий через зеркало и запрашивает у API только записи
+старше PLANFIX_MIRROR_TTL секунд. Заказы (parse_task_list), строки аналитики
+и статусы тоже сохраняются в зеркало, поэтому разовые проверки (то, что
+делают test_task_list.py и planfix_get_analytics_list.py) можно выполнять
+по локальным данным за миллисекунды:
+
+    python scripts/planfix_mirror.py orders --order-number 123/2025
+    python scripts/planfix_mirror.py actions --task 100000
+    python scripts/planfix_mirror.py analytics --task 100000
+    python scripts/planfix_mirror.py statuses --refresh
+    python scripts/planfix_mirror.py sql "SELECT count(*) FROM orders"
+
+Зеркало — только кеш: его можно удалить в любой момент, следующий запуск
+экспорта заполнит его заново.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    import scripts.planfix_utils as planfix_utils
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+
+logger = logging.getLogger(__name__)
+
+# Файл зеркала (пусто — зеркало выключено) и время жизни записей (с)
+PLANFIX_MIRROR_PATH = os.environ.get('PLANFIX_MIRROR_PATH')
+PLANFIX_MIRROR_TTL = int(os.environ.get('PLANFIX_MIRROR_TTL', '21600'))
+
+MIRROR_SCHEMA_SQL = '''
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    number TEXT,
+    order_number TEXT,
+    begin_datetime TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_order_number_idx ON orders (order_number);
+CREATE INDEX IF NOT EXISTS orders_fetched_at_idx ON orders (fetched_at);
+
+CREATE TABLE IF NOT EXISTS task_actions (
+    task_id INTEGER PRIMARY KEY,
+    actions TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_actions_fetched_at_idx ON task_actions (fetched_at);
+
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    task_id INTEGER,
+    date_time TEXT,
+    has_produkty INTEGER,
+    xml BLOB NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS actions_task_id_idx ON actions (task_id);
+CREATE INDEX IF NOT EXISTS actions_fetched_at_idx ON actions (fetched_at);
+
+CREATE TABLE IF NOT EXISTS analytics (
+    composite_key TEXT PRIMARY KEY,
+    analytic_key TEXT,
+    task_id INTEGER,
+    action_id INTEGER,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analytics_task_id_idx ON analytics (task_id);
+CREATE INDEX IF NOT EXISTS analytics_action_id_idx ON analytics (action_id);
+CREATE INDEX IF NOT EXISTS analytics_updated_at_idx ON analytics (updated_at);
+
+CREATE TABLE IF NOT EXISTS statuses (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS statuses_fetched_at_idx ON statuses (fetched_at);
+'''
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class PlanfixMirror:
+    """Зеркало сущностей Planfix в одном файле SQLite."""
+
+    def __init__(self, path: str, ttl: int = PLANFIX_MIRROR_TTL):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        # WAL: чтение из другого процесса (CLI) не блокирует запись экспорта
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(MIRROR_SCHEMA_SQL)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _fresh_after(self) -> float:
+        return time.time() - self.ttl
+
+    def _count(self, fresh: bool) -> None:
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    # Заказы
+    def put_orders(self, tasks) -> None:
+        """Сохраняет заказы в формате parse_task_list (словари TASK_ROW_FIELDS)."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO orders (id, name, number, order_number, begin_datetime, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    name = excluded.name, number = excluded.number, order_number = excluded.order_number,
+                    begin_datetime = COALESCE(excluded.begin_datetime, orders.begin_datetime),
+                    fetched_at = excluded.fetched_at
+            ''', [
+                (task['id'], task.get('name'), task.get('number'), task.get('order_number'), task.get('begin_datetime'), now)
+                for task in tasks
+            ])
+
+    def get_orders(self, order_number: str | None = None) -> list[dict]:
+        sql = 'SELECT id, name, number, order_number, begin_datetime FROM orders'
+        params = ()
+        if order_number is not None:
+            sql += ' WHERE order_number = ?'
+            params = (order_number,)
+        cursor = self.conn.execute(sql + ' ORDER BY id', params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def get_fresh_orders(self, task_ids) -> dict:
+        """Заказы моложе ttl из task_ids: {id: словарь заказа}."""
+        task_ids = list(task_ids)
+        orders = {}
+        # Ограничение SQLite на число параметров запроса
+        for start in range(0, len(task_ids), 500):
+            chunk = task_ids[start:start + 500]
+            cursor = self.conn.execute(
+                f'SELECT id, name, number, order_number, begin_datetime FROM orders '
+                f'WHERE fetched_at >= ? AND id IN ({", ".join("?" * len(chunk))})',
+                [self._fresh_after(), *chunk]
+            )
+            columns = [column[0] for column in cursor.description]
+            for row in cursor.fetchall():
+                orders[row[0]] = dict(zip(columns, row))
+        for task_id in task_ids:
+            self._count(task_id in orders)
+        return orders
+
+    # Действия
+    def get_task_actions(self, task_id: int) -> list[dict] | None:
+        """Список действий заказа (parse_task_actions), если он моложе ttl, иначе None."""
+        row = self.conn.execute(
+            'SELECT actions FROM task_actions WHERE task_id = ? AND fetched_at >= ?', (task_id, self._fresh_after())
+        ).fetchone()
+        self._count(row is not None)
+        return json.loads(row[0]) if row is not None else None
+
+    def put_task_actions(self, task_id: int, actions: list[dict]) -> None:
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO task_actions (task_id, actions, fetched_at) VALUES (?, ?, ?)
+                ON CONFLICT (task_id) DO UPDATE SET actions = excluded.actions, fetched_at = excluded.fetched_at
+            ''', (task_id, json.dumps(actions, ensure_ascii=False), time.time()))
+
+    def get_action_xml(self, action_id: int) -> bytes | None:
+        """Сырой ответ action.get для действия, если он моложе ttl, иначе None."""
+        row = self.conn.execute(
+            'SELECT xml FROM actions WHERE id = ? AND fetched_at >= ?', (action_id, self._fresh_after())
+        ).fetchone()
+        self._count(row is not None)
+        return row[0] if row is not None else None
+
+    def put_action(self, action_id: int, task_id: int | None, date_time: str | None, has_produkty: bool, xml: bytes) -> None:
+        with self.conn:
+            self.conn.execute('''
+                INSERT INTO actions (id, task_id, date_time, has_produkty, xml, fetched_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    task_id = COALESCE(excluded.task_id, actions.task_id), date_time = excluded.date_time,
+                    has_produkty = excluded.has_produkty, xml = excluded.xml, fetched_at = excluded.fetched_at
+            ''', (action_id, task_id, date_time, int(has_produkty), xml, time.time()))
+
+    def get_actions(self, task_id: int) -> list[dict]:
+        cursor = self.conn.execute(
+            'SELECT id, task_id, date_time, has_produkty, fetched_at FROM actions WHERE task_id = ? ORDER BY id', (task_id,)
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # Строки аналитики
+    def put_analytics(self, records, key_fn) -> None:
+        """Сохраняет записи аналитики; key_fn(record) возвращает составной ключ записи."""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO analytics (composite_key, analytic_key, task_id, action_id, data, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (composite_key) DO UPDATE SET
+                    analytic_key = excluded.analytic_key, task_id = excluded.task_id, action_id = excluded.action_id,
+                    data = excluded.data, updated_at = excluded.updated_at
+            ''', [
+                (
+                    key_fn(record), record.get('analytic_key'), record.get('task_id'), record.get('action_id'),
+                    json.dumps(record, ensure_ascii=False, default=_json_default), now
+                )
+                for record in records
+            ])
+
+    def get_analytics(self, task_id: int | None = None) -> list[dict]:
+        sql = 'SELECT data FROM analytics'
+        params = ()
+        if task_id is not None:
+            sql += ' WHERE task_id = ?'
+            params = (task_id,)
+        return [json.loads(row[0]) for row in self.conn.execute(sql + ' ORDER BY composite_key', params)]
+
+    # Статусы
+    def put_statuses(self, statuses: dict) -> None:
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO statuses (id, name, fetched_at) VALUES (?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET name = excluded.name, fetched_at = excluded.fetched_at
+            ''', [(str(status_id), name, now) for status_id, name in statuses.items() if name is not None])
+
+    def get_statuses(self) -> dict:
+        return dict(self.conn.execute('SELECT id, name FROM statuses ORDER BY id'))
+
+    def query(self, sql: str, params=()) -> tuple[list[str], list[tuple]]:
+        """Выполняет произвольный запрос к зеркалу, возвращает (колонки, строки)."""
+        cursor = self.conn.execute(sql, params)
+        columns = [column[0] for column in cursor.description] if cursor.description else []
+        return columns, cursor.fetchall()
+
+
+def open_mirror(path: str | None = None) -> PlanfixMirror | None:
+    """Открывает зеркало по пути path или PLANFIX_MIRROR_PATH; None, если зеркало выключено."""
+    path = path or PLANFIX_MIRROR_PATH
+    if not path:
+        return None
+    logger.info(f"Using the local Planfix mirror {path} (entries refreshed after {PLANFIX_MIRROR_TTL}s)")
+    return PlanfixMirror(path)
+
+
+def _print_rows(columns, rows) -> None:
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join('' if value is None else str(value) for value in row))
+    print(f"({len(rows)} rows)")
+
+
+def _print_dicts(items) -> None:
+    columns = list(items[0]) if items else []
+    _print_rows(columns, [tuple(item.get(column) for column in columns) for item in items])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the local SQLite mirror of Planfix entities")
+    parser.add_argument('--path', default=PLANFIX_MIRROR_PATH, help="Mirror file (default: $PLANFIX_MIRROR_PATH)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    orders_parser = commands.add_parser('orders', help="List mirrored orders")
+    orders_parser.add_argument('--order-number', help="Only the order with this number")
+    actions_parser = commands.add_parser('actions', help="List mirrored actions of an order")
+    actions_parser.add_argument('--task', type=int, required=True, help="Order (task) ID")
+    analytics_parser = commands.add_parser('analytics', help="List mirrored analytics rows")
+    analytics_parser.add_argument('--task', type=int, help="Only rows of this order (task) ID")
+    statuses_parser = commands.add_parser('statuses', help="List mirrored status names")
+    statuses_parser.add_argument('--refresh', action='store_true', help="Reload the statuses from the Planfix API first")
+    sql_parser = commands.add_parser('sql', help="Run an SQL query against the mirror")
+    sql_parser.add_argument('query', help="SQL query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if not args.path:
+        parser.error("No mirror file: pass --path or set PLANFIX_MIRROR_PATH")
+
+    mirror = PlanfixMirror(args.path)
+    try:
+        if args.command == 'orders':
+            _print_dicts(mirror.get_orders(args.order_number))
+        elif args.command == 'actions':
+            _print_dicts(mirror.get_actions(args.task))
+        elif args.command == 'analytics':
+            _print_dicts(mirror.get_analytics(args.task))
+        elif args.command == 'statuses':
+            if args.refresh:
+                mirror.put_statuses(planfix_utils.preload_planfix_statuses(force=True))
+            _print_rows(['id', 'name'], list(mirror.get_statuses().items()))
+        elif args.command == 'sql':
+            _print_rows(*mirror.query(args.query))
+    finally:
+        mirror.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Хеши страниц ответов Planfix между запусками.
+
+Большинство страниц task.getList и analitic.getDataByCondition не меняются
+между соседними запусками. Для каждой страницы хранится SHA-256 ее байтов
+и то, что из нее получилось (строки или ключи записей). Если хеш совпал,
+страница не разбирается и не загружается повторно — ее ключи просто
+переносятся в текущий запуск (для пометки удаленных записей).
+
+Состояние хранится в Supabase (таблица planfix_page_hashes), потому что
+раннеры GitHub Actions не сохраняют файлы между запусками. Новое состояние
+записывается только после успешной загрузки данных.
+"""
+
+import json
+import hashlib
+import logging
+import psycopg2
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+PAGE_HASH_TABLE = "planfix_page_hashes"
+
+PAGE_HASH_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{PAGE_HASH_TABLE}" (
+    "stream_key" TEXT NOT NULL,
+    "page" INTEGER NOT NULL,
+    "content_hash" TEXT NOT NULL,
+    "context_hash" TEXT,
+    "context_ids" JSONB,
+    "row_count" INTEGER NOT NULL,
+    "payload" JSONB,
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY ("stream_key", "page")
+);
+'''
+
+
+def content_hash(data: bytes) -> str:
+    """Returns the SHA-256 hex digest of a raw response page."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageHashStream:
+    """Состояние страниц одного постраничного запроса (например, task.getList)."""
+
+    def __init__(self, cache, stream_key, context_fn=None):
+        self.cache = cache
+        self.stream_key = stream_key
+        # context_fn(ids) -> str: хеш внешних данных, от которых зависят строки страницы
+        self.context_fn = context_fn
+        self.previous = {}
+        self.current = {}
+        # Страницы, сохраненное состояние которых нужно удалить (forget_pages_with)
+        self.forgotten = set()
+        self._hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, page: int, data: bytes) -> dict | None:
+        """
+        Hashes a fetched page and returns its previous-run entry when both the
+        content and its context are unchanged, otherwise None.
+        """
+        page_hash = content_hash(data)
+        self._hashes[page] = page_hash
+        entry = self.previous.get(page) if self.cache.enabled else None
+        if entry is not None and entry['content_hash'] == page_hash:
+            if self.context_fn is None or self.context_fn(entry['context_ids'] or []) == entry['context_hash']:
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    def carry(self, page: int, entry: dict) -> None:
+        """Keeps an unchanged page's previous entry for the next run."""
+        self.current[page] = entry
+
+    def remember(self, page: int, row_count: int, payload, context_ids=()) -> None:
+        """Stages the state of a page that was parsed in this run."""
+        context_ids = sorted(set(context_ids))
+        self.current[page] = {
+            'content_hash': self._hashes[page],
+            'context_hash': self.context_fn(context_ids) if self.context_fn else None,
+            'context_ids': context_ids,
+            'row_count': row_count,
+            'payload': payload,
+        }
+
+
+    def forget_pages_with(self, keys) -> int:
+        """
+        Drops this run's state of pages whose payload holds any of keys (for example,
+        rows that failed to load), so those pages are processed again next run.
+        Returns the number of dropped pages.
+        """
+        keys = set(keys)
+        pages = [
+            page for page, entry in self.current.items()
+            if any(key in keys for key in entry['payload'] or [])
+        ]
+        for page in pages:
+            del self.current[page]
+        self.forgotten.update(pages)
+        return len(pages)
+
+
+class PageHashCache:
+    """Хранилище хешей страниц в Supabase."""
+
+    def __init__(self, conn, enabled: bool = True):
+        self.conn = conn
+        self.enabled = enabled
+        self.streams = {}
+
+    def stream(self, stream_key: str, context_fn=None) -> PageHashStream:
+        """Returns the page state of one paged request, loading the previous run's hashes."""
+        stream = PageHashStream(self, stream_key, context_fn)
+        if self.enabled:
+            stream.previous = self._load(stream_key)
+            logger.info(f"Loaded {len(stream.previous)} page hashes for '{stream_key}'")
+        self.streams[stream_key] = stream
+        return stream
+
+    def discard(self, stream_key: str) -> None:
+        """Drops a stream from this run, leaving its stored hashes untouched."""
+        self.streams.pop(stream_key, None)
+
+    def _load(self, stream_key: str) -> dict:
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(PAGE_HASH_TABLE_SQL)
+                cur.execute(
+                    f'SELECT "page", "content_hash", "context_hash", "context_ids", "row_count", "payload" '
+                    f'FROM "{PAGE_HASH_TABLE}" WHERE "stream_key" = %s',
+                    (stream_key,)
+                )
+                rows = cur.fetchall()
+            self.conn.commit()
+        except psycopg2.Error as e:
+            logger.warning(f"Could not load page hashes for '{stream_key}', all pages will be processed: {e}")
+            self.conn.rollback()
+            return {}
+
+        return {
+            page: {
+                'content_hash': page_hash,
+                'context_hash': context_hash,
+                'context_ids': context_ids,
+                'row_count': row_count,
+                'payload': payload,
+            }
+            for page, page_hash, context_hash, context_ids, row_count, payload in rows
+        }
+
+    def save(self) -> None:
+        """
+        Stores this run's page hashes. Call only after the data of the run has been
+        loaded successfully, otherwise skipped pages would never be retried.
+        """
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(PAGE_HASH_TABLE_SQL)
+                for stream_key, stream in self.streams.items():
+                    # Страницы за последней текущей больше не существуют
+                    cur.execute(
+                        f'DELETE FROM "{PAGE_HASH_TABLE}" WHERE "stream_key" = %s AND "page" > %s',
+                        (stream_key, max(stream.current, default=0))
+                    )
+                    if stream.forgotten:
+                        cur.execute(
+                            f'DELETE FROM "{PAGE_HASH_TABLE}" WHERE "stream_key" = %s AND "page" = ANY(%s)',
+                            (stream_key, sorted(stream.forgotten))
+                        )
+                    psycopg2.extras.execute_batch(cur, f'''
+                        INSERT INTO "{PAGE_HASH_TABLE}"
+                            ("stream_key", "page", "content_hash", "context_hash", "context_ids", "row_count", "payload", "updated_at")
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                        ON CONFLICT ("stream_key", "page") DO UPDATE SET
+                            "content_hash" = EXCLUDED."content_hash",
+                            "context_hash" = EXCLUDED."context_hash",
+                            "context_ids" = EXCLUDED."context_ids",
+                            "row_count" = EXCLUDED."row_count",
+                            "payload" = EXCLUDED."payload",
+                            "updated_at" = NOW();
+                    ''', [
+                        (
+                            stream_key, page, entry['content_hash'], entry['context_hash'],
+                            psycopg2.extras.Json(entry['context_ids']), entry['row_count'],
+                            psycopg2.extras.Json(entry['payload'])
+                        )
+                        for page, entry in sorted(stream.current.items())
+                    ])
+                    logger.info(
+                        f"Saved {len(stream.current)} page hashes for '{stream_key}' "
+                        f"({stream.hits} unchanged, {stream.misses} processed)"
+                    )
+            self.conn.commit()
+        except psycopg2.Error as e:
+            # Потеря хешей означает только полную обработку страниц в следующий раз
+            logger.warning(f"Could not save page hashes: {e}")
+            self.conn.rollback()
+
+
+def table_has_live_rows(conn, table_name: str) -> bool:
+    """
+    Returns True when table_name has at least one row that is not soft-deleted.
+    Page hashes are only valid while the rows they stand for are still in the table.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'SELECT EXISTS (SELECT 1 FROM "{table_name}" WHERE "is_deleted" = FALSE)')
+            exists = cur.fetchone()[0]
+        conn.commit()
+        return exists
+    except psycopg2.Error as e:
+        logger.warning(f"Could not check rows of '{table_name}', all pages will be processed: {e}")
+        conn.rollback()
+        return False
+
+
+def tasks_context_fn(tasks_dict, extra=None):
+    """
+    Returns a context function hashing the order attributes that analytics rows
+    take from tasks_dict, so a page is reprocessed when a linked order changes.
+    extra — a version string of other data the rows depend on (e.g. a handbook):
+    when it changes, every page is reprocessed.
+    tasks_dict may be a planfix_task_resolver.TaskResolver: orders missing from
+    the order list are then resolved in one batch before hashing.
+    """
+    def context_hash(task_ids):
+        if hasattr(tasks_dict, 'resolve'):
+            tasks_dict.resolve(task_ids)
+        digest = hashlib.sha256()
+        if extra:
+            digest.update(extra.encode('utf-8'))
+        for task_id in task_ids:
+            task = tasks_dict.get(task_id)
+            attributes = [task_id, task.get('name'), task.get('order_number')] if task else [task_id]
+            if task and task.get('begin_datetime'):
+                # Дата заказа определяет секцию строки в секционированной таблице
+                attributes.append(task['begin_datetime'])
+            digest.update(json.dumps(attributes, ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+    return context_hash
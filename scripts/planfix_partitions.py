@@ -0,0 +1,187 @@
+"""
+Помесячное секционирование таблиц аналитики по дате заказа.
+
+Секционированная таблица (PARTITION BY RANGE) делится по колонке order_date —
+дате начала заказа (beginDateTime). На каждый месяц создается отдельная
+секция {таблица}_pYYYY_MM, строки без даты попадают в секцию {таблица}_default.
+Запросы за период читают только свои секции, а закрытые месяцы больше не
+меняются, и их не нужно повторно очищать VACUUM.
+
+Уникальный ключ секционированной таблицы обязан содержать колонку секционирования,
+поэтому upsert идет по (composite_key, order_date), а ограничение объявлено как
+UNIQUE NULLS NOT DISTINCT (Postgres 15+), чтобы строки без даты тоже сливались.
+Если дата заказа изменилась, строка вставляется в новую секцию, а старая копия
+удаляется через remove_moved_rows.
+"""
+
+import logging
+from datetime import date, datetime
+
+import psycopg2
+
+try:
+    import scripts.planfix_utils as planfix_utils
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+
+logger = logging.getLogger(__name__)
+
+PARTITION_COLUMN = "order_date"
+
+
+def month_start(value: date) -> date:
+    """Returns the first day of the month of a date or datetime."""
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.replace(day=1)
+
+
+def next_month(value: date) -> date:
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(table_name: str, month: date | None) -> str:
+    """Returns the partition of a month (None — the default partition for rows without a date)."""
+    suffix = 'default' if month is None else f'p{month:%Y_%m}'
+    return f"{table_name}_{suffix}"[:63]
+
+
+def unique_constraint_sql(table_name: str, key_column: str) -> str:
+    return (
+        f'CONSTRAINT "{table_name}_{key_column}_{PARTITION_COLUMN}_key"'
+        f' UNIQUE NULLS NOT DISTINCT ("{key_column}", "{PARTITION_COLUMN}")'
+    )
+
+
+def is_partitioned(conn, table_name: str) -> bool:
+    """Returns True when table_name exists and is a partitioned table."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (f'public."{table_name}"',))
+        row = cur.fetchone()
+    conn.commit()
+    return row is not None and row[0] == 'p'
+
+
+def get_partitions(conn, table_name: str) -> set[str]:
+    """Returns the names of the partitions of a partitioned table."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s);
+        """, (f'public."{table_name}"',))
+        partitions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return partitions
+
+
+def ensure_month_partitions(conn, table_name: str, dates) -> list[str]:
+    """
+    Creates the default partition and the monthly partitions covering the given
+    dates (None values are ignored). Partitions must exist before rows of their
+    month are loaded: a month partition cannot be created while the default
+    partition holds rows of that month. Returns the names of created partitions.
+    """
+    months = sorted({month_start(value) for value in dates if value is not None})
+    existing = get_partitions(conn, table_name)
+    created = []
+    try:
+        with conn.cursor() as cur:
+            default_name = partition_name(table_name, None)
+            if default_name not in existing:
+                cur.execute(f'CREATE TABLE IF NOT EXISTS "{default_name}" PARTITION OF "{table_name}" DEFAULT')
+                created.append(default_name)
+            for month in months:
+                name = partition_name(table_name, month)
+                if name in existing:
+                    continue
+                cur.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{table_name}" '
+                    f'FOR VALUES FROM (%s) TO (%s)',
+                    (month, next_month(month))
+                )
+                created.append(name)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error creating partitions of '{table_name}': {e}")
+        conn.rollback()
+        raise
+
+    if created:
+        logger.info(f"Created {len(created)} partitions of '{table_name}': {created}")
+    return created
+
+
+def remove_moved_rows(conn, table_name: str, key_column: str, run_id: str) -> int:
+    """
+    Deletes rows that were written again in this run (stamped with run_id) under a
+    different order_date, i.e. into another partition: the old copy is no longer valid.
+    Returns the number of deleted rows.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'''
+                DELETE FROM "{table_name}" AS old
+                USING "{table_name}" AS new
+                WHERE new."{planfix_utils.RUN_ID_COLUMN}" = %s
+                  AND old."{key_column}" = new."{key_column}"
+                  AND old."{PARTITION_COLUMN}" IS DISTINCT FROM new."{PARTITION_COLUMN}"
+                  AND old."{planfix_utils.RUN_ID_COLUMN}" IS DISTINCT FROM %s
+            ''', (run_id, run_id))
+            deleted = cur.rowcount
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error removing moved rows from '{table_name}': {e}")
+        conn.rollback()
+        raise
+
+    if deleted:
+        logger.info(f"Removed {deleted} rows of '{table_name}' that moved to another {PARTITION_COLUMN} partition")
+    return deleted
+
+
+def convert_to_partitioned(conn, table_name: str, key_column: str = 'composite_key', index_sql=()) -> str:
+    """
+    Replaces a regular table with a partitioned one with the same columns and data.
+    The old table is kept as {table}_unpartitioned until it is dropped manually.
+    Existing rows get no order_date (it is not stored yet) and land in the default
+    partition; the next full export moves them to their month partitions.
+    index_sql — CREATE INDEX statements to run on the new table (propagated to partitions).
+    Returns the name of the old table.
+    """
+    old_name = f"{table_name}_unpartitioned"[:63]
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'ALTER TABLE "{table_name}" ADD COLUMN IF NOT EXISTS "{PARTITION_COLUMN}" DATE')
+            cur.execute(f'ALTER TABLE "{table_name}" RENAME TO "{old_name}"')
+            # Имена индексов старой таблицы освобождаются для индексов новой
+            cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass", (f'"{old_name}"',))
+            for (index,) in cur.fetchall():
+                cur.execute(f'ALTER INDEX {index} RENAME TO "{(index.strip(chr(34)) + "_unpartitioned")[:63]}"')
+            # Индексы и ограничения старой таблицы не переносятся:
+            # уникальные ключи должны включать колонку секционирования
+            cur.execute(f'''
+                CREATE TABLE "{table_name}" (
+                    LIKE "{old_name}" INCLUDING DEFAULTS INCLUDING IDENTITY,
+                    {unique_constraint_sql(table_name, key_column)}
+                ) PARTITION BY RANGE ("{PARTITION_COLUMN}")
+            ''')
+            # Последовательности SERIAL-колонок переходят к новой таблице, иначе их удалит DROP старой
+            cur.execute("""
+                SELECT attname, pg_get_serial_sequence(%s, attname) FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            """, (f'"{old_name}"', f'"{old_name}"'))
+            for column, sequence in cur.fetchall():
+                if sequence:
+                    cur.execute(f'ALTER SEQUENCE {sequence} OWNED BY "{table_name}"."{column}"')
+            cur.execute(f'CREATE TABLE "{partition_name(table_name, None)}" PARTITION OF "{table_name}" DEFAULT')
+            for statement in index_sql:
+                cur.execute(statement)
+            cur.execute(f'INSERT INTO "{table_name}" SELECT * FROM "{old_name}"')
+            logger.info(f"Copied {cur.rowcount} rows from '{old_name}' into partitioned '{table_name}'")
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error converting '{table_name}' to a partitioned table: {e}")
+        conn.rollback()
+        raise
+    return old_name
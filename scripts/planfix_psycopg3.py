@@ -0,0 +1,278 @@
+"""
+Альтернативный бэкенд загрузки в Supabase на psycopg 3 (необязательная зависимость).
+
+Supabase находится далеко от раннеров, и основное время загрузки — ожидание
+ответа на каждый запрос. Здесь запросы отправляются в pipeline mode: пачка
+независимых запросов уходит на сервер сразу, а результаты читаются после
+одной синхронизации. Строки передаются бинарным COPY (без разбора текста на
+сервере) во временную таблицу и сливаются одним INSERT ... ON CONFLICT, как
+в загрузчике copy из planfix_utils.
+
+  upsert_data_to_supabase    — 3 обмена с сервером на пачку: DDL, COPY, слияние + COMMIT;
+  mark_items_as_deleted      — 3 обмена: DDL, COPY ключей, ANALYZE + UPDATE + COMMIT;
+  refresh_rollups            — 2 обмена вместо ~10 (planfix_rollups.rollup_statements).
+
+Включается SUPABASE_DB_BACKEND=psycopg3 (pip install "psycopg[binary]").
+По умолчанию используется psycopg2 (planfix_utils) — пока этот бэкенд не
+подтвердит выигрыш в scripts/benchmark_loaders.py (--loaders ...,psycopg3).
+Карантин плохих строк и параллельная загрузка есть только в psycopg2.
+"""
+
+import time
+import itertools
+import logging
+from decimal import Decimal
+
+try:
+    import psycopg
+except ImportError:  # psycopg 3 — необязательная зависимость
+    psycopg = None
+
+try:
+    import scripts.planfix_utils as planfix_utils
+    import scripts.planfix_rollups as planfix_rollups
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+    import planfix_rollups
+
+logger = logging.getLogger(__name__)
+
+# Бинарный COPY не приводит типы: строки из ответов Planfix (числа приходят
+# строками) преобразуются в тип колонки заранее. OID типов Postgres -> конструктор.
+_BINARY_COERCIONS = {
+    20: int, 21: int, 23: int,  # bigint, smallint, integer
+    700: float, 701: float,  # real, double precision
+    1700: Decimal,  # numeric
+}
+
+
+def is_available() -> bool:
+    return psycopg is not None
+
+
+def get_connection(dsn: str | None = None):
+    """Opens a psycopg 3 connection to dsn, or with the Supabase settings of planfix_utils."""
+    if psycopg is None:
+        raise ImportError("psycopg 3 is not installed (pip install \"psycopg[binary]\")")
+    if dsn:
+        conn = psycopg.connect(dsn)
+    else:
+        kwargs = planfix_utils._supabase_connect_kwargs()
+        conninfo = kwargs.pop('dsn', '')
+        logger.info("Attempting to connect to Supabase (psycopg 3)...")
+        conn = psycopg.connect(conninfo, **kwargs)
+    if not planfix_utils.prepared_statements_enabled(conn):
+        # psycopg 3 сам готовит часто выполняемые запросы — через пулер transaction нельзя
+        conn.prepare_threshold = None
+    return conn
+
+
+def get_column_type_oids(conn, table_name: str, column_names: list[str]) -> list[int]:
+    """Returns the type OIDs of the given columns of a table, in order."""
+    rows = conn.execute("""
+        SELECT attname, atttypid FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    """, (f'"{table_name}"',)).fetchall()
+    types = dict(rows)
+    missing = [col for col in column_names if col not in types]
+    if missing:
+        raise ValueError(f"Columns not found in table '{table_name}': {', '.join(missing)}")
+    return [types[col] for col in column_names]
+
+
+def _binary_rows(rows, type_oids: list[int]):
+    """Converts values of numeric columns to the column type for binary COPY ('' becomes NULL)."""
+    coercions = [(i, _BINARY_COERCIONS[oid]) for i, oid in enumerate(type_oids) if oid in _BINARY_COERCIONS]
+    for row in rows:
+        if coercions:
+            row = list(row)
+            for i, coerce in coercions:
+                value = row[i]
+                if value is None or type(value) is coerce:
+                    continue
+                if isinstance(value, str):
+                    row[i] = coerce(value) if value.strip() else None
+                else:
+                    # float -> Decimal через str, чтобы не тянуть двоичную погрешность
+                    row[i] = coerce(str(value)) if coerce is Decimal else coerce(value)
+        yield row
+
+
+def upsert_data_to_supabase(conn, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], data_list, run_id: str | None = None, detect_changes: bool = False) -> dict:
+    """
+    psycopg 3 counterpart of planfix_utils.upsert_data_to_supabase with the copy loader:
+    binary COPY into a temporary table and one INSERT ... SELECT ... ON CONFLICT,
+    with the DDL and the merge + COMMIT each sent as one pipeline.
+    Returns {'rows', 'inserted', 'updated', 'unchanged', 'collapsed'}.
+    """
+    column_names, rows = planfix_utils._upsert_rows(data_list, column_names, run_id, detect_changes)
+    key_positions = [column_names.index(col) for col in planfix_utils._key_columns(primary_key_column)]
+    rows, collapsed = planfix_utils.collapse_duplicate_keys(rows, key_positions)
+    if collapsed:
+        logger.warning(f"Collapsed {collapsed} rows repeating a key of '{table_name}' (the last occurrence is kept).")
+    if not rows:
+        return {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'collapsed': collapsed}
+
+    stage_table = f"_stage_{table_name}"
+    key_sql = planfix_utils._key_sql(primary_key_column)
+    cols_sql, conflict_sql = planfix_utils._upsert_sql_parts(table_name, primary_key_column, column_names)
+    try:
+        type_oids = get_column_type_oids(conn, table_name, column_names)
+        with conn.cursor() as cur:
+            with conn.pipeline():
+                cur.execute(f'DROP TABLE IF EXISTS "{stage_table}"')
+                cur.execute(f'CREATE TEMP TABLE "{stage_table}" ON COMMIT DROP AS SELECT {cols_sql} FROM "{table_name}" WITH NO DATA')
+                cur.execute(f'ALTER TABLE "{stage_table}" ADD COLUMN "_copy_row_no" BIGSERIAL')
+
+            with cur.copy(f'COPY "{stage_table}" ({cols_sql}) FROM STDIN (FORMAT BINARY)') as copy:
+                copy.set_types(type_oids)
+                for row in _binary_rows(rows, type_oids):
+                    copy.write_row(row)
+
+            with conn.pipeline():
+                cur.execute(planfix_utils._counted_merge_sql(table_name, primary_key_column, cols_sql, f"""
+                    SELECT DISTINCT ON ({key_sql}) {cols_sql}
+                    FROM "{stage_table}"
+                    ORDER BY {key_sql}, "_copy_row_no" DESC
+                """, conflict_sql))
+                conn.commit()
+            inserted, updated = cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error during psycopg 3 upsert to table '{table_name}': {e}")
+        conn.rollback()
+        raise
+
+    stats = {
+        'rows': len(rows), 'inserted': inserted, 'updated': updated,
+        'unchanged': len(rows) - inserted - updated, 'collapsed': collapsed,
+    }
+    logger.info(
+        f"Successfully upserted {len(rows)} records to table '{table_name}' (psycopg 3): "
+        f"{inserted} inserted, {updated} updated, {stats['unchanged']} unchanged."
+    )
+    return stats
+
+
+def upsert_stream_to_supabase(conn, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], records, chunk_size: int | None = None, run_id: str | None = None, detect_changes: bool = False) -> dict:
+    """
+    Upserts an iterator of record dicts in chunks of chunk_size (default from
+    SUPABASE_CHUNK_SIZE), one transaction per chunk, like
+    planfix_utils.upsert_stream_to_supabase.
+    """
+    chunk_size = chunk_size or planfix_utils.SUPABASE_CHUNK_SIZE
+    totals = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'collapsed': 0, 'quarantined': 0, 'chunks': 0}
+    records = iter(records)
+    started = time.perf_counter()
+
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        chunk_started = time.perf_counter()
+        stats = upsert_data_to_supabase(
+            conn, table_name, primary_key_column, column_names, chunk,
+            run_id=run_id, detect_changes=detect_changes
+        )
+        elapsed = time.perf_counter() - chunk_started
+        totals['chunks'] += 1
+        for key in ('rows', 'inserted', 'updated', 'unchanged', 'collapsed'):
+            totals[key] += stats[key]
+        logger.info(
+            f"Chunk {totals['chunks']} of '{table_name}': {stats['rows']} rows in {elapsed:.2f}s "
+            f"({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s), {totals['rows']} rows committed so far."
+        )
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Streamed {totals['rows']} rows into '{table_name}' in {totals['chunks']} chunks (psycopg 3), "
+        f"{elapsed:.2f}s ({totals['rows'] / elapsed if elapsed else 0:.0f} rows/s)."
+    )
+    return totals
+
+
+def mark_items_as_deleted_in_supabase(conn, table_name: str, id_column_name: str, actual_ids: list[int | str], scope: dict | None = None, reset_row_hash: bool = False) -> int:
+    """
+    psycopg 3 counterpart of planfix_utils.mark_items_as_deleted_in_supabase:
+    the live keys are sent with binary COPY, ANALYZE, UPDATE and COMMIT go in one pipeline.
+    Returns the number of rows marked as deleted.
+    """
+    logger.info(f"Marking items as deleted in table '{table_name}' ({len(actual_ids)} actual IDs, psycopg 3).")
+    conditions = ['t."is_deleted" = FALSE']
+    params = []
+    for column, value in (scope or {}).items():
+        conditions.append(f't."{column}" = %s')
+        params.append(value)
+    reset_sql = f', "{planfix_utils.ROW_HASH_COLUMN}" = NULL' if reset_row_hash else ''
+
+    keys_table = f"_live_keys_{table_name}"
+    try:
+        with conn.cursor() as cur:
+            if actual_ids:
+                type_oids = get_column_type_oids(conn, table_name, [id_column_name])
+                with conn.pipeline():
+                    cur.execute(f'DROP TABLE IF EXISTS "{keys_table}"')
+                    cur.execute(f'CREATE TEMP TABLE "{keys_table}" ON COMMIT DROP AS SELECT "{id_column_name}" FROM "{table_name}" WITH NO DATA')
+                with cur.copy(f'COPY "{keys_table}" ("{id_column_name}") FROM STDIN (FORMAT BINARY)') as copy:
+                    copy.set_types(type_oids)
+                    for row in _binary_rows(((key,) for key in actual_ids), type_oids):
+                        copy.write_row(row)
+                conditions.append(f'NOT EXISTS (SELECT 1 FROM "{keys_table}" k WHERE k."{id_column_name}" = t."{id_column_name}")')
+            else:
+                logger.info(f"actual_ids list is empty. Marking all non-deleted items in '{table_name}' as deleted.")
+
+            with conn.pipeline():
+                if actual_ids:
+                    # Статистика временной таблицы нужна планировщику для hash anti join
+                    cur.execute(f'ANALYZE "{keys_table}"')
+                cur.execute(f"""
+                    UPDATE "{table_name}" t
+                    SET is_deleted = TRUE, updated_at = NOW(){reset_sql}
+                    WHERE {' AND '.join(conditions)}
+                """, params)
+                conn.commit()
+            deleted_count = cur.rowcount
+    except Exception as e:
+        logger.error(f"Error marking items as deleted in Supabase table '{table_name}': {e}")
+        conn.rollback()
+        raise
+
+    logger.info(f"Successfully marked {deleted_count} items as deleted in '{table_name}'.")
+    return deleted_count
+
+
+def refresh_rollups(conn, table_name: str, task_ids=None) -> dict:
+    """
+    psycopg 3 counterpart of planfix_rollups.refresh_rollups: all refresh
+    statements and the COMMIT are sent in one pipeline.
+    """
+    stats = {'orders': 0, 'products': 0, 'currencies': 0}
+    try:
+        with conn.cursor() as cur:
+            # Несколько команд в одном запросе — только вне pipeline (простой протокол)
+            cur.execute(planfix_rollups.ROLLUP_TABLES_SQL)
+            task_ids = planfix_rollups.resolve_task_ids(cur, task_ids)
+            if task_ids == []:
+                logger.info("No orders changed in this run, rollups are up to date")
+                conn.commit()
+                return stats
+
+            counted = []
+            with conn.pipeline():
+                for stats_key, statement, params in planfix_rollups.rollup_statements(table_name, task_ids):
+                    # Для каждого запроса свой курсор: rowcount читается после синхронизации
+                    statement_cur = conn.cursor()
+                    statement_cur.execute(statement, params)
+                    if stats_key:
+                        counted.append((stats_key, statement_cur))
+                conn.commit()
+            for stats_key, statement_cur in counted:
+                stats[stats_key] = statement_cur.rowcount
+            if task_ids is not None:
+                stats['orders'] = len(task_ids)
+    except Exception as e:
+        logger.error(f"Error refreshing rollup tables: {e}")
+        conn.rollback()
+        raise
+
+    planfix_rollups.log_refresh_stats(stats)
+    return stats
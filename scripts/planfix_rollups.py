@@ -0,0 +1,262 @@
+"""
+Агрегаты по заказам, продуктам и валютам для дашбордов.
+
+Дашборды суммируют wartosc_netto, ilosc, prowizja_pln и laczna_masa_kg
+по заказу, продукту (nazwa_handbook_id) и валюте (waluta). Чтобы не
+сканировать каждый раз всю planfix_analytics_produkty, синхронизация ведет
+маленькие таблицы с готовыми суммами и после загрузки пересчитывает только
+заказы, строки которых изменились в этом запуске:
+
+  planfix_rollup_order_products — заказ × продукт × валюта (основа остальных);
+  planfix_rollup_orders         — заказ × валюта;
+  planfix_rollup_products       — продукт × валюта;
+  planfix_rollup_currencies     — валюта.
+
+Суммы по продуктам и валютам пересчитываются из order_products только для
+продуктов и валют затронутых заказов (до и после изменения), поэтому
+переход строки на другой продукт тоже учитывается. Учитываются только
+неудаленные строки. Строки без продукта или валюты попадают в группы
+с пустым nazwa_handbook_id или waluta ('').
+"""
+
+import logging
+import psycopg2
+
+try:
+    import scripts.planfix_utils as planfix_utils
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+
+logger = logging.getLogger(__name__)
+
+ORDER_PRODUCTS_TABLE = "planfix_rollup_order_products"
+ORDERS_TABLE = "planfix_rollup_orders"
+PRODUCTS_TABLE = "planfix_rollup_products"
+CURRENCIES_TABLE = "planfix_rollup_currencies"
+
+# Суммируемые колонки строк продуктов. Это колонки, закрепленные за полями Produkty
+# в реестре аналитик (planfix_analytic_registry.KNOWN_FIELD_COLUMNS): переименование
+# поля в Planfix их не меняет
+SUM_COLUMNS = ['ilosc', 'wartosc_netto', 'prowizja_pln', 'laczna_masa_kg']
+
+_SUMS_DDL = ",\n    ".join(f'"{col}" NUMERIC NOT NULL DEFAULT 0' for col in SUM_COLUMNS)
+
+ROLLUP_TABLES_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{ORDER_PRODUCTS_TABLE}" (
+    "task_id" INTEGER NOT NULL,
+    "nazwa_handbook_id" TEXT NOT NULL,
+    "waluta" TEXT NOT NULL,
+    "order_number" TEXT,
+    "task_name" TEXT,
+    "nazwa" TEXT,
+    "line_count" INTEGER NOT NULL,
+    {_SUMS_DDL},
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY ("task_id", "nazwa_handbook_id", "waluta")
+);
+CREATE INDEX IF NOT EXISTS "idx_{ORDER_PRODUCTS_TABLE}_product" ON "{ORDER_PRODUCTS_TABLE}" ("nazwa_handbook_id", "waluta");
+
+CREATE TABLE IF NOT EXISTS "{ORDERS_TABLE}" (
+    "task_id" INTEGER NOT NULL,
+    "waluta" TEXT NOT NULL,
+    "order_number" TEXT,
+    "task_name" TEXT,
+    "product_count" INTEGER NOT NULL,
+    "line_count" INTEGER NOT NULL,
+    {_SUMS_DDL},
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY ("task_id", "waluta")
+);
+
+CREATE TABLE IF NOT EXISTS "{PRODUCTS_TABLE}" (
+    "nazwa_handbook_id" TEXT NOT NULL,
+    "waluta" TEXT NOT NULL,
+    "nazwa" TEXT,
+    "order_count" INTEGER NOT NULL,
+    "line_count" INTEGER NOT NULL,
+    {_SUMS_DDL},
+    "updated_at" TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY ("nazwa_handbook_id", "waluta")
+);
+
+CREATE TABLE IF NOT EXISTS "{CURRENCIES_TABLE}" (
+    "waluta" TEXT PRIMARY KEY,
+    "order_count" INTEGER NOT NULL,
+    "line_count" INTEGER NOT NULL,
+    {_SUMS_DDL},
+    "updated_at" TIMESTAMP DEFAULT NOW()
+);
+'''
+
+
+def _sum_sql(source_alias: str = '') -> str:
+    prefix = f'{source_alias}.' if source_alias else ''
+    return ", ".join(f'COALESCE(SUM({prefix}"{col}"), 0)' for col in SUM_COLUMNS)
+
+
+_SUM_COLUMNS_SQL = ", ".join(f'"{col}"' for col in SUM_COLUMNS)
+
+
+def database_now(conn):
+    """Returns the database clock; rows soft-deleted after it belong to the current run."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT NOW()")
+        return cur.fetchone()[0]
+
+
+def touched_task_ids(conn, table_name: str, run_id: str, run_started_at) -> list[int]:
+    """
+    Returns the orders whose product rows were written in this run (stamped with
+    run_id) or soft-deleted in it (updated_at at or after run_started_at).
+    """
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT DISTINCT "task_id" FROM "{table_name}"
+            WHERE "task_id" IS NOT NULL
+              AND ("{planfix_utils.RUN_ID_COLUMN}" = %s OR ("is_deleted" AND "updated_at" >= %s))
+        ''', (run_id, run_started_at))
+        task_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return task_ids
+
+
+def resolve_task_ids(cur, task_ids):
+    """
+    Returns the orders to refresh: task_ids as a sorted list, or None (full rebuild)
+    when task_ids is None or the rollup tables are still empty.
+    """
+    if task_ids is None:
+        return None
+    cur.execute(f'SELECT EXISTS (SELECT 1 FROM "{ORDER_PRODUCTS_TABLE}")')
+    if not cur.fetchone()[0]:
+        logger.info("Rollup tables are empty, rebuilding them from scratch")
+        return None
+    return sorted(set(task_ids))
+
+
+def rollup_statements(table_name: str, task_ids) -> list[tuple]:
+    """
+    Returns the statements refreshing the rollups for task_ids (None — all orders)
+    as (stats key or None, SQL, parameters). They do not depend on each other's
+    results, so they can be sent in one batch (see planfix_psycopg3).
+    """
+    statements = []
+    if task_ids is None:
+        for rollup_table in (ORDER_PRODUCTS_TABLE, ORDERS_TABLE, PRODUCTS_TABLE, CURRENCIES_TABLE):
+            statements.append((None, f'TRUNCATE "{rollup_table}"', []))
+        task_filter, op_task_filter, params = '', '', []
+    else:
+        task_filter = 'AND "task_id" = ANY(%s)'
+        op_task_filter = 'AND op."task_id" = ANY(%s)'
+        params = [list(task_ids)]
+
+    # 1. Заказ × продукт × валюта: старые группы затронутых заказов удаляются,
+    #    их продукты и валюты запоминаются для шага 3
+    statements.append((None, f'''
+        CREATE TEMP TABLE "_rollup_affected" ON COMMIT DROP AS
+        SELECT "nazwa_handbook_id", "waluta" FROM "{ORDER_PRODUCTS_TABLE}" WHERE FALSE
+    ''', []))
+    if task_ids is not None:
+        statements.append((None, f'''
+            WITH removed AS (
+                DELETE FROM "{ORDER_PRODUCTS_TABLE}" WHERE TRUE {task_filter}
+                RETURNING "nazwa_handbook_id", "waluta"
+            )
+            INSERT INTO "_rollup_affected" SELECT DISTINCT "nazwa_handbook_id", "waluta" FROM removed
+        ''', params))
+        statements.append((None, f'DELETE FROM "{ORDERS_TABLE}" WHERE TRUE {task_filter}', params))
+
+    statements.append((None, f'''
+        WITH added AS (
+            INSERT INTO "{ORDER_PRODUCTS_TABLE}"
+                ("task_id", "nazwa_handbook_id", "waluta", "order_number", "task_name", "nazwa",
+                 "line_count", {_SUM_COLUMNS_SQL}, "updated_at")
+            SELECT "task_id", COALESCE("nazwa_handbook_id"::text, ''), COALESCE("waluta", ''),
+                   MAX("order_number"), MAX("task_name"), MAX("nazwa"), COUNT(*), {_sum_sql()}, NOW()
+            FROM "{table_name}"
+            WHERE NOT "is_deleted" AND "task_id" IS NOT NULL {task_filter}
+            GROUP BY "task_id", COALESCE("nazwa_handbook_id"::text, ''), COALESCE("waluta", '')
+            RETURNING "nazwa_handbook_id", "waluta"
+        )
+        INSERT INTO "_rollup_affected" SELECT DISTINCT "nazwa_handbook_id", "waluta" FROM added
+    ''', params))
+
+    # 2. Заказ × валюта — из order_products затронутых заказов
+    statements.append(('orders', f'''
+        INSERT INTO "{ORDERS_TABLE}"
+            ("task_id", "waluta", "order_number", "task_name", "product_count", "line_count", {_SUM_COLUMNS_SQL}, "updated_at")
+        SELECT op."task_id", op."waluta", MAX(op."order_number"), MAX(op."task_name"),
+               COUNT(*), SUM(op."line_count"), {_sum_sql('op')}, NOW()
+        FROM "{ORDER_PRODUCTS_TABLE}" op
+        WHERE TRUE {op_task_filter}
+        GROUP BY op."task_id", op."waluta"
+    ''', params))
+
+    # 3. Продукт × валюта — только для продуктов затронутых заказов
+    statements.append((None, f'''
+        DELETE FROM "{PRODUCTS_TABLE}" t
+        USING (SELECT DISTINCT "nazwa_handbook_id", "waluta" FROM "_rollup_affected") a
+        WHERE t."nazwa_handbook_id" = a."nazwa_handbook_id" AND t."waluta" = a."waluta"
+    ''', []))
+    statements.append(('products', f'''
+        INSERT INTO "{PRODUCTS_TABLE}"
+            ("nazwa_handbook_id", "waluta", "nazwa", "order_count", "line_count", {_SUM_COLUMNS_SQL}, "updated_at")
+        SELECT op."nazwa_handbook_id", op."waluta", MAX(op."nazwa"), COUNT(DISTINCT op."task_id"),
+               SUM(op."line_count"), {_sum_sql('op')}, NOW()
+        FROM "{ORDER_PRODUCTS_TABLE}" op
+        JOIN (SELECT DISTINCT "nazwa_handbook_id", "waluta" FROM "_rollup_affected") a
+          ON a."nazwa_handbook_id" = op."nazwa_handbook_id" AND a."waluta" = op."waluta"
+        GROUP BY op."nazwa_handbook_id", op."waluta"
+    ''', []))
+
+    # 4. Валюта — валют немного, пересчитываем затронутые из заказов
+    statements.append((None, f'''
+        DELETE FROM "{CURRENCIES_TABLE}" WHERE "waluta" IN (SELECT "waluta" FROM "_rollup_affected")
+    ''', []))
+    statements.append(('currencies', f'''
+        INSERT INTO "{CURRENCIES_TABLE}" ("waluta", "order_count", "line_count", {_SUM_COLUMNS_SQL}, "updated_at")
+        SELECT o."waluta", COUNT(*), SUM(o."line_count"), {_sum_sql('o')}, NOW()
+        FROM "{ORDERS_TABLE}" o
+        WHERE o."waluta" IN (SELECT "waluta" FROM "_rollup_affected")
+        GROUP BY o."waluta"
+    ''', []))
+    return statements
+
+
+def log_refresh_stats(stats: dict) -> None:
+    logger.info(
+        f"Rollups refreshed: {stats['orders']} orders, {stats['products']} products, "
+        f"{stats['currencies']} currencies"
+    )
+
+
+def refresh_rollups(conn, table_name: str, task_ids=None) -> dict:
+    """
+    Recomputes the rollup tables for the given orders in one transaction.
+    task_ids=None rebuilds everything (also done automatically when the rollups are empty).
+    Returns the number of refreshed orders, products and currencies.
+    """
+    stats = {'orders': 0, 'products': 0, 'currencies': 0}
+    try:
+        with conn.cursor() as cur:
+            cur.execute(ROLLUP_TABLES_SQL)
+            task_ids = resolve_task_ids(cur, task_ids)
+            if task_ids == []:
+                logger.info("No orders changed in this run, rollups are up to date")
+                conn.commit()
+                return stats
+
+            for stats_key, statement, params in rollup_statements(table_name, task_ids):
+                cur.execute(statement, params)
+                if stats_key:
+                    stats[stats_key] = cur.rowcount
+            if task_ids is not None:
+                stats['orders'] = len(task_ids)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error refreshing rollup tables: {e}")
+        conn.rollback()
+        raise
+
+    log_refresh_stats(stats)
+    return stats
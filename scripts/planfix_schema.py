@@ -0,0 +1,156 @@
+"""
+Реестр схем таблиц, которыми управляют скрипты экспорта.
+
+Раньше каждый запуск выполнял CREATE TABLE IF NOT EXISTS, add_missing_columns
+(запрос к information_schema) и SELECT * ... LIMIT 0, чтобы узнать колонки.
+Теперь для каждой таблицы в служебной таблице planfix_schema_registry
+хранится отпечаток ожидаемой схемы (SQL создания и карта колонок) и список
+колонок таблицы вместе с ее OID. Если отпечаток не изменился и таблица
+та же (не удалена и не пересоздана), DDL и интроспекция не выполняются —
+колонки берутся из реестра одним запросом.
+
+Если таблицу изменили вручную (например, удалили колонку), сбросьте запись
+через invalidate_table_schema.
+"""
+
+import json
+import hashlib
+import logging
+import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+
+try:
+    import scripts.planfix_utils as planfix_utils
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_REGISTRY_TABLE = "planfix_schema_registry"
+
+SCHEMA_REGISTRY_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{SCHEMA_REGISTRY_TABLE}" (
+    "table_name" TEXT PRIMARY KEY,
+    "fingerprint" TEXT NOT NULL,
+    "columns" JSONB NOT NULL,
+    "table_oid" BIGINT,
+    "updated_at" TIMESTAMP DEFAULT NOW()
+);
+'''
+
+
+def schema_fingerprint(columns_map: dict, create_sql: str | None = None) -> str:
+    """Returns a hash of the expected schema of a table."""
+    payload = json.dumps({'columns': columns_map, 'create_sql': create_sql}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def fetch_table_columns(conn, table_name: str) -> list[str]:
+    """Returns the columns of a table in their physical order (from information_schema)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name
+            FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = %s
+            ORDER BY ordinal_position;
+        """, (table_name,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def _load_entry(conn, table_name: str):
+    """Returns (fingerprint, columns) of a registered table that was not dropped or recreated since, or None."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f'SELECT "fingerprint", "columns", "table_oid" IS NOT DISTINCT FROM to_regclass(%s)::oid::bigint '
+                f'FROM "{SCHEMA_REGISTRY_TABLE}" WHERE "table_name" = %s',
+                (f'public."{table_name}"', table_name)
+            )
+            row = cur.fetchone()
+        conn.commit()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return None
+    except psycopg2.Error as e:
+        logger.warning(f"Could not read schema registry for '{table_name}': {e}")
+        conn.rollback()
+        return None
+
+    if row is None or not row[2]:
+        return None
+    return row[0], row[1]
+
+
+def _save_entry(conn, table_name: str, fingerprint: str, columns: list[str]) -> None:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA_REGISTRY_TABLE_SQL)
+            cur.execute(f'''
+                INSERT INTO "{SCHEMA_REGISTRY_TABLE}" ("table_name", "fingerprint", "columns", "table_oid", "updated_at")
+                VALUES (%s, %s, %s, to_regclass(%s)::oid::bigint, NOW())
+                ON CONFLICT ("table_name") DO UPDATE SET
+                    "fingerprint" = EXCLUDED."fingerprint",
+                    "columns" = EXCLUDED."columns",
+                    "table_oid" = EXCLUDED."table_oid",
+                    "updated_at" = NOW();
+            ''', (table_name, fingerprint, psycopg2.extras.Json(columns), f'public."{table_name}"'))
+        conn.commit()
+    except psycopg2.Error as e:
+        # Без записи в реестре следующий запуск просто повторит проверку схемы
+        logger.warning(f"Could not save schema registry entry for '{table_name}': {e}")
+        conn.rollback()
+
+
+def ensure_table_schema(conn, table_name: str, columns_map: dict, create_sql: str | None = None) -> list[str]:
+    """
+    Makes sure table_name exists with at least the columns of columns_map
+    ({column: SQL type}) and returns all its columns in order.
+    create_sql (CREATE TABLE IF NOT EXISTS ...) and add_missing_columns only run when
+    the expected schema changed since the last registered run or the table was
+    dropped or recreated.
+    """
+    fingerprint = schema_fingerprint(columns_map, create_sql)
+    entry = _load_entry(conn, table_name)
+    if entry is not None and entry[0] == fingerprint:
+        logger.info(f"Schema of '{table_name}' is up to date (registry), skipping DDL checks.")
+        return list(entry[1])
+
+    logger.info(f"Schema of '{table_name}' is not registered or changed, checking the table...")
+    if create_sql:
+        planfix_utils.create_table_if_not_exists(conn, create_sql)
+    planfix_utils.add_missing_columns(conn, table_name, columns_map)
+    columns = fetch_table_columns(conn, table_name)
+    conn.commit()
+    if not columns:
+        raise ValueError(f"Table '{table_name}' does not exist")
+
+    _save_entry(conn, table_name, fingerprint, columns)
+    return columns
+
+
+def get_registered_columns(conn, table_name: str) -> list[str]:
+    """
+    Returns the columns of table_name without checking or registering its schema:
+    from the registry entry if the table was not dropped or recreated since,
+    otherwise from information_schema. For callers that only read a table owned
+    by another script, so the owner's fingerprint is left as it is.
+    """
+    entry = _load_entry(conn, table_name)
+    if entry is not None:
+        return list(entry[1])
+    columns = fetch_table_columns(conn, table_name)
+    conn.commit()
+    if not columns:
+        raise ValueError(f"Table '{table_name}' does not exist")
+    return columns
+
+
+def invalidate_table_schema(conn, table_name: str) -> None:
+    """Drops the registry entry of a table, so the next run checks its schema again."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DELETE FROM "{SCHEMA_REGISTRY_TABLE}" WHERE "table_name" = %s', (table_name,))
+        conn.commit()
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
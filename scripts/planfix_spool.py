@@ -0,0 +1,141 @@
+"""
+Спул сырых ответов Planfix.
+
+Каждый ответ API за запуск дописывается в append-only файл в сжатом виде
+(zlib), а рядом ведется индекс <spool>.idx (JSON Lines) с ключом
+метод + параметры + страница и смещением записи в файле. Повторный запуск
+с --from-spool читает ответы из файла через mmap и не обращается к API:
+если упал шаг загрузки в Supabase или поменялся парсер, данные
+переобрабатываются со скоростью диска.
+"""
+
+import os
+import json
+import mmap
+import zlib
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.idx'
+
+
+def spool_key(method_name: str, params: str = '', page: int = 1) -> str:
+    """Builds the spool index key for a request."""
+    return f"{method_name}|{params}|{page}"
+
+
+class ResponseSpoolWriter:
+    """Дописывает ответы API в спул-файл и его индекс."""
+
+    def __init__(self, path: str, compress_level: int = 6):
+        self.path = path
+        self.compress_level = compress_level
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Каждый запуск пишет свой спул: прежний файл и индекс перезаписываются
+        self._data_file = open(path, 'wb')
+        self._index_file = open(path + INDEX_SUFFIX, 'w', encoding='utf-8')
+        self.records = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        logger.info(f"Recording raw Planfix responses to spool {path}")
+
+    def append(self, method_name: str, params: str, page: int, data: bytes) -> None:
+        """Appends one raw response and its index entry."""
+        compressed = zlib.compress(data, self.compress_level)
+        offset = self._data_file.tell()
+        self._data_file.write(compressed)
+        self._data_file.flush()
+
+        entry = {
+            'key': spool_key(method_name, params, page),
+            'method': method_name,
+            'params': params,
+            'page': page,
+            'offset': offset,
+            'length': len(compressed),
+            'size': len(data),
+            'fetched_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        self._index_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._index_file.flush()
+
+        self.records += 1
+        self.raw_bytes += len(data)
+        self.stored_bytes += len(compressed)
+
+    def close(self) -> None:
+        if self._data_file.closed:
+            return
+        self._data_file.close()
+        self._index_file.close()
+        logger.info(
+            f"Spool {self.path} closed: {self.records} responses, "
+            f"{self.raw_bytes / 1024:.1f} KB raw, {self.stored_bytes / 1024:.1f} KB stored"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ResponseSpoolReader:
+    """Читает ответы из спула через mmap по ключу индекса."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = {}
+        self.entries = []
+        with open(path + INDEX_SUFFIX, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка после аварийного завершения записи
+                    logger.warning(f"Skipping damaged spool index line in {path}{INDEX_SUFFIX}")
+                    continue
+                self.entries.append(entry)
+                # При повторных запросах (ретраях) актуален последний ответ
+                self.index[entry['key']] = entry
+
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        logger.info(f"Opened spool {path}: {len(self.index)} responses")
+
+    def get(self, method_name: str, params: str = '', page: int = 1) -> bytes | None:
+        """Returns the raw response for a request, or None if it was not spooled."""
+        entry = self.index.get(spool_key(method_name, params, page))
+        if entry is None or self._map is None:
+            return None
+        start = entry['offset']
+        return zlib.decompress(self._map[start:start + entry['length']])
+
+    def iter_responses(self, method_name: str | None = None):
+        """Yields (entry, raw response) in recording order, optionally for one method."""
+        for entry in self.entries:
+            if method_name and entry['method'] != method_name:
+                continue
+            if self.index.get(entry['key']) is not entry:
+                continue
+            start = entry['offset']
+            yield entry, zlib.decompress(self._map[start:start + entry['length']])
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
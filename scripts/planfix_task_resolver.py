@@ -0,0 +1,132 @@
+"""
+Дозапрос заказов, на которые ссылаются строки аналитики.
+
+Строки analitic.getDataByCondition связываются с заказами через tasks_dict —
+заказы из списка task.getList. Строки задач, которых в списке нет (задача
+создана после получения списка, не по шаблону заказов и т.п.), раньше
+пропускались. TaskResolver собирает
+неизвестные ID задач со страницы и запрашивает их пачками (task.getMulti,
+до PLANFIX_TASK_BATCH_SIZE задач в запросе), поэтому число запросов зависит
+от числа новых задач, а не от размера списка заказов. Дозапрошенные задачи
+(и задачи, которых в Planfix нет) хранятся в LRU-кеше на
+PLANFIX_TASK_CACHE_SIZE записей.
+"""
+
+import os
+import logging
+from collections import OrderedDict
+
+import requests
+
+try:
+    import scripts.planfix_utils as planfix_utils
+    import scripts.planfix_xml as planfix_xml
+except ImportError:  # модуль импортирован из каталога scripts/
+    import planfix_utils
+    import planfix_xml
+
+logger = logging.getLogger(__name__)
+
+PLANFIX_TASK_CACHE_SIZE = int(os.environ.get('PLANFIX_TASK_CACHE_SIZE', '5000'))
+PLANFIX_TASK_BATCH_SIZE = int(os.environ.get('PLANFIX_TASK_BATCH_SIZE', '100'))
+
+
+def build_task_multi_body(task_ids) -> str:
+    """Формирует XML-запрос task.getMulti для пачки задач."""
+    tasks_xml = ''.join(f'<task><id>{task_id}</id></task>' for task_id in task_ids)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<request method="task.getMulti">'
+        f'<account>{planfix_utils.PLANFIX_ACCOUNT}</account>'
+        f'<tasks>{tasks_xml}</tasks>'
+        '</request>'
+    )
+
+
+def task_multi_spool_params(task_ids) -> str:
+    return 'tasks=' + ','.join(str(task_id) for task_id in task_ids)
+
+
+class TaskResolver:
+    """
+    Заказы для строк аналитики: известные (tasks_dict) и дозапрошенные.
+    parse_rows и row_fields — разбор ответа с задачами в кортежи и имена их
+    полей (export_produkty_with_orders.parse_task_rows и TASK_ROW_FIELDS).
+    mirror — локальное зеркало (planfix_mirror): свежие заказы берутся из него.
+    """
+
+    def __init__(self, tasks_dict: dict, parse_rows, row_fields, mirror=None,
+                 max_size: int = PLANFIX_TASK_CACHE_SIZE, batch_size: int = PLANFIX_TASK_BATCH_SIZE):
+        self.tasks_dict = tasks_dict
+        self.parse_rows = parse_rows
+        self.row_fields = row_fields
+        self.mirror = mirror
+        self.max_size = max_size
+        self.batch_size = batch_size
+        # ID задачи -> словарь задачи или None (задачи нет или ее не удалось получить)
+        self._cache = OrderedDict()
+        self.requests = 0
+        self.resolved = 0
+
+    def __contains__(self, task_id) -> bool:
+        return task_id in self.tasks_dict or self._cache.get(task_id) is not None
+
+    def get(self, task_id, default=None):
+        """Задача по ID без запросов к API (неизвестная — default)."""
+        task = self.tasks_dict.get(task_id)
+        if task is not None:
+            return task
+        if task_id in self._cache:
+            self._cache.move_to_end(task_id)
+            task = self._cache[task_id]
+        return task if task is not None else default
+
+    def _remember(self, task_id, task) -> None:
+        self._cache[task_id] = task
+        self._cache.move_to_end(task_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _fetch(self, task_ids: list) -> dict:
+        data = planfix_utils.post_planfix_xml(
+            'task.getMulti', build_task_multi_body(task_ids), task_multi_spool_params(task_ids)
+        )
+        self.requests += 1
+        return {row[0]: dict(zip(self.row_fields, row)) for row in self.parse_rows(data)}
+
+    def resolve(self, task_ids) -> None:
+        """
+        Дозапрашивает задачи из task_ids, которых нет ни в tasks_dict, ни в кеше.
+        Ошибка запроса не прерывает экспорт: задачи пачки считаются ненайденными
+        до конца запуска.
+        """
+        missing = sorted({
+            task_id for task_id in task_ids
+            if task_id and task_id not in self.tasks_dict and task_id not in self._cache
+        })
+        if not missing:
+            return
+
+        if self.mirror is not None:
+            for task_id, task in self.mirror.get_fresh_orders(missing).items():
+                self._remember(task_id, task)
+            missing = [task_id for task_id in missing if task_id not in self._cache]
+
+        fetched = []
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            try:
+                tasks = self._fetch(batch)
+            except (requests.exceptions.RequestException, ValueError, *planfix_xml.ParseError) as e:
+                logger.warning(f"Could not resolve {len(batch)} tasks missing from the order list: {e}")
+                tasks = {}
+            for task_id in batch:
+                task = tasks.get(task_id)
+                self._remember(task_id, task)
+                if task is not None:
+                    fetched.append(task)
+        self.resolved += len(fetched)
+        if fetched and self.mirror is not None:
+            self.mirror.put_orders(fetched)
+        if missing:
+            logger.info(f"Resolved {len(fetched)} of {len(missing)} tasks missing from the order list")
@@ -1,11 +1,28 @@
 import os
+import json
+import time
+import itertools
+import operator
+import uuid
+import hashlib
+import queue
+import threading
+import zlib
+import weakref
 import psycopg2
 import requests
-import xml.etree.ElementTree as ET
 from datetime import datetime
 import logging
+from contextlib import contextmanager
 from dotenv import load_dotenv
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
+
+try:
+    import scripts.planfix_xml as planfix_xml
+except ImportError:  # модуль импортирован как planfix_utils (scripts/ в sys.path)
+    import planfix_xml
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
@@ -26,6 +43,54 @@ SUPABASE_PORT = os.environ.get('SUPABASE_PORT')
 
 PLANFIX_API_URL = "https://api.planfix.com/xml/"
 
+# Пул соединений с Supabase: максимум соединений и таймаут подключения (с)
+SUPABASE_POOL_SIZE = int(os.environ.get('SUPABASE_POOL_SIZE', '4'))
+SUPABASE_CONNECT_TIMEOUT = int(os.environ.get('SUPABASE_CONNECT_TIMEOUT', '10'))
+# Серверные подготовленные запросы для upsert: 1 — включены, 0 — выключены,
+# auto (по умолчанию) — включены, кроме подключения через пулер Supabase в режиме
+# transaction (порт 6543): PREPARE живет в сессии, а пулер меняет сессию на каждой транзакции
+SUPABASE_PREPARED_STATEMENTS = os.environ.get('SUPABASE_PREPARED_STATEMENTS', 'auto').lower()
+SUPABASE_TRANSACTION_POOLER_PORT = 6543
+
+# Способ загрузки строк в upsert_data_to_supabase:
+#   batch  — execute_batch с построчным INSERT ... ON CONFLICT (по умолчанию);
+#   values — execute_values: многострочный INSERT по page_size строк;
+#   unnest — каждая колонка одним массивом, все строки одним запросом;
+#   copy   — COPY FROM STDIN во временную таблицу и один INSERT ... SELECT ... ON CONFLICT;
+#   auto   — выбор по числу строк (см. choose_upsert_loader).
+UPSERT_LOADERS = ('batch', 'values', 'unnest', 'copy', 'auto')
+SUPABASE_LOADER = os.environ.get('SUPABASE_LOADER', 'batch')
+# Строк в одном запросе для batch/values
+SUPABASE_PAGE_SIZE = int(os.environ.get('SUPABASE_PAGE_SIZE', '1000'))
+# Строк в одной транзакции потоковой загрузки (upsert_stream_to_supabase)
+SUPABASE_CHUNK_SIZE = int(os.environ.get('SUPABASE_CHUNK_SIZE', '5000'))
+# Драйвер загрузки в экспорте Produkty: psycopg2 (функции этого модуля) или
+# psycopg3 (pipeline mode и бинарный COPY, scripts/planfix_psycopg3.py)
+DB_BACKENDS = ('psycopg2', 'psycopg3')
+SUPABASE_DB_BACKEND = os.environ.get('SUPABASE_DB_BACKEND', 'psycopg2').lower()
+# Параллельных соединений при загрузке (upsert_parallel_to_supabase), 1 — одно соединение
+SUPABASE_WRITE_WORKERS = int(os.environ.get('SUPABASE_WRITE_WORKERS', '1'))
+# Таблица для строк, которые не удалось загрузить (upsert с quarantine=True), и
+# максимум таких строк в одной пачке: больше — уже не плохие строки, а системная ошибка
+QUARANTINE_TABLE = 'planfix_upsert_quarantine'
+SUPABASE_QUARANTINE_MAX_ROWS = int(os.environ.get('SUPABASE_QUARANTINE_MAX_ROWS', '100'))
+# Границы для auto (по результатам scripts/benchmark_loaders.py). copy быстрее
+# всех уже от ~200 строк на локальном Postgres, но делает 5 запросов против 2
+# у unnest, поэтому до удаленного Supabase граница сдвинута выше.
+AUTO_VALUES_MAX_ROWS = 50
+AUTO_UNNEST_MAX_ROWS = 1000
+
+# Колонка с идентификатором запуска, в котором строка была загружена последний раз
+RUN_ID_COLUMN = 'last_seen_run_id'
+# Колонка с хешем содержимого строки: неизмененные строки при upsert не переписываются
+ROW_HASH_COLUMN = 'row_hash'
+# Колонки, которые меняются при каждом запуске и не входят в хеш строки
+ROW_HASH_IGNORED_COLUMNS = ('updated_at', RUN_ID_COLUMN, ROW_HASH_COLUMN)
+
+def new_run_id() -> str:
+    """Returns a unique identifier of an export run, stamped into RUN_ID_COLUMN."""
+    return f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
 def check_required_env_vars(env_vars_dict: dict) -> None:
     """
     Checks if all required environment variables are set.
@@ -68,8 +133,9 @@ def dict_to_xml(data, root_tag=None):
     else:
         # data — строка или число
         xml += f'<{root_tag}>{data}</{root_tag}>' if root_tag else str(data)
-    if root_tag and not isinstance(data, (str, int, float)):
-        return xml
+    if root_tag and isinstance(data, dict):
+        # Вложенный словарь оборачивается своим тегом: {'status': {'id': 1}} -> <status><id>1</id></status>
+        return f'<{root_tag}>{xml}</{root_tag}>'
     return xml
 
 def make_planfix_request(method_name: str, params: dict) -> str:
@@ -112,7 +178,7 @@ def make_planfix_request(method_name: str, params: dict) -> str:
         response.raise_for_status()
         
         # Check for Planfix API errors in response
-        root = ET.fromstring(response.text)
+        root = planfix_xml.fromstring(response.text)
         error = root.find('.//error')
         if error is not None:
             error_code = error.find('code').text if error.find('code') is not None else 'Unknown'
@@ -123,22 +189,188 @@ def make_planfix_request(method_name: str, params: dict) -> str:
         logger.info(f"Planfix API request to {method_name} successful.")
         return response.text
         
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"XML ParseError for request_body_xml: {e}. Request body: {request_body_xml[:200]}...")
         raise
     except requests.exceptions.RequestException as e:
         logger.error(f"Planfix API request failed: {e}")
         raise
 
-def get_planfix_status_name(status_id: str) -> str | None:
+# Спул сырых ответов API (см. planfix_spool): запись ответов текущего запуска
+# и чтение ранее записанных ответов вместо запросов при --from-spool
+_response_spool = None
+_replay_spool = None
+
+def set_response_spool(writer=None, reader=None) -> None:
     """
-    Gets the name of a Planfix status by its ID.
-    Logs errors if fetching or parsing fails.
+    Sets the spool that records raw responses (writer) and/or the spool that
+    serves responses instead of the API (reader). Pass None to disable.
     """
-    if not status_id:
-        logger.warning("get_planfix_status_name called with empty status_id.")
+    global _response_spool, _replay_spool
+    _response_spool = writer
+    _replay_spool = reader
+
+def close_response_spool() -> None:
+    """Closes the active record/replay spools and disables spooling."""
+    global _response_spool, _replay_spool
+    for spool in (_response_spool, _replay_spool):
+        if spool is not None:
+            spool.close()
+    _response_spool = None
+    _replay_spool = None
+
+def is_replaying_spool() -> bool:
+    """Returns True when responses are served from a spool instead of the API."""
+    return _replay_spool is not None
+
+def api_pause(seconds: float) -> None:
+    """
+    Sleeps between API calls to stay under Planfix rate limits.
+    No-op when replaying from a spool, where there is no API to throttle.
+    """
+    if _replay_spool is None:
+        time.sleep(seconds)
+
+def post_planfix_xml(method_name: str, body: str, spool_params: str = '', page: int = 1) -> bytes:
+    """
+    Sends a ready XML request body to Planfix (HTTP basic auth) and returns the raw response bytes.
+    spool_params and page identify the request in the response spool:
+    the response is recorded when a spool writer is set, and read from the spool
+    instead of the API when a replay spool is set.
+    """
+    if _replay_spool is not None:
+        data = _replay_spool.get(method_name, spool_params, page)
+        if data is None:
+            raise ValueError(f"Response for {method_name} ({spool_params}, page {page}) not found in spool")
+        return data
+
+    headers = {
+        'Content-Type': 'application/xml',
+        'Accept': 'application/xml'
+    }
+    response = requests.post(
+        PLANFIX_API_URL,
+        data=body.encode('utf-8'),
+        headers=headers,
+        auth=(PLANFIX_API_KEY, PLANFIX_TOKEN)
+    )
+    response.raise_for_status()
+    data = response.content
+
+    if _response_spool is not None:
+        _response_spool.append(method_name, spool_params, page, data)
+    return data
+
+# Кеш названий статусов: статусы загружаются одним проходом по наборам статусов
+# (taskStatus.getSetList или наборы нужных шаблонов + taskStatus.getListOfSet) и хранятся в памяти
+# и в JSON-файле на диске, пока не истечет PLANFIX_STATUS_CACHE_TTL (с)
+PLANFIX_STATUS_CACHE_PATH = os.environ.get('PLANFIX_STATUS_CACHE_PATH', '.planfix_cache/statuses.json')
+PLANFIX_STATUS_CACHE_TTL = int(os.environ.get('PLANFIX_STATUS_CACHE_TTL', '86400'))
+_status_names = {}
+_status_names_loaded_at = None
+_status_cache_lock = threading.Lock()
+
+def _load_status_cache_file(path: str, ttl: int) -> dict | None:
+    """Returns the statuses saved on disk, or None when the file is missing, broken or older than ttl."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        loaded_at = float(saved['loaded_at'])
+        statuses = saved['statuses']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if time.time() - loaded_at > ttl:
         return None
+    return {'loaded_at': loaded_at, 'statuses': {str(k): v for k, v in statuses.items()}}
+
+def _save_status_cache_file(path: str, loaded_at: float, statuses: dict) -> None:
+    """Writes the statuses to disk atomically; failures only disable the disk copy."""
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'loaded_at': loaded_at, 'statuses': statuses}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not save status cache to {path}: {e}")
+
+def fetch_planfix_statuses(status_set_ids: list[str] | None = None) -> dict[str, str]:
+    """
+    Loads status names from Planfix: one taskStatus.getSetList call (skipped when
+    status_set_ids is given) plus one taskStatus.getListOfSet call per status set.
+    Returns {status_id: name}.
+    """
+    if status_set_ids is None:
+        root = planfix_xml.fromstring(make_planfix_request('taskStatus.getSetList', {}))
+        status_set_ids = [node.findtext('id') for node in root.iter('taskStatusSet') if node.findtext('id')]
+
+    statuses = {}
+    for set_id in status_set_ids:
+        response_xml = make_planfix_request('taskStatus.getListOfSet', {'taskStatusSet': {'id': set_id}})
+        root = planfix_xml.fromstring(response_xml)
+        for node in root.iter('taskStatus'):
+            status_id = node.findtext('id')
+            name = node.findtext('name')
+            if status_id and name:
+                statuses[status_id.strip()] = name.strip()
+    logger.info(f"Fetched {len(statuses)} statuses from {len(status_set_ids)} status sets")
+    return statuses
+
+def fetch_template_status_set_ids(template_ids) -> list[str]:
+    """
+    Returns the status sets of task templates without repeats: one task.get call
+    per template, the set is the <statusSet> of the template task.
+    """
+    status_set_ids = []
+    for template_id in template_ids:
+        root = planfix_xml.fromstring(make_planfix_request('task.get', {'task': {'id': template_id}}))
+        set_id = (root.findtext('.//task/statusSet') or '').strip()
+        if set_id and set_id not in status_set_ids:
+            status_set_ids.append(set_id)
+    return status_set_ids
+
+def preload_planfix_statuses(status_set_ids: list[str] | None = None, force: bool = False, template_ids=None) -> dict[str, str]:
+    """
+    Fills the status name cache: from memory or the disk copy while they are
+    younger than PLANFIX_STATUS_CACHE_TTL, otherwise from the API (fetch_planfix_statuses).
+    status_set_ids limits the API load to the status sets of the relevant task templates;
+    alternatively template_ids names the templates, and their status sets are only
+    looked up (fetch_template_status_set_ids) when the API load is needed.
+    force=True always reloads from the API. Returns the cached {status_id: name}.
+    """
+    global _status_names, _status_names_loaded_at
+    with _status_cache_lock:
+        now = time.time()
+        if not force and _status_names_loaded_at is not None and now - _status_names_loaded_at <= PLANFIX_STATUS_CACHE_TTL:
+            return _status_names
+
+        saved = None if force else _load_status_cache_file(PLANFIX_STATUS_CACHE_PATH, PLANFIX_STATUS_CACHE_TTL)
+        if saved is not None:
+            logger.info(f"Loaded {len(saved['statuses'])} statuses from {PLANFIX_STATUS_CACHE_PATH}")
+            _status_names, _status_names_loaded_at = saved['statuses'], saved['loaded_at']
+            return _status_names
+
+        if status_set_ids is None and template_ids:
+            # Шаблон без набора статусов — загружаем все наборы
+            status_set_ids = fetch_template_status_set_ids(template_ids) or None
+        statuses = fetch_planfix_statuses(status_set_ids)
+        _status_names, _status_names_loaded_at = statuses, now
+        _save_status_cache_file(PLANFIX_STATUS_CACHE_PATH, now, statuses)
+        return _status_names
+
+def clear_planfix_status_cache(remove_file: bool = False) -> None:
+    """Drops the in-memory status cache (and the disk copy when remove_file=True)."""
+    global _status_names, _status_names_loaded_at
+    with _status_cache_lock:
+        _status_names, _status_names_loaded_at = {}, None
+        if remove_file:
+            try:
+                os.remove(PLANFIX_STATUS_CACHE_PATH)
+            except FileNotFoundError:
+                pass
 
+def _fetch_planfix_status_name(status_id: str) -> str | None:
+    """Gets the name of one status with status.get (fallback for statuses outside the preloaded sets)."""
     params = {
         'status': {
             'id': status_id
@@ -147,7 +379,7 @@ def get_planfix_status_name(status_id: str) -> str | None:
     try:
         logger.info(f"Fetching status name for ID: {status_id}")
         response_xml = make_planfix_request('status.get', params)
-        root = ET.fromstring(response_xml)
+        root = planfix_xml.fromstring(response_xml)
         status_name_element = root.find(".//status/name")
         
         if status_name_element is not None and status_name_element.text:
@@ -167,39 +399,168 @@ def get_planfix_status_name(status_id: str) -> str | None:
         # Error already logged by make_planfix_request, but can add context
         logger.error(f"Request failed while trying to get status name for ID {status_id}: {e}")
         return None
-    except ET.ParseError as e:
+    except planfix_xml.ParseError as e:
         logger.error(f"Failed to parse XML response for status ID {status_id}: {e}. Response: {response_xml[:200]}...")
         return None
     except Exception as e: # Catch any other unexpected errors
-        logger.error(f"An unexpected error occurred in get_planfix_status_name for ID {status_id}: {e}")
+        logger.error(f"An unexpected error occurred in _fetch_planfix_status_name for ID {status_id}: {e}")
         return None
 
+def get_planfix_status_name(status_id: str, template_ids=None) -> str | None:
+    """
+    Gets the name of a Planfix status by its ID from the status cache
+    (see preload_planfix_statuses). The first lookup preloads all statuses,
+    or only those of the status sets of template_ids when given;
+    a status missing from the preloaded sets is fetched once with status.get
+    and remembered, so repeated lookups cost no API calls.
+    Logs errors if fetching or parsing fails.
+    """
+    if not status_id:
+        logger.warning("get_planfix_status_name called with empty status_id.")
+        return None
+    status_id = str(status_id).strip()
+
+    try:
+        statuses = preload_planfix_statuses(template_ids=template_ids)
+    except (requests.exceptions.RequestException, ValueError, *planfix_xml.ParseError) as e:
+        logger.error(f"Failed to preload Planfix statuses: {e}")
+        with _status_cache_lock:
+            # Не повторяем неудачную загрузку на каждый поиск: остальные статусы — через status.get
+            global _status_names_loaded_at
+            _status_names_loaded_at = time.time()
+        statuses = _status_names
+    if status_id in statuses:
+        return statuses[status_id]
+
+    status_name = _fetch_planfix_status_name(status_id)
+    with _status_cache_lock:
+        # None тоже запоминается до конца запуска, чтобы не повторять запрос
+        _status_names[status_id] = status_name
+    return status_name
+
+
+def _supabase_connect_kwargs() -> dict:
+    """Returns psycopg2.connect arguments from the Supabase environment variables."""
+    if SUPABASE_CONNECTION_STRING:
+        return {'dsn': SUPABASE_CONNECTION_STRING, 'connect_timeout': SUPABASE_CONNECT_TIMEOUT}
+    # Fallback to individual parameters if connection string is not provided
+    required_params = {
+        'SUPABASE_HOST': SUPABASE_HOST, 'SUPABASE_DB': SUPABASE_DB,
+        'SUPABASE_USER': SUPABASE_USER, 'SUPABASE_PASSWORD': SUPABASE_PASSWORD,
+        'SUPABASE_PORT': SUPABASE_PORT
+    }
+    if any(not v for v in required_params.values()):
+        raise ValueError(f"Missing one or more Supabase connection parameters: {', '.join(k for k, v in required_params.items() if not v)}")
+    return {
+        'host': SUPABASE_HOST, 'dbname': SUPABASE_DB,
+        'user': SUPABASE_USER, 'password': SUPABASE_PASSWORD, 'port': SUPABASE_PORT,
+        'connect_timeout': SUPABASE_CONNECT_TIMEOUT,
+    }
 
 def get_supabase_connection():
     """Establishes a connection to the Supabase database."""
     try:
         logger.info("Attempting to connect to Supabase...")
-        if SUPABASE_CONNECTION_STRING:
-            conn = psycopg2.connect(SUPABASE_CONNECTION_STRING)
-        else:
-            # Fallback to individual parameters if connection string is not provided
-            required_params = {
-                'SUPABASE_HOST': SUPABASE_HOST, 'SUPABASE_DB': SUPABASE_DB,
-                'SUPABASE_USER': SUPABASE_USER, 'SUPABASE_PASSWORD': SUPABASE_PASSWORD,
-                'SUPABASE_PORT': SUPABASE_PORT
-            }
-            if any(not v for v in required_params.values()):
-                raise ValueError(f"Missing one or more Supabase connection parameters: {', '.join(k for k, v in required_params.items() if not v)}")
-            conn = psycopg2.connect(
-                host=SUPABASE_HOST, dbname=SUPABASE_DB,
-                user=SUPABASE_USER, password=SUPABASE_PASSWORD, port=SUPABASE_PORT
-            )
+        conn = psycopg2.connect(**_supabase_connect_kwargs())
         logger.info("Successfully connected to Supabase.")
         return conn
     except (psycopg2.OperationalError, ValueError) as e:
         logger.critical(f"Could not connect to Supabase: {e}")
         raise
 
+# Общий пул соединений процесса (создается при первом обращении, в том числе из потоков загрузки)
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Returns the process-wide Supabase connection pool, creating it on first use."""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            try:
+                logger.info(f"Creating Supabase connection pool (max {SUPABASE_POOL_SIZE} connections)...")
+                _connection_pool = psycopg2.pool.ThreadedConnectionPool(1, SUPABASE_POOL_SIZE, **_supabase_connect_kwargs())
+            except (psycopg2.OperationalError, ValueError) as e:
+                logger.critical(f"Could not connect to Supabase: {e}")
+                raise
+        return _connection_pool
+
+def get_pooled_connection():
+    """Takes a connection from the pool. Return it with release_connection."""
+    return get_connection_pool().getconn()
+
+def release_connection(conn) -> None:
+    """
+    Returns a pooled connection to the pool. An open transaction is rolled back,
+    a broken connection is discarded instead of being reused.
+    """
+    if conn is None or _connection_pool is None:
+        return
+    broken = bool(conn.closed)
+    if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    _connection_pool.putconn(conn, close=broken)
+
+@contextmanager
+def supabase_connection():
+    """Context manager yielding a pooled connection and returning it to the pool afterwards."""
+    conn = get_pooled_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+def close_connection_pool() -> None:
+    """Closes all pooled connections."""
+    global _connection_pool
+    if _connection_pool is not None:
+        _connection_pool.closeall()
+        _connection_pool = None
+        logger.info("Supabase connection pool closed.")
+
+def prepared_statements_enabled(conn) -> bool:
+    """
+    Returns whether server-side prepared statements may be used on conn
+    (psycopg2 or psycopg 3), see SUPABASE_PREPARED_STATEMENTS.
+    """
+    if SUPABASE_PREPARED_STATEMENTS in ('0', 'false', 'no'):
+        return False
+    if SUPABASE_PREPARED_STATEMENTS == 'auto':
+        return int(conn.info.port) != SUPABASE_TRANSACTION_POOLER_PORT
+    return True
+
+# Подготовленные запросы сессий: соединение -> (PID серверного процесса, имена запросов).
+# Другой PID — другая сессия, в которой запросы надо подготовить заново
+_prepared_names = weakref.WeakKeyDictionary()
+
+def _prepared_statement(cursor, statement_sql: str, param_types: list[str] | None = None) -> str | None:
+    """
+    Prepares statement_sql ($1, $2... placeholders) once per database session and
+    returns the name to EXECUTE, or None when prepared statements are disabled.
+    Prepared statements live as long as the connection, so pooled connections
+    reuse the plan across batches and runs of the same process. Prepared names
+    are remembered per connection, so a repeated call costs no round trip.
+    """
+    conn = cursor.connection
+    if not prepared_statements_enabled(conn):
+        return None
+    name = f"planfix_{hashlib.sha1(statement_sql.encode('utf-8')).hexdigest()[:16]}"
+    backend_pid = conn.get_backend_pid()
+    session = _prepared_names.get(conn)
+    if session is None or session[0] != backend_pid:
+        session = (backend_pid, set())
+        _prepared_names[conn] = session
+    if name not in session[1]:
+        types_sql = f" ({', '.join(param_types)})" if param_types else ''
+        cursor.execute(f"PREPARE {name}{types_sql} AS {statement_sql}")
+        # PREPARE не откатывается вместе с транзакцией: запрос остается в сессии
+        session[1].add(name)
+        logger.debug(f"Prepared statement {name}: {statement_sql}")
+    return name
+
 def create_table_if_not_exists(conn, create_sql):
     """Executes a CREATE TABLE IF NOT EXISTS statement."""
     try:
@@ -213,46 +574,473 @@ def create_table_if_not_exists(conn, create_sql):
         conn.rollback()
         raise
 
-def upsert_data_to_supabase(conn: psycopg2.extensions.connection, table_name: str, primary_key_column: str, column_names: list[str], data_list: list[dict]) -> None:
+def _copy_text_value(value) -> str:
+    """Formats a Python value as a field of COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        text = value.isoformat(sep=' ')
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value, ensure_ascii=False)
+    else:
+        text = str(value)
+    return (
+        text.replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+class _CopyRowReader:
+    """
+    Файлоподобный объект для cursor.copy_expert: отдает строки в формате
+    COPY text по мере чтения, не собирая весь набор данных в памяти.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = b''
+        self.rows_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += ('\t'.join(_copy_text_value(v) for v in row) + '\n').encode('utf-8')
+            self.rows_read += 1
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    readline = read
+
+def compute_row_hash(values) -> str:
+    """Returns a SHA-256 content hash of a row's values (stored in ROW_HASH_COLUMN)."""
+    payload = json.dumps(list(values), ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _key_columns(primary_key_column: str | tuple[str, ...]) -> list[str]:
+    """
+    Returns the conflict key of an upsert as a list of columns. The key is a single
+    column name or a tuple of names (partitioned tables need the partition column in it).
+    """
+    if isinstance(primary_key_column, str):
+        return [primary_key_column]
+    return list(primary_key_column)
+
+def _key_sql(primary_key_column: str | tuple[str, ...]) -> str:
+    return ", ".join(f'"{col}"' for col in _key_columns(primary_key_column))
+
+def _upsert_sql_parts(table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str]) -> tuple[str, str]:
+    """
+    Returns the quoted column list and the ON CONFLICT ... DO UPDATE clause of an upsert.
+    When the rows carry ROW_HASH_COLUMN, an existing row is only updated if its hash
+    changed or it is soft-deleted: a row that comes back unchanged after
+    mark_items_as_deleted_in_supabase must be written again with is_deleted = FALSE.
+    """
+    key_columns = _key_columns(primary_key_column)
+    cols_sql = ", ".join([f'"{col}"' for col in column_names])
+    update_cols = [col for col in column_names if col not in key_columns]
+    update_set_sql = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in update_cols])
+    conflict_sql = f'ON CONFLICT ({_key_sql(primary_key_column)}) DO UPDATE SET {update_set_sql}'
+    if ROW_HASH_COLUMN in column_names:
+        conflict_sql += f' WHERE "{table_name}"."{ROW_HASH_COLUMN}" IS DISTINCT FROM EXCLUDED."{ROW_HASH_COLUMN}"'
+        if 'is_deleted' in column_names:
+            conflict_sql += f' OR "{table_name}"."is_deleted"'
+    return cols_sql, conflict_sql
+
+def _inserted_flag_sql(table_name: str, primary_key_column: str | tuple[str, ...]) -> tuple[str, str]:
+    """
+    Returns the RETURNING list of an upsert CTE named "merged" and an expression over
+    "merged" that is true for the rows it inserted. The rest of the statement sees the
+    table as it was before the CTE ran, so a written row whose key was not there yet
+    was inserted. Unlike (xmax = 0), this also works on partitioned tables, where
+    RETURNING cannot read system columns.
+    """
+    match_sql = " AND ".join(f'"t"."{col}" = "merged"."{col}"' for col in _key_columns(primary_key_column))
+    return _key_sql(primary_key_column), f'NOT EXISTS (SELECT 1 FROM "{table_name}" AS "t" WHERE {match_sql})'
+
+def _counted_merge_sql(table_name: str, primary_key_column: str | tuple[str, ...], cols_sql: str, select_sql: str, conflict_sql: str) -> str:
+    """
+    Wraps a set-based INSERT ... SELECT ... ON CONFLICT so that it returns one row:
+    (inserted, updated). Rows skipped by the conflict WHERE are not returned.
+    """
+    returning_sql, inserted_sql = _inserted_flag_sql(table_name, primary_key_column)
+    return f"""
+    WITH merged AS (
+        INSERT INTO "{table_name}" ({cols_sql})
+        {select_sql}
+        {conflict_sql}
+        RETURNING {returning_sql}
+    )
+    SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+    FROM (SELECT {inserted_sql} AS inserted FROM merged) AS written;
+    """
+
+def get_column_types(cursor, table_name: str, column_names: list[str]) -> list[str]:
+    """Returns the SQL types (format_type) of the given columns of a table, in order."""
+    cursor.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped;
+    """, (f'"{table_name}"',))
+    types = dict(cursor.fetchall())
+    missing = [col for col in column_names if col not in types]
+    if missing:
+        raise ValueError(f"Columns not found in table '{table_name}': {', '.join(missing)}")
+    return [types[col] for col in column_names]
+
+# Функции загрузки возвращают (строк передано, вставлено, обновлено).
+
+def _upsert_batch(cursor, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], rows, page_size: int) -> tuple:
+    """
+    Upserts rows one INSERT ... ON CONFLICT statement per row via execute_batch.
+    execute_batch does not return the results of the statements, so every statement
+    records whether it inserted its row in a temporary table, counted at the end.
+    """
+    cols_sql, conflict_sql = _upsert_sql_parts(table_name, primary_key_column, column_names)
+
+    records_to_insert = list(rows)
+    if not records_to_insert:
+        return 0, 0, 0
+
+    counts_table = f"_counts_{table_name}"
+    cursor.execute(f'DROP TABLE IF EXISTS "{counts_table}"')
+    cursor.execute(f'CREATE TEMP TABLE "{counts_table}" ("inserted" BOOLEAN) ON COMMIT DROP')
+
+    returning_sql, inserted_sql = _inserted_flag_sql(table_name, primary_key_column)
+
+    def counted_sql(values_sql):
+        return f"""
+        WITH merged AS (
+            INSERT INTO "{table_name}" ({cols_sql})
+            VALUES ({values_sql})
+            {conflict_sql}
+            RETURNING {returning_sql}
+        )
+        INSERT INTO "{counts_table}" SELECT {inserted_sql} FROM merged
+        """
+
+    statement = _prepared_statement(cursor, counted_sql(", ".join(f"${i}" for i in range(1, len(column_names) + 1))))
+    placeholders_sql = ", ".join(["%s"] * len(column_names))
+    if statement:
+        upsert_query = f"EXECUTE {statement} ({placeholders_sql})"
+    else:
+        upsert_query = counted_sql(placeholders_sql)
+    psycopg2.extras.execute_batch(cursor, upsert_query, records_to_insert, page_size=page_size)
+    cursor.execute(
+        f'SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM "{counts_table}"'
+    )
+    inserted, updated = cursor.fetchone()
+    return len(records_to_insert), inserted, updated
+
+def _upsert_values(cursor, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], rows, page_size: int) -> tuple:
+    """
+    Upserts rows with multi-row INSERT statements of page_size rows via execute_values.
+    Values are cast to the column types, and within a statement the last row of a
+    repeated key wins (a single ON CONFLICT statement cannot update a row twice).
+    """
+    cols_sql, conflict_sql = _upsert_sql_parts(table_name, primary_key_column, column_names)
+    column_types = get_column_types(cursor, table_name, column_names)
+    template = "(" + ", ".join(f"%s::{col_type}" for col_type in column_types) + ", %s)"
+
+    upsert_query = _counted_merge_sql(table_name, primary_key_column, cols_sql, f"""
+        SELECT DISTINCT ON ({_key_sql(primary_key_column)}) {cols_sql}
+        FROM (VALUES %s) AS v ({cols_sql}, "_row_no")
+        ORDER BY {_key_sql(primary_key_column)}, "_row_no" DESC
+    """, conflict_sql)
+
+    records_to_insert = [row + (row_no,) for row_no, row in enumerate(rows)]
+    if not records_to_insert:
+        return 0, 0, 0
+    counts = psycopg2.extras.execute_values(
+        cursor, upsert_query, records_to_insert, template=template, page_size=page_size, fetch=True
+    )
+    return len(records_to_insert), sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+def _upsert_unnest(cursor, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], rows, page_size: int) -> tuple:
+    """
+    Upserts all rows in one statement: each column is sent as a single typed array
+    parameter and expanded with unnest. The last row of a repeated key wins.
+    """
+    cols_sql, conflict_sql = _upsert_sql_parts(table_name, primary_key_column, column_names)
+    column_types = get_column_types(cursor, table_name, column_names)
+    arrays_sql = ", ".join(f"%s::{col_type}[]" for col_type in column_types)
+
+    columns = [list(values) for values in zip(*rows)]
+    if not columns:
+        return 0, 0, 0
+
+    def merge_sql(unnest_args):
+        return _counted_merge_sql(table_name, primary_key_column, cols_sql, f"""
+        SELECT DISTINCT ON ({_key_sql(primary_key_column)}) {cols_sql}
+        FROM unnest({unnest_args}) WITH ORDINALITY AS u ({cols_sql}, "_row_no")
+        ORDER BY {_key_sql(primary_key_column)}, "_row_no" DESC
+        """, conflict_sql)
+
+    statement = _prepared_statement(
+        cursor,
+        merge_sql(", ".join(f"${i}" for i in range(1, len(column_names) + 1))),
+        [f"{col_type}[]" for col_type in column_types]
+    )
+    if statement:
+        cursor.execute(f"EXECUTE {statement} ({arrays_sql})", columns)
+    else:
+        cursor.execute(merge_sql(arrays_sql), columns)
+    inserted, updated = cursor.fetchone()
+    return len(columns[0]), inserted, updated
+
+def _upsert_copy(cursor, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], rows, page_size: int) -> tuple:
+    """
+    Streams rows with COPY FROM STDIN into a temporary staging table and merges
+    them into table_name with a single INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+    """
+    stage_table = f"_stage_{table_name}"
+    cols_sql, conflict_sql = _upsert_sql_parts(table_name, primary_key_column, column_names)
+
+    # Временная таблица с колонками и типами целевой, без ограничений; удаляется при commit
+    cursor.execute(f'DROP TABLE IF EXISTS "{stage_table}"')
+    cursor.execute(f"""
+    CREATE TEMP TABLE "{stage_table}" ON COMMIT DROP AS
+    SELECT {cols_sql} FROM "{table_name}" WITH NO DATA;
+    """)
+    # Порядковый номер строки: при повторе ключа побеждает последняя строка, как в построчном режиме
+    cursor.execute(f'ALTER TABLE "{stage_table}" ADD COLUMN "_copy_row_no" BIGSERIAL')
+
+    reader = _CopyRowReader(rows)
+    cursor.copy_expert(f'COPY "{stage_table}" ({cols_sql}) FROM STDIN', reader)
+    if not reader.rows_read:
+        return 0, 0, 0
+
+    cursor.execute(_counted_merge_sql(table_name, primary_key_column, cols_sql, f"""
+        SELECT DISTINCT ON ({_key_sql(primary_key_column)}) {cols_sql}
+        FROM "{stage_table}"
+        ORDER BY {_key_sql(primary_key_column)}, "_copy_row_no" DESC
+    """, conflict_sql))
+    inserted, updated = cursor.fetchone()
+    return reader.rows_read, inserted, updated
+
+UPSERT_LOADER_FUNCTIONS = {
+    'batch': _upsert_batch,
+    'values': _upsert_values,
+    'unnest': _upsert_unnest,
+    'copy': _upsert_copy,
+}
+
+def choose_upsert_loader(row_count: int | None) -> str:
+    """
+    Picks a loader for the 'auto' strategy by batch size: values for small
+    batches, unnest for medium ones, copy for large or unsized (streamed) input.
+    """
+    if row_count is None or row_count > AUTO_UNNEST_MAX_ROWS:
+        return 'copy'
+    if row_count > AUTO_VALUES_MAX_ROWS:
+        return 'unnest'
+    return 'values'
+
+def _upsert_rows(data_list, column_names: list[str], run_id: str | None, detect_changes: bool) -> tuple[list[str], object]:
+    """
+    Returns the column list actually sent by the upsert and a generator of row tuples,
+    with RUN_ID_COLUMN and ROW_HASH_COLUMN values appended when requested.
+    """
+    data_columns = [col for col in column_names if col not in (RUN_ID_COLUMN, ROW_HASH_COLUMN)]
+    extra_columns = ([RUN_ID_COLUMN] if run_id is not None else []) + ([ROW_HASH_COLUMN] if detect_changes else [])
+    if not extra_columns:
+        return column_names, (tuple(record_dict.get(col) for col in column_names) for record_dict in data_list)
+
+    hashed_positions = [i for i, col in enumerate(data_columns) if col not in ROW_HASH_IGNORED_COLUMNS]
+
+    def build_rows():
+        for record_dict in data_list:
+            values = tuple(record_dict.get(col) for col in data_columns)
+            extra = (run_id,) if run_id is not None else ()
+            if detect_changes:
+                extra += (compute_row_hash(values[i] for i in hashed_positions),)
+            yield values + extra
+
+    return data_columns + extra_columns, build_rows()
+
+QUARANTINE_TABLE_SQL = f'''
+CREATE TABLE IF NOT EXISTS "{QUARANTINE_TABLE}" (
+    "id" BIGSERIAL PRIMARY KEY,
+    "table_name" TEXT NOT NULL,
+    "row_key" TEXT,
+    "row_data" JSONB NOT NULL,
+    "error" TEXT,
+    "run_id" TEXT,
+    "created_at" TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS "idx_{QUARANTINE_TABLE}_run" ON "{QUARANTINE_TABLE}" ("table_name", "run_id");
+'''
+
+def _upsert_isolating_bad_rows(cursor, loader_function, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], rows: list[tuple], page_size: int) -> tuple:
+    """
+    Runs a loader inside a savepoint. When the batch fails on bad data (DataError,
+    IntegrityError: a malformed number, an overlong string, a NULL in a NOT NULL
+    column), it is rolled back to the savepoint, split in halves and each half is
+    retried, down to single rows. k bad rows cost about 2·k·log2(n) extra statements;
+    all other rows are loaded in the same transaction.
+    Raises the error if more than SUPABASE_QUARANTINE_MAX_ROWS rows fail.
+    Returns (sent, inserted, updated, [(row, error message)]).
+    """
+    totals = [0, 0, 0]
+    bad_rows = []
+    pending = [rows]
+    while pending:
+        part = pending.pop()
+        cursor.execute("SAVEPOINT planfix_upsert_part")
+        try:
+            counts = loader_function(cursor, table_name, primary_key_column, column_names, part, page_size)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT planfix_upsert_part")
+            if len(part) == 1:
+                bad_rows.append((part[0], str(e).strip()))
+                if len(bad_rows) > SUPABASE_QUARANTINE_MAX_ROWS:
+                    logger.error(f"More than {SUPABASE_QUARANTINE_MAX_ROWS} rows of '{table_name}' failed, giving up.")
+                    raise
+                continue
+            if part is rows:
+                logger.warning(f"Batch of {len(rows)} rows for '{table_name}' failed ({str(e).strip()}), isolating bad rows...")
+            middle = len(part) // 2
+            # Первая половина обрабатывается первой
+            pending.append(part[middle:])
+            pending.append(part[:middle])
+            continue
+        cursor.execute("RELEASE SAVEPOINT planfix_upsert_part")
+        for i, count in enumerate(counts):
+            totals[i] = None if totals[i] is None or count is None else totals[i] + count
+    return totals[0], totals[1], totals[2], bad_rows
+
+def _quarantine_rows(cursor, table_name: str, column_names: list[str], key_positions: list[int], bad_rows: list, run_id: str | None) -> None:
+    """Stores rows that could not be loaded, with their errors, in QUARANTINE_TABLE."""
+    cursor.execute(QUARANTINE_TABLE_SQL)
+    dumps = lambda value: json.dumps(value, ensure_ascii=False, default=str)
+    psycopg2.extras.execute_values(cursor, f'''
+        INSERT INTO "{QUARANTINE_TABLE}" ("table_name", "row_key", "row_data", "error", "run_id") VALUES %s
+    ''', [
+        (
+            table_name,
+            "_".join(str(row[i]) for i in key_positions),
+            psycopg2.extras.Json(dict(zip(column_names, row)), dumps=dumps),
+            error,
+            run_id,
+        )
+        for row, error in bad_rows
+    ])
+    for row, error in bad_rows:
+        logger.warning(
+            f"Quarantined row {'_'.join(str(row[i]) for i in key_positions)} of '{table_name}' "
+            f"in '{QUARANTINE_TABLE}': {error}"
+        )
+
+def get_quarantined_rows(conn, table_name: str, run_id: str) -> list[dict]:
+    """Returns the data of the rows of table_name quarantined in a run."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f'SELECT "row_data" FROM "{QUARANTINE_TABLE}" WHERE "table_name" = %s AND "run_id" = %s',
+                (table_name, run_id)
+            )
+            rows = [row[0] for row in cur.fetchall()]
+        conn.commit()
+        return rows
+    except psycopg2.errors.UndefinedTable:
+        conn.rollback()
+        return []
+
+def collapse_duplicate_keys(rows, key_positions: list[int]) -> tuple[list[tuple], int]:
+    """
+    Keeps only the last row of every conflict key, in one pass with one dict entry
+    per distinct key. A single INSERT ... ON CONFLICT DO UPDATE fails when it would
+    update the same row twice ("cannot affect row a second time").
+    Rows stay at the position of the first occurrence of their key.
+    Returns (rows, number of collapsed rows).
+    """
+    key_of = operator.itemgetter(*key_positions)
+    latest = {}
+    total = 0
+    for row in rows:
+        latest[key_of(row)] = row
+        total += 1
+    return list(latest.values()), total - len(latest)
+
+def upsert_data_to_supabase(conn: psycopg2.extensions.connection, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], data_list, loader: str | None = None, page_size: int | None = None, run_id: str | None = None, detect_changes: bool = False, quarantine: bool = False) -> dict:
     """
     Upserts data into a Supabase table.
-    data_list items already include 'updated_at' and 'is_deleted'.
+    primary_key_column is the ON CONFLICT key: a column name or a tuple of column names.
+    data_list is a list or any iterable of dicts; items already include 'updated_at' and 'is_deleted'.
+    loader selects how rows are sent (see UPSERT_LOADERS, default from SUPABASE_LOADER);
+    page_size is the number of rows per statement for 'batch' and 'values'
+    (default from SUPABASE_PAGE_SIZE).
+    Rows repeating a conflict key are collapsed before loading, the last one wins
+    (see collapse_duplicate_keys); pass large streams through upsert_stream_to_supabase,
+    which hands over one chunk at a time.
+    When run_id is given, every written row is stamped with it in RUN_ID_COLUMN.
+    With detect_changes, a content hash of each row is stored in ROW_HASH_COLUMN and
+    existing rows whose hash did not change are left untouched (not even stamped, so
+    soft-delete has to receive their keys). Both columns must exist.
+    With quarantine, a batch failing on bad data is bisected down to the offending
+    rows, which are stored in QUARANTINE_TABLE with their errors; the rest is committed.
+    Returns {'rows', 'inserted', 'updated', 'unchanged', 'collapsed', 'quarantined'}:
+    rows loaded, inserted, updated and left unchanged by the hash check, the number
+    of collapsed repeats and of quarantined rows.
     Logs information about the upsert process and errors.
     """
-    if not data_list:
+    if isinstance(data_list, (list, tuple)) and not data_list:
         logger.info(f"No data provided for upsert to table {table_name}. Skipping.")
-        return
+        return {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'collapsed': 0, 'quarantined': 0}
+
+    loader = (loader or SUPABASE_LOADER).lower()
+    if loader not in UPSERT_LOADERS:
+        raise ValueError(f"Unknown upsert loader '{loader}'. Expected one of: {', '.join(UPSERT_LOADERS)}")
+    row_count = len(data_list) if hasattr(data_list, '__len__') else None
+    if loader == 'auto':
+        loader = choose_upsert_loader(row_count)
+    page_size = page_size or SUPABASE_PAGE_SIZE
 
-    logger.info(f"Starting upsert process for {len(data_list)} records into table '{table_name}'.")
+    size_info = f"{row_count} records" if row_count is not None else "streamed records"
+    logger.info(f"Starting upsert process for {size_info} into table '{table_name}' (loader: {loader}).")
     
     cursor = None # Initialize cursor to None for finally block
     try:
         cursor = conn.cursor()
-        
-        cols_sql = ", ".join([f'"{col}"' for col in column_names])
-        placeholders_sql = ", ".join(["%s"] * len(column_names))
-        update_cols = [col for col in column_names if col != primary_key_column]
-        update_set_sql = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in update_cols])
-
-        upsert_query = f"""
-        INSERT INTO "{table_name}" ({cols_sql})
-        VALUES ({placeholders_sql})
-        ON CONFLICT ("{primary_key_column}") DO UPDATE SET
-        {update_set_sql};
-        """
-        
-        records_to_insert = []
-        for record_dict in data_list:
-            record_values = [record_dict.get(col) for col in column_names]
-            records_to_insert.append(tuple(record_values))
-
-        if records_to_insert:
-            # logger.debug(f"Upsert query: {upsert_query}")
-            # logger.debug(f"First record to upsert (sample): {records_to_insert[0]}")
-            psycopg2.extras.execute_batch(cursor, upsert_query, records_to_insert)
-            logger.info(f"Successfully upserted {len(records_to_insert)} records to table '{table_name}'.")
 
+        column_names, rows = _upsert_rows(data_list, column_names, run_id, detect_changes)
+        key_positions = [column_names.index(col) for col in _key_columns(primary_key_column)]
+        rows, collapsed = collapse_duplicate_keys(rows, key_positions)
+        if collapsed:
+            logger.warning(f"Collapsed {collapsed} rows repeating a key of '{table_name}' (the last occurrence is kept).")
+        loader_function = UPSERT_LOADER_FUNCTIONS[loader]
+        bad_rows = []
+        if quarantine:
+            sent, inserted, updated, bad_rows = _upsert_isolating_bad_rows(
+                cursor, loader_function, table_name, primary_key_column, column_names, rows, page_size
+            )
+            if bad_rows:
+                _quarantine_rows(cursor, table_name, column_names, key_positions, bad_rows, run_id)
+        else:
+            sent, inserted, updated = loader_function(cursor, table_name, primary_key_column, column_names, rows, page_size)
         conn.commit()
+
+        stats = {
+            'rows': sent, 'inserted': inserted, 'updated': updated, 'unchanged': None,
+            'collapsed': collapsed, 'quarantined': len(bad_rows),
+        }
+        if inserted is not None:
+            stats['unchanged'] = sent - inserted - updated
+            logger.info(
+                f"Successfully upserted {sent} records to table '{table_name}': "
+                f"{inserted} inserted, {updated} updated, {stats['unchanged']} unchanged."
+            )
+        elif sent:
+            logger.info(f"Successfully upserted {sent} records to table '{table_name}'.")
+        else:
+            logger.info(f"No data provided for upsert to table {table_name}. Skipping.")
+        return stats
     except psycopg2.Error as e:
         logger.error(f"Database error during upsert to table '{table_name}': {e}")
         if conn:
@@ -267,6 +1055,146 @@ def upsert_data_to_supabase(conn: psycopg2.extensions.connection, table_name: st
         if cursor:
             cursor.close()
 
+def upsert_stream_to_supabase(conn: psycopg2.extensions.connection, table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], records, chunk_size: int | None = None, loader: str | None = None, run_id: str | None = None, detect_changes: bool = False, quarantine: bool = False) -> dict:
+    """
+    Upserts an iterator of record dicts in chunks of chunk_size (default from
+    SUPABASE_CHUNK_SIZE), committing each chunk in its own transaction.
+    Only one chunk is held in memory at a time. A failing chunk is rolled back and
+    the error is raised; the chunks before it stay committed.
+    Logs throughput per chunk and returns the summed upsert_data_to_supabase stats
+    plus the number of chunks.
+    """
+    chunk_size = chunk_size or SUPABASE_CHUNK_SIZE
+    totals = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'collapsed': 0, 'quarantined': 0, 'chunks': 0}
+    records = iter(records)
+    started = time.perf_counter()
+
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        chunk_started = time.perf_counter()
+        stats = upsert_data_to_supabase(
+            conn, table_name, primary_key_column, column_names, chunk,
+            loader=loader, run_id=run_id, detect_changes=detect_changes, quarantine=quarantine
+        )
+        elapsed = time.perf_counter() - chunk_started
+        totals['chunks'] += 1
+        for key in ('rows', 'inserted', 'updated', 'unchanged', 'collapsed', 'quarantined'):
+            if totals[key] is not None and stats[key] is not None:
+                totals[key] += stats[key]
+            else:
+                totals[key] = None
+        logger.info(
+            f"Chunk {totals['chunks']} of '{table_name}': {stats['rows']} rows in {elapsed:.2f}s "
+            f"({stats['rows'] / elapsed if elapsed else 0:.0f} rows/s), {totals['rows']} rows committed so far."
+        )
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Streamed {totals['rows']} rows into '{table_name}' in {totals['chunks']} chunks, "
+        f"{elapsed:.2f}s ({totals['rows'] / elapsed if elapsed else 0:.0f} rows/s)."
+    )
+    return totals
+
+def key_partition(record: dict, key_columns: list[str], partitions: int) -> int:
+    """Returns the partition (0..partitions-1) of a record by a stable hash of its conflict key."""
+    key = json.dumps([record.get(col) for col in key_columns], ensure_ascii=False, default=str)
+    return zlib.crc32(key.encode('utf-8')) % partitions
+
+def upsert_parallel_to_supabase(table_name: str, primary_key_column: str | tuple[str, ...], column_names: list[str], records, workers: int | None = None, chunk_size: int | None = None, loader: str | None = None, run_id: str | None = None, detect_changes: bool = False, quarantine: bool = False) -> dict:
+    """
+    Upserts an iterator of record dicts over several pooled connections at once
+    (workers, default from SUPABASE_WRITE_WORKERS).
+    Records are partitioned by a hash of the conflict key, so every key is written by
+    exactly one worker and concurrent transactions never touch the same row.
+    Each worker streams its partition with upsert_stream_to_supabase on its own
+    pooled connection; the caller is assumed to hold one more connection, so at most
+    SUPABASE_POOL_SIZE - 1 workers are started.
+    If a worker fails, distribution stops, the other workers finish their queued
+    records and the first error is raised; chunks committed before it stay committed.
+    Run-wide steps (such as mark_items_as_deleted_in_supabase) must run after it returns.
+    Returns the summed stats of the workers plus 'workers'.
+    """
+    workers = workers or SUPABASE_WRITE_WORKERS
+    if workers >= SUPABASE_POOL_SIZE:
+        logger.warning(
+            f"{workers} write workers do not fit into the connection pool (SUPABASE_POOL_SIZE={SUPABASE_POOL_SIZE}), "
+            f"using {max(1, SUPABASE_POOL_SIZE - 1)}"
+        )
+        workers = max(1, SUPABASE_POOL_SIZE - 1)
+    chunk_size = chunk_size or SUPABASE_CHUNK_SIZE
+    key_columns = _key_columns(primary_key_column)
+
+    # Очередь каждого потока ограничена одной пачкой: записи не копятся в памяти,
+    # если загрузка медленнее разбора
+    queues = [queue.Queue(maxsize=chunk_size) for _ in range(workers)]
+    results = [None] * workers
+    errors = [None] * workers
+    failed = threading.Event()
+    done = object()
+
+    def queued_records(records_queue):
+        while True:
+            record = records_queue.get()
+            if record is done:
+                return
+            yield record
+
+    def work(index):
+        partition_records = queued_records(queues[index])
+        try:
+            with supabase_connection() as conn:
+                results[index] = upsert_stream_to_supabase(
+                    conn, table_name, primary_key_column, column_names, partition_records,
+                    chunk_size=chunk_size, loader=loader, run_id=run_id, detect_changes=detect_changes,
+                    quarantine=quarantine
+                )
+        except Exception as e:
+            logger.error(f"Write worker {index + 1}/{workers} for '{table_name}' failed: {e}")
+            errors[index] = e
+            failed.set()
+            # Дочитываем очередь, чтобы распределение записей не заблокировалось
+            for _ in partition_records:
+                pass
+
+    logger.info(f"Starting parallel upsert into '{table_name}' with {workers} workers.")
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=work, args=(index,), name=f"upsert-{table_name}-{index + 1}", daemon=True)
+        for index in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for record in records:
+            if failed.is_set():
+                break
+            queues[key_partition(record, key_columns, workers)].put(record)
+    finally:
+        for records_queue in queues:
+            records_queue.put(done)
+        for thread in threads:
+            thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    totals = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'collapsed': 0, 'quarantined': 0, 'chunks': 0, 'workers': workers}
+    for stats in results:
+        for key in ('rows', 'inserted', 'updated', 'unchanged', 'collapsed', 'quarantined', 'chunks'):
+            if totals[key] is not None and stats[key] is not None:
+                totals[key] += stats[key]
+            else:
+                totals[key] = None
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Parallel upsert of {totals['rows']} rows into '{table_name}' with {workers} workers "
+        f"finished in {elapsed:.2f}s ({totals['rows'] / elapsed if elapsed else 0:.0f} rows/s)."
+    )
+    return totals
+
 def add_missing_columns(conn, table_name, expected_columns_map):
     """
     Checks if all expected columns exist in the table and adds any missing ones.
@@ -308,10 +1236,16 @@ def add_missing_columns(conn, table_name, expected_columns_map):
         conn.rollback()
         raise
 
-def mark_items_as_deleted_in_supabase(conn: psycopg2.extensions.connection, table_name: str, id_column_name: str, actual_ids: list[int | str]) -> None:
+def mark_items_as_deleted_in_supabase(conn: psycopg2.extensions.connection, table_name: str, id_column_name: str, actual_ids: list[int | str], scope: dict | None = None, reset_row_hash: bool = False) -> int:
     """
     Marks items as deleted in Supabase table if their IDs are not in actual_ids list.
-    Logs the process and any errors.
+    actual_ids are streamed with COPY into a temporary table and anti-joined, so the
+    statement does not grow with the number of IDs. actual_ids must hold every live
+    ID: rows left unchanged by upsert_data_to_supabase keep their old run ID.
+    scope ({column: value}) limits the update to matching rows, e.g. one handbook.
+    reset_row_hash clears ROW_HASH_COLUMN, so a row that comes back unchanged is
+    rewritten with is_deleted = FALSE instead of being skipped as unchanged.
+    Logs the process and any errors. Returns the number of rows marked as deleted.
     """
     logger.info(f"Starting process to mark items as deleted in table '{table_name}'.")
     logger.info(f"Number of actual (active) IDs received: {len(actual_ids)} for table '{table_name}'.")
@@ -319,33 +1253,39 @@ def mark_items_as_deleted_in_supabase(conn: psycopg2.extensions.connection, tabl
     cursor = None
     try:
         cursor = conn.cursor()
-        if not actual_ids: 
-            update_query = f"""
-            UPDATE "{table_name}"
-            SET is_deleted = TRUE, updated_at = NOW()
-            WHERE is_deleted = FALSE; 
-            """
-            logger.info(f"actual_ids list is empty. Marking all non-deleted items in '{table_name}' as deleted.")
-            cursor.execute(update_query)
+        conditions = ['t."is_deleted" = FALSE']
+        params = []
+
+        for column, value in (scope or {}).items():
+            conditions.append(f't."{column}" = %s')
+            params.append(value)
+
+        if actual_ids:
+            keys_table = f"_live_keys_{table_name}"
+            cursor.execute(f'DROP TABLE IF EXISTS "{keys_table}"')
+            cursor.execute(f"""
+            CREATE TEMP TABLE "{keys_table}" ON COMMIT DROP AS
+            SELECT "{id_column_name}" FROM "{table_name}" WITH NO DATA;
+            """)
+            cursor.copy_expert(f'COPY "{keys_table}" ("{id_column_name}") FROM STDIN', _CopyRowReader((key,) for key in actual_ids))
+            # Статистика временной таблицы нужна планировщику для hash anti join
+            cursor.execute(f'ANALYZE "{keys_table}"')
+            conditions.append(f'NOT EXISTS (SELECT 1 FROM "{keys_table}" k WHERE k."{id_column_name}" = t."{id_column_name}")')
         else:
-            ids_tuple = tuple(actual_ids)
-            if not ids_tuple: # Should be caught by 'if not actual_ids' but as a safeguard
-                logger.warning(f"actual_ids list resulted in an empty tuple for table {table_name}. No items will be marked as deleted based on 'NOT IN ()' clause, which could be problematic.")
-                # This path should ideally not be hit if `actual_ids` is truly empty due to the above `if not actual_ids`.
-                # If `actual_ids` contains items that result in an empty tuple (e.g. list of Nones, though type hints suggest int/str),
-                # then this warning is relevant.
-            
-            update_query = f"""
-            UPDATE "{table_name}"
-            SET is_deleted = TRUE, updated_at = NOW()
-            WHERE "{id_column_name}" NOT IN %s AND is_deleted = FALSE;
-            """
-            # logger.debug(f"Marking items as deleted query: {update_query} with {len(ids_tuple)} IDs.")
-            cursor.execute(update_query, (ids_tuple,))
+            logger.info(f"actual_ids list is empty. Marking all non-deleted items in '{table_name}' as deleted.")
+
+        reset_sql = f', "{ROW_HASH_COLUMN}" = NULL' if reset_row_hash else ''
+        update_query = f"""
+        UPDATE "{table_name}" t
+        SET is_deleted = TRUE, updated_at = NOW(){reset_sql}
+        WHERE {' AND '.join(conditions)};
+        """
+        cursor.execute(update_query, params)
 
         deleted_count = cursor.rowcount
         conn.commit()
         logger.info(f"Successfully marked {deleted_count} items as deleted in '{table_name}'.")
+        return deleted_count
 
     except Exception as e:
         if conn:
@@ -372,4 +1312,57 @@ def parse_planfix_date_string(date_str: str | None) -> datetime | None:
         except ValueError:
             continue
     logger.warning(f"Could not parse date string '{date_str}' with known formats.")
-    return None 
\ No newline at end of file
+    return None 
+
+def clean_field_name(field_name):
+    """
+    Очищает название поля для использования в SQL
+    """
+    # Заменяем польские символы и специальные символы
+    replacements = {
+        'ą': 'a', 'ć': 'c', 'ę': 'e', 'ł': 'l', 'ń': 'n', 'ó': 'o', 'ś': 's', 'ź': 'z', 'ż': 'z',
+        'Ą': 'A', 'Ć': 'C', 'Ę': 'E', 'Ł': 'L', 'Ń': 'N', 'Ó': 'O', 'Ś': 'S', 'Ź': 'Z', 'Ż': 'Z',
+        ' ': '_', '-': '_', '.': '_', ',': '_', '%': 'procent'
+    }
+    
+    clean_name = field_name
+    for old, new in replacements.items():
+        clean_name = clean_name.replace(old, new)
+    
+    # Убираем все неалфавитно-цифровые символы
+    clean_name = ''.join(c for c in clean_name if c.isalnum() or c == '_')
+    
+    # Приводим к нижнему регистру
+    return clean_name.lower()
+
+def convert_polish_number(value):
+    """
+    Преобразует польские числа (запятая как разделитель) в английский формат (точка как разделитель)
+    для корректной записи в Supabase numeric поля
+    """
+    if not value or value == '':
+        return None
+    
+    try:
+        # Убираем пробелы
+        value = str(value).strip()
+        
+        # Если пустая строка, возвращаем None
+        if value == '':
+            return None
+        
+        # Заменяем запятую на точку
+        value = value.replace(',', '.')
+        
+        # Убираем лишние пробелы
+        value = value.replace(' ', '')
+        
+        # Проверяем, что это число
+        float(value)
+        
+        return value
+        
+    except (ValueError, TypeError):
+        # Если не удалось преобразовать в число, возвращаем None
+        logger.warning(f"Could not convert value '{value}' to number, setting to None")
+        return None
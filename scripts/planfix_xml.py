@@ -0,0 +1,170 @@
+"""
+Слой парсинга XML-ответов Planfix.
+
+Все скрипты разбирают ответы API через этот модуль, а не напрямую через
+xml.etree.ElementTree. Бэкенд выбирается переменной окружения
+PLANFIX_XML_BACKEND:
+  stdlib — xml.etree.ElementTree (C-ускоритель _elementtree), по умолчанию;
+  lxml   — lxml.etree (libxml2);
+  auto   — lxml, если он установлен, иначе stdlib.
+
+lxml быстрее разбирает сам документ, но обход дерева через findtext/findall
+у него медленнее (на каждый элемент создается прокси-объект), поэтому на
+страницах analitic.getDataByCondition stdlib в итоге выигрывает. Перед
+переключением сравните бэкенды на своих ответах:
+scripts/benchmark_xml_parsers.py.
+"""
+
+import os
+import logging
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml — необязательная зависимость
+    lxml_etree = None
+
+logger = logging.getLogger(__name__)
+
+
+class StdlibXmlBackend:
+    """Бэкенд на xml.etree.ElementTree (всегда доступен)."""
+
+    name = 'stdlib'
+    parse_errors = (ET.ParseError,)
+
+    def fromstring(self, data):
+        return ET.fromstring(data)
+
+    def tostring(self, element):
+        return ET.tostring(element, encoding='unicode')
+
+
+class LxmlXmlBackend:
+    """Бэкенд на lxml.etree. API элементов совместим с ElementTree."""
+
+    name = 'lxml'
+
+    def __init__(self):
+        if lxml_etree is None:
+            raise ImportError("lxml is not installed")
+        self.parse_errors = (lxml_etree.XMLSyntaxError,)
+        # huge_tree снимает ограничение libxml2 на размер текстовых узлов
+        # (длинные description в task.getList), сущности не разворачиваем.
+        self._parser = lxml_etree.XMLParser(resolve_entities=False, huge_tree=True)
+
+    def fromstring(self, data):
+        # lxml не принимает str с объявлением encoding — передаем байты
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return lxml_etree.fromstring(data, self._parser)
+
+    def tostring(self, element):
+        return lxml_etree.tostring(element, encoding='unicode')
+
+
+XML_BACKENDS = {
+    StdlibXmlBackend.name: StdlibXmlBackend,
+    LxmlXmlBackend.name: LxmlXmlBackend,
+}
+
+
+def get_xml_backend(name: str | None = None):
+    """
+    Returns an XML backend instance by name ('auto', 'lxml' or 'stdlib').
+    'auto' picks lxml when it is installed and falls back to the stdlib.
+    """
+    name = (name or StdlibXmlBackend.name).lower()
+    if name == 'auto':
+        name = LxmlXmlBackend.name if lxml_etree is not None else StdlibXmlBackend.name
+    if name not in XML_BACKENDS:
+        raise ValueError(f"Unknown XML backend '{name}'. Expected one of: auto, {', '.join(XML_BACKENDS)}")
+    return XML_BACKENDS[name]()
+
+
+_backend = get_xml_backend(os.environ.get('PLANFIX_XML_BACKEND'))
+logger.debug(f"Using '{_backend.name}' XML backend")
+
+# Исключения парсинга всех доступных бэкендов, для использования в except
+ParseError = (ET.ParseError,) + ((lxml_etree.XMLSyntaxError,) if lxml_etree is not None else ())
+
+
+def set_xml_backend(name: str) -> None:
+    """Switches the module-wide XML backend (used by benchmarks)."""
+    global _backend
+    _backend = get_xml_backend(name)
+    logger.info(f"Switched to '{_backend.name}' XML backend")
+
+
+def backend_name() -> str:
+    """Returns the name of the active XML backend."""
+    return _backend.name
+
+
+def fromstring(data):
+    """Parses an XML document (str or bytes) with the active backend."""
+    return _backend.fromstring(data)
+
+
+def tostring(element) -> str:
+    """Serializes an element produced by the active backend to a string."""
+    return _backend.tostring(element)
+
+
+def get_parse_workers() -> int:
+    """
+    Returns the number of parse worker processes from PLANFIX_PARSE_WORKERS.
+    0 (default) means parsing inline in the main process.
+    """
+    value = os.environ.get('PLANFIX_PARSE_WORKERS', '0').strip()
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        logger.warning(f"Invalid PLANFIX_PARSE_WORKERS value '{value}', parsing inline")
+        return 0
+
+
+class ParsePool:
+    """
+    Необязательная стадия парсинга в пуле процессов.
+
+    Парсинг больших страниц упирается в GIL, поэтому сырые байты ответа
+    отправляются в процессы-воркеры, а обратно возвращаются компактные
+    кортежи строк. Функция парсинга должна быть объявлена на уровне модуля
+    (передается в воркер через pickle). При workers=0 разбор выполняется
+    сразу в основном процессе, а submit возвращает уже завершенный Future.
+    """
+
+    def __init__(self, workers: int | None = None):
+        self.workers = get_parse_workers() if workers is None else max(workers, 0)
+        self._executor = None
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"Parsing responses in a pool of {self.workers} worker processes")
+
+    @property
+    def parallel(self) -> bool:
+        return self._executor is not None
+
+    def submit(self, func, data) -> Future:
+        """Schedules func(data) and returns a Future with its result."""
+        if self._executor is not None:
+            return self._executor.submit(func, data)
+        future = Future()
+        try:
+            future.set_result(func(data))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,187 @@
+"""Тесты описания полей аналитики и декодера строк (без Planfix и Supabase)."""
+
+import pickle
+
+import pytest
+import requests
+
+import scripts.benchmark_xml_parsers as benchmark_xml_parsers
+import scripts.planfix_analytic_registry as planfix_analytic_registry
+
+ERROR_RESPONSE = '<response status="error"><code>0019</code><message>limit</message></response>'
+
+
+def analytics_page(*rows):
+    """Страница analitic.getDataByCondition: rows — (key, task_id, action_id, [(ID поля, value, valueId)])."""
+    items_xml = []
+    for key, task_id, action_id, items in rows:
+        fields_xml = ''.join(
+            f'<itemData><id>{field_id}</id><value>{value}</value>'
+            + (f'<valueId>{value_id}</valueId>' if value_id else '')
+            + '</itemData>'
+            for field_id, value, value_id in items
+        )
+        items_xml.append(
+            f'<analiticData><key>{key}</key><task><id>{task_id}</id></task>'
+            f'<action><id>{action_id}</id></action>{fields_xml}</analiticData>'
+        )
+    return f'<response status="ok"><analiticDatas>{"".join(items_xml)}</analiticDatas></response>'
+
+
+@pytest.fixture
+def definition():
+    return planfix_analytic_registry.parse_analytic_options(
+        benchmark_xml_parsers.build_analytic_options_payload(), 4867
+    )
+
+
+def test_parse_analytic_options(definition):
+    assert definition.analytic_id == 4867
+    assert definition.name == 'Produkty'
+    assert [field['id'] for field in definition.fields] == list(benchmark_xml_parsers.SYNTHETIC_PRODUKTY_FIELDS)
+    nazwa = definition.fields[0]
+    assert nazwa == {'id': '27719', 'name': 'Nazwa', 'type': 11, 'handbook_id': '512', 'formula': False}
+
+
+def test_parse_analytic_options_rejects_error_and_empty_responses():
+    with pytest.raises(ValueError, match='code=0019'):
+        planfix_analytic_registry.parse_analytic_options(ERROR_RESPONSE, 4867)
+    with pytest.raises(ValueError, match='no fields'):
+        planfix_analytic_registry.parse_analytic_options(
+            '<response status="ok"><analitic><id>1</id><fields/></analitic></response>', 1
+        )
+
+
+def test_known_fields_keep_the_columns_of_the_exporter(definition):
+    assert definition.column_types() == {
+        'nazwa': 'TEXT',
+        'nazwa_handbook_id': 'TEXT',
+        'cena': 'NUMERIC',
+        'waluta': 'TEXT',
+        'ilosc': 'NUMERIC',
+        'rabat_procent': 'NUMERIC',
+        'cena_po_rabacie': 'NUMERIC',
+        'wartosc_netto': 'NUMERIC',
+        'prowizja_pln': 'NUMERIC',
+        'laczna_masa_kg': 'NUMERIC',
+    }
+
+
+def test_assign_columns_survives_renames_and_unknown_type_codes():
+    fields = [{'id': '27721', 'name': 'Cena jednostkowa', 'type': 99, 'formula': False}]
+
+    assigned = planfix_analytic_registry.assign_columns(fields)
+
+    assert assigned == {'27721': {'column': 'cena', 'kind': 'number', 'type': 99}}
+
+
+def test_assign_columns_keeps_assigned_column_after_rename():
+    assigned = planfix_analytic_registry.assign_columns([{'id': '50001', 'name': 'Uwagi', 'type': 0}])
+    renamed = [{'id': '50001', 'name': 'Uwagi klienta', 'type': 0}]
+
+    assert planfix_analytic_registry.assign_columns(renamed, assigned)['50001']['column'] == 'uwagi'
+
+
+def test_assign_columns_suffixes_clashing_columns():
+    fields = [
+        {'id': '27721', 'name': 'Cena', 'type': 1},
+        {'id': '50002', 'name': 'Cena', 'type': 1},
+    ]
+
+    assigned = planfix_analytic_registry.assign_columns(fields)
+
+    assert assigned['50002']['column'] == 'cena_50002'
+
+
+def test_assign_columns_keeps_the_kind_of_the_column_when_the_type_changes(caplog):
+    assigned = planfix_analytic_registry.assign_columns([{'id': '50003', 'name': 'Masa', 'type': 1}])
+
+    with caplog.at_level('ERROR', logger=planfix_analytic_registry.logger.name):
+        changed = planfix_analytic_registry.assign_columns([{'id': '50003', 'name': 'Masa', 'type': 0}], assigned)
+
+    assert changed['50003'] == {'column': 'masa', 'kind': 'number', 'type': 1}
+    assert '50003' in caplog.text
+    # Смена кода типа без смены типа значения допустима
+    assert planfix_analytic_registry.assign_columns(
+        [{'id': '50003', 'name': 'Masa', 'type': 0, 'formula': True}], assigned
+    )['50003'] == {'column': 'masa', 'kind': 'number', 'type': 0}
+
+
+def test_seeded_handbook_field_always_has_a_handbook_id_column():
+    fields = [{'id': '27719', 'name': 'Nazwa', 'type': 0, 'handbook_id': None, 'formula': False}]
+
+    definition = planfix_analytic_registry.AnalyticDefinition(4867, 'Produkty', fields)
+
+    assert definition.column_types() == {'nazwa': 'TEXT', 'nazwa_handbook_id': 'TEXT'}
+    assert definition.fields_structure()['Nazwa']['has_value_id']
+
+
+def test_first_run_falls_back_to_the_known_fields(monkeypatch):
+    def fail(analytic_id):
+        raise requests.exceptions.ConnectionError('down')
+
+    monkeypatch.setattr(planfix_analytic_registry, 'load_stored_definition', lambda conn, analytic_id: None)
+    monkeypatch.setattr(planfix_analytic_registry, 'fetch_analytic_definition', fail)
+    monkeypatch.setattr(planfix_analytic_registry, 'store_definition', lambda conn, definition: pytest.fail('stored'))
+
+    definition = planfix_analytic_registry.get_analytic_definition(None, 4867)
+
+    assert definition.column_types() == {
+        'nazwa': 'TEXT',
+        'nazwa_handbook_id': 'TEXT',
+        'cena': 'NUMERIC',
+        'waluta': 'TEXT',
+        'ilosc': 'NUMERIC',
+        'rabat_procent': 'NUMERIC',
+        'cena_po_rabacie': 'NUMERIC',
+        'wartosc_netto': 'NUMERIC',
+        'prowizja_pln': 'NUMERIC',
+        'laczna_masa_kg': 'NUMERIC',
+    }
+
+
+def test_decoder_converts_values_by_kind(definition):
+    decoder = definition.decoder()
+    page = analytics_page(
+        ('200000', '100000', '300000', [('27719', 'Produkt', '31337'), ('27721', '1 234,50', None)]),
+        ('200001', '', '', []),
+    )
+
+    rows = decoder(page)
+
+    first = dict(zip(decoder.row_fields, rows[0]))
+    assert first['analytic_key'] == '200000'
+    assert first['task_id'] == 100000
+    assert first['action_id'] == 300000
+    assert first['nazwa'] == 'Produkt'
+    assert first['nazwa_handbook_id'] == '31337'
+    assert first['cena'] == '1234.50'
+    assert first['ilosc'] is None
+    second = dict(zip(decoder.row_fields, rows[1]))
+    assert second['task_id'] is None and second['cena'] is None
+
+
+def test_decoder_matches_benchmark_payload(definition):
+    decoder = definition.decoder()
+
+    rows = decoder(benchmark_xml_parsers.build_analytics_by_condition_payload(row_count=3))
+
+    assert len(rows) == 3
+    record = dict(zip(decoder.row_fields, rows[0]))
+    assert record['cena'] == '12.50'
+    assert record['waluta'] == 'PLN'
+    assert record['laczna_masa_kg'] == '3.2'
+
+
+def test_decoder_raises_on_error_response(definition):
+    with pytest.raises(ValueError, match='code=0019'):
+        definition.decoder()(ERROR_RESPONSE)
+
+
+def test_decoder_is_picklable(definition):
+    decoder = definition.decoder()
+
+    restored = pickle.loads(pickle.dumps(decoder))
+
+    assert restored.row_fields == decoder.row_fields
+    assert restored(analytics_page(('1', '2', '3', []))) == decoder(analytics_page(('1', '2', '3', [])))
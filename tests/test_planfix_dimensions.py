@@ -0,0 +1,55 @@
+"""Тесты строк таблиц измерений planfix_orders и planfix_clients (без Planfix и Supabase)."""
+
+from datetime import datetime
+
+import scripts.planfix_dimensions as planfix_dimensions
+import scripts.planfix_utils as planfix_utils
+
+TASKS = [
+    {
+        'id': 100001, 'name': 'Zamówienie', 'number': '1', 'order_number': '123/2025',
+        'status': 3, 'status_name': 'W realizacji', 'template_id': 501,
+        'client_id': 7, 'client_name': 'Firma', 'begin_datetime': '01-03-2025 10:00',
+    },
+    {
+        'id': 100002, 'name': 'Inne', 'number': '2', 'order_number': '124/2025',
+        'status': 4, 'template_id': 502, 'client_id': 7, 'client_name': 'Firma Sp. z o.o.',
+    },
+    {'id': 100003, 'name': 'Bez klienta', 'status': None},
+]
+
+
+def test_order_rows_fill_missing_status_names_from_the_cache(monkeypatch):
+    calls = []
+
+    def get_status_name(status_id, template_ids=None):
+        calls.append((status_id, template_ids))
+        return 'Zrealizowane'
+
+    monkeypatch.setattr(planfix_utils, 'get_planfix_status_name', get_status_name)
+
+    rows = planfix_dimensions.build_order_rows(TASKS)
+
+    assert [row['status_name'] for row in rows] == ['W realizacji', 'Zrealizowane', None]
+    # Кеш спрашивается только для заказа без названия статуса, с шаблонами всех заказов
+    assert calls == [('4', ['501', '502'])]
+    assert rows[0]['begin_datetime'] == datetime(2025, 3, 1, 10, 0)
+    assert rows[1]['begin_datetime'] is None
+    assert all(set(row) == set(planfix_dimensions.ORDER_COLUMNS) for row in rows)
+    assert not any(row['is_deleted'] for row in rows)
+
+
+def test_client_rows_are_deduplicated_by_last_order():
+    rows = planfix_dimensions.build_client_rows(TASKS)
+
+    assert [(row['client_id'], row['name']) for row in rows] == [(7, 'Firma Sp. z o.o.')]
+    assert set(rows[0]) == set(planfix_dimensions.CLIENT_COLUMNS)
+
+
+def test_empty_order_list_marks_nothing_deleted(monkeypatch):
+    def mark_deleted(*args, **kwargs):
+        raise AssertionError('orders marked deleted for an empty list')
+
+    monkeypatch.setattr(planfix_utils, 'mark_items_as_deleted_in_supabase', mark_deleted)
+
+    assert planfix_dimensions.mark_missing_orders_deleted(None, []) == 0
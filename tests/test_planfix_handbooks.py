@@ -0,0 +1,77 @@
+"""Тесты разбора записей справочника и подстановки атрибутов (без Planfix и Supabase)."""
+
+import pytest
+
+import scripts.planfix_handbooks as planfix_handbooks
+
+
+def handbook_page(*records):
+    """Страница handbook.getRecords: records — (key, parentKey, isGroup, [(поле, value, text)])."""
+    records_xml = []
+    for key, parent_key, is_group, values in records:
+        values_xml = ''.join(
+            f'<customValue><field><name>{name}</name></field><value>{value}</value>'
+            + (f'<text>{text}</text>' if text else '')
+            + '</customValue>'
+            for name, value, text in values
+        )
+        records_xml.append(
+            f'<record><key>{key}</key>'
+            + (f'<parentKey>{parent_key}</parentKey>' if parent_key else '')
+            + f'<isGroup>{1 if is_group else 0}</isGroup><customData>{values_xml}</customData></record>'
+        )
+    return f'<response status="ok"><records>{"".join(records_xml)}</records></response>'
+
+
+PAGE = handbook_page(
+    ('10', None, True, [('Nazwa', 'Grupa', None)]),
+    ('31337', '10', False, [('Artykuł', 'SKU-1', None), ('Kategoria', '7', 'Narzędzia')]),
+    ('31338', '10', False, [('Artykuł', 'SKU-2', None)]),
+)
+
+
+def test_parse_handbook_records():
+    records = planfix_handbooks.parse_handbook_records(PAGE)
+
+    assert records == [
+        ('10', None, True, {'Nazwa': 'Grupa'}),
+        ('31337', '10', False, {'Artykuł': 'SKU-1', 'Kategoria': 'Narzędzia'}),
+        ('31338', '10', False, {'Artykuł': 'SKU-2'}),
+    ]
+
+
+def test_parse_handbook_records_raises_on_error_response():
+    with pytest.raises(ValueError, match='code=0019'):
+        planfix_handbooks.parse_handbook_records(
+            '<response status="error"><code>0019</code><message>limit</message></response>'
+        )
+
+
+def test_parse_columns_spec():
+    assert planfix_handbooks.parse_columns_spec('sku=Artykuł, kategoria = Kategoria') == {
+        'sku': 'Artykuł', 'kategoria': 'Kategoria'
+    }
+    with pytest.raises(ValueError, match='sku'):
+        planfix_handbooks.parse_columns_spec('sku')
+
+
+def test_lookup_fills_columns_and_counts_misses():
+    records = planfix_handbooks.parse_handbook_records(PAGE)
+    lookup = planfix_handbooks.HandbookLookup(512, {'sku': 'Artykuł', 'kategoria': 'Kategoria'}, records)
+
+    assert len(lookup) == 2  # группы справочника не подставляются
+    assert lookup.attributes(' 31337 ') == {'sku': 'SKU-1', 'kategoria': 'Narzędzia'}
+    assert lookup.attributes(31338) == {'sku': 'SKU-2', 'kategoria': None}
+    assert lookup.attributes('10') == {'sku': None, 'kategoria': None}
+    assert lookup.attributes(None) == {'sku': None, 'kategoria': None}
+    assert lookup.misses == 1
+
+
+def test_lookup_version_follows_the_attributes():
+    records = planfix_handbooks.parse_handbook_records(PAGE)
+    columns = {'sku': 'Artykuł'}
+    version = planfix_handbooks.HandbookLookup(512, columns, records).version()
+
+    assert planfix_handbooks.HandbookLookup(512, columns, list(reversed(records))).version() == version
+    records[1][3]['Artykuł'] = 'SKU-1a'
+    assert planfix_handbooks.HandbookLookup(512, columns, records).version() != version
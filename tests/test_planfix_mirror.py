@@ -0,0 +1,83 @@
+"""Тесты локального зеркала Planfix на временном файле SQLite (без Planfix)."""
+
+import time
+from datetime import date
+from decimal import Decimal
+
+import scripts.planfix_mirror as planfix_mirror
+
+
+def open_mirror(tmp_path, ttl=3600):
+    return planfix_mirror.PlanfixMirror(str(tmp_path / 'mirror' / 'planfix.sqlite'), ttl=ttl)
+
+
+def test_orders_keep_begin_datetime_and_count_fresh_hits(tmp_path):
+    mirror = open_mirror(tmp_path)
+    mirror.put_orders([
+        {'id': 100001, 'name': 'Zamówienie', 'number': '1', 'order_number': '123/2025', 'begin_datetime': '01-03-2025 10:00'},
+        {'id': 100002, 'name': 'Inne', 'number': '2', 'order_number': '124/2025', 'begin_datetime': None},
+    ])
+    mirror.put_orders([{'id': 100001, 'name': 'Zamówienie 2', 'number': '1', 'order_number': '123/2025'}])
+
+    assert mirror.get_orders('123/2025') == [{
+        'id': 100001, 'name': 'Zamówienie 2', 'number': '1', 'order_number': '123/2025',
+        'begin_datetime': '01-03-2025 10:00',
+    }]
+    assert sorted(mirror.get_fresh_orders([100001, 100002, 100003])) == [100001, 100002]
+    assert (mirror.hits, mirror.misses) == (2, 1)
+    mirror.close()
+
+
+def test_stale_entries_are_misses(tmp_path, monkeypatch):
+    mirror = open_mirror(tmp_path, ttl=60)
+    mirror.put_task_actions(100001, [{'id': 5001, 'date_time': '01-03-2025 10:00'}])
+    mirror.put_action(5001, 100001, '01-03-2025 10:00', True, b'<response status="ok"/>')
+
+    assert mirror.get_task_actions(100001) == [{'id': 5001, 'date_time': '01-03-2025 10:00'}]
+    assert mirror.get_action_xml(5001) == b'<response status="ok"/>'
+
+    now = time.time()
+    monkeypatch.setattr(planfix_mirror.time, 'time', lambda: now + 120)
+    assert mirror.get_task_actions(100001) is None
+    assert mirror.get_action_xml(5001) is None
+    assert (mirror.hits, mirror.misses) == (2, 2)
+    mirror.close()
+
+
+def test_put_action_keeps_known_task(tmp_path):
+    mirror = open_mirror(tmp_path)
+    mirror.put_action(5001, 100001, '01-03-2025 10:00', True, b'<a/>')
+    mirror.put_action(5001, None, '02-03-2025 10:00', False, b'<b/>')
+
+    [action] = mirror.get_actions(100001)
+    assert (action['id'], action['date_time'], action['has_produkty']) == (5001, '02-03-2025 10:00', 0)
+    mirror.close()
+
+
+def test_analytics_round_trip_through_json(tmp_path):
+    mirror = open_mirror(tmp_path)
+    record = {
+        'analytic_key': 'produkty', 'task_id': 100001, 'action_id': 5001,
+        'cena': Decimal('12.50'), 'data_realizacji': date(2025, 3, 1),
+    }
+    mirror.put_analytics([record], lambda item: f"{item['task_id']}_{item['action_id']}")
+    mirror.put_analytics([{**record, 'cena': Decimal('13.00')}], lambda item: f"{item['task_id']}_{item['action_id']}")
+
+    assert mirror.get_analytics(100001) == [{**record, 'cena': '13.00', 'data_realizacji': '2025-03-01'}]
+    assert mirror.get_analytics(100002) == []
+    mirror.close()
+
+
+def test_statuses_skip_unknown_names(tmp_path):
+    mirror = open_mirror(tmp_path)
+    mirror.put_statuses({1: 'Nowe', 2: None, '3': 'Zrealizowane'})
+
+    assert mirror.get_statuses() == {'1': 'Nowe', '3': 'Zrealizowane'}
+    assert mirror.query('SELECT count(*) FROM statuses') == (['count(*)'], [(2,)])
+    mirror.close()
+
+
+def test_open_mirror_is_disabled_without_path(monkeypatch):
+    monkeypatch.setattr(planfix_mirror, 'PLANFIX_MIRROR_PATH', None)
+
+    assert planfix_mirror.open_mirror() is None
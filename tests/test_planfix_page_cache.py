@@ -0,0 +1,82 @@
+"""Тесты хешей страниц PageHashStream и контекста заказов (без Supabase)."""
+
+import scripts.planfix_page_cache as planfix_page_cache
+
+
+class FakeCache:
+    enabled = True
+
+
+def previous_entry(data, payload, context_hash=None, context_ids=None):
+    return {
+        'content_hash': planfix_page_cache.content_hash(data),
+        'context_hash': context_hash,
+        'context_ids': context_ids,
+        'row_count': len(payload),
+        'payload': payload,
+    }
+
+
+def test_unchanged_page_returns_previous_entry():
+    stream = planfix_page_cache.PageHashStream(FakeCache(), 'orders')
+    stream.previous = {1: previous_entry(b'page 1', ['a']), 2: previous_entry(b'page 2', ['b'])}
+
+    assert stream.check(1, b'page 1')['payload'] == ['a']
+    assert stream.check(2, b'page 2 changed') is None
+    assert stream.check(3, b'page 3') is None
+    assert (stream.hits, stream.misses) == (1, 2)
+
+
+def test_disabled_cache_processes_every_page():
+    cache = FakeCache()
+    cache.enabled = False
+    stream = planfix_page_cache.PageHashStream(cache, 'orders')
+    stream.previous = {1: previous_entry(b'page 1', ['a'])}
+
+    assert stream.check(1, b'page 1') is None
+
+
+def test_changed_context_reprocesses_the_page():
+    tasks = {100: {'name': 'Zamówienie 1', 'order_number': 'ZAM/1'}}
+    context_fn = planfix_page_cache.tasks_context_fn(tasks)
+    stream = planfix_page_cache.PageHashStream(FakeCache(), 'analytics', context_fn)
+    stream.previous = {1: previous_entry(b'page 1', ['a'], context_fn([100]), [100])}
+
+    assert stream.check(1, b'page 1') is not None
+    tasks[100]['order_number'] = 'ZAM/2'
+    assert stream.check(1, b'page 1') is None
+
+
+def test_context_depends_on_the_extra_version():
+    tasks = {100: {'name': 'Zamówienie 1'}}
+
+    assert planfix_page_cache.tasks_context_fn(tasks, 'v1')([100]) != planfix_page_cache.tasks_context_fn(tasks, 'v2')([100])
+
+
+def test_remember_and_carry_stage_the_current_run():
+    stream = planfix_page_cache.PageHashStream(FakeCache(), 'analytics', lambda ids: f'ctx{ids}')
+    stream.previous = {1: previous_entry(b'page 1', ['a'], 'ctx[]')}
+
+    stream.carry(1, stream.check(1, b'page 1'))
+    stream.check(2, b'page 2')
+    stream.remember(2, 3, ['b', 'c'], context_ids=[7, 5, 7])
+
+    assert stream.current[1]['payload'] == ['a']
+    assert stream.current[2] == {
+        'content_hash': planfix_page_cache.content_hash(b'page 2'),
+        'context_hash': 'ctx[5, 7]',
+        'context_ids': [5, 7],
+        'row_count': 3,
+        'payload': ['b', 'c'],
+    }
+
+
+def test_forget_pages_with_drops_pages_of_failed_keys():
+    stream = planfix_page_cache.PageHashStream(FakeCache(), 'analytics')
+    for page, payload in ((1, ['a', 'b']), (2, ['c']), (3, None)):
+        stream.check(page, f'page {page}'.encode())
+        stream.remember(page, 1, payload)
+
+    assert stream.forget_pages_with(['b', 'x']) == 1
+    assert sorted(stream.current) == [2, 3]
+    assert stream.forgotten == {1}
@@ -0,0 +1,82 @@
+"""
+Тесты помесячных секций: имена и границы месяцев без базы, создание секций
+и перенос строк — на Postgres из PLANFIX_TEST_DATABASE_URL (иначе пропускаются).
+"""
+
+import os
+from datetime import date, datetime
+
+import pytest
+
+import scripts.planfix_partitions as planfix_partitions
+import scripts.planfix_utils as planfix_utils
+
+TEST_DATABASE_URL = os.environ.get('PLANFIX_TEST_DATABASE_URL')
+TABLE = '_planfix_test_partitions'
+
+
+def test_month_bounds():
+    assert planfix_partitions.month_start(date(2025, 3, 17)) == date(2025, 3, 1)
+    assert planfix_partitions.month_start(datetime(2025, 3, 17, 23, 59)) == date(2025, 3, 1)
+    assert planfix_partitions.next_month(date(2025, 3, 1)) == date(2025, 4, 1)
+    assert planfix_partitions.next_month(date(2025, 12, 1)) == date(2026, 1, 1)
+
+
+def test_partition_name():
+    assert planfix_partitions.partition_name('planfix_analytics_produkty', date(2025, 3, 1)) == 'planfix_analytics_produkty_p2025_03'
+    assert planfix_partitions.partition_name('planfix_analytics_produkty', None) == 'planfix_analytics_produkty_default'
+    # Имена длиннее лимита идентификатора Postgres обрезаются до 63 символов
+    assert len(planfix_partitions.partition_name('t' * 70, date(2025, 3, 1))) == 63
+
+
+@pytest.fixture
+def conn():
+    if not TEST_DATABASE_URL:
+        pytest.skip('PLANFIX_TEST_DATABASE_URL is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            DROP TABLE IF EXISTS "{TABLE}";
+            CREATE TABLE "{TABLE}" (
+                "composite_key" TEXT,
+                "{planfix_partitions.PARTITION_COLUMN}" DATE,
+                "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+                {planfix_partitions.unique_constraint_sql(TABLE, 'composite_key')}
+            ) PARTITION BY RANGE ("{planfix_partitions.PARTITION_COLUMN}");
+        ''')
+    conn.commit()
+    yield conn
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute(f'DROP TABLE IF EXISTS "{TABLE}"')
+    conn.commit()
+    conn.close()
+
+
+def test_month_partitions_are_created_once(conn):
+    dates = [date(2025, 3, 17), datetime(2025, 3, 2, 10, 0), None, date(2025, 12, 31)]
+
+    created = planfix_partitions.ensure_month_partitions(conn, TABLE, dates)
+
+    assert sorted(created) == [f'{TABLE}_default', f'{TABLE}_p2025_03', f'{TABLE}_p2025_12']
+    assert planfix_partitions.is_partitioned(conn, TABLE)
+    assert planfix_partitions.get_partitions(conn, TABLE) == set(created)
+    assert planfix_partitions.ensure_month_partitions(conn, TABLE, dates) == []
+
+
+def test_moved_rows_leave_their_old_partition(conn):
+    planfix_partitions.ensure_month_partitions(conn, TABLE, [date(2025, 3, 1), date(2025, 4, 1)])
+    with conn.cursor() as cur:
+        # Запуск r2 записал 'a' с новой датой (в другую секцию), 'b' — с прежней
+        cur.execute(f'''
+            INSERT INTO "{TABLE}" VALUES
+                ('a', '2025-03-10', 'r1'), ('a', '2025-04-02', 'r2'), ('b', '2025-03-10', 'r2')
+        ''')
+    conn.commit()
+
+    assert planfix_partitions.remove_moved_rows(conn, TABLE, 'composite_key', 'r2') == 1
+
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT "composite_key", "{planfix_partitions.PARTITION_COLUMN}" FROM "{TABLE}" ORDER BY 1')
+        assert cur.fetchall() == [('a', date(2025, 4, 2)), ('b', date(2025, 3, 10))]
@@ -0,0 +1,98 @@
+"""
+Тесты бэкенда psycopg 3: приведение значений для бинарного COPY без базы,
+загрузка — на Postgres из PLANFIX_TEST_DATABASE_URL (нужен установленный psycopg 3).
+"""
+
+import os
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+import scripts.planfix_psycopg3 as planfix_psycopg3
+import scripts.planfix_utils as planfix_utils
+
+TEST_DATABASE_URL = os.environ.get('PLANFIX_TEST_DATABASE_URL')
+TABLE = '_planfix_test_psycopg3'
+COLUMNS = ['composite_key', 'task_id', 'cena', 'updated_at', 'is_deleted']
+
+INTEGER, NUMERIC, TEXT = 23, 1700, 25
+
+
+def test_binary_rows_coerce_numeric_columns():
+    rows = [
+        ('a', '100001', '12.50', 'PLN'),
+        ('b', '', '  ', ''),
+        ('c', 100003, 0.1, None),
+        ('d', None, Decimal('3.2'), 'EUR'),
+    ]
+
+    converted = list(planfix_psycopg3._binary_rows(rows, [TEXT, INTEGER, NUMERIC, TEXT]))
+
+    assert converted == [
+        ['a', 100001, Decimal('12.50'), 'PLN'],
+        ['b', None, None, ''],
+        ['c', 100003, Decimal('0.1'), None],
+        ['d', None, Decimal('3.2'), 'EUR'],
+    ]
+
+
+def test_binary_rows_pass_text_only_rows_through():
+    rows = [('a', 'b')]
+
+    assert list(planfix_psycopg3._binary_rows(rows, [TEXT, TEXT])) == rows
+
+
+@pytest.fixture
+def conn():
+    if not TEST_DATABASE_URL:
+        pytest.skip('PLANFIX_TEST_DATABASE_URL is not set')
+    pytest.importorskip('psycopg')
+    conn = planfix_psycopg3.get_connection(TEST_DATABASE_URL)
+    conn.execute(f'''
+        DROP TABLE IF EXISTS "{TABLE}";
+        CREATE TABLE "{TABLE}" (
+            "composite_key" TEXT PRIMARY KEY,
+            "task_id" INTEGER,
+            "cena" NUMERIC,
+            "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+            "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+            "updated_at" TIMESTAMP,
+            "is_deleted" BOOLEAN DEFAULT FALSE
+        )
+    ''')
+    conn.commit()
+    yield conn
+    conn.rollback()
+    conn.execute(f'DROP TABLE IF EXISTS "{TABLE}"')
+    conn.commit()
+    conn.close()
+
+
+def rows(*keys, cena='12.50'):
+    return [
+        {'composite_key': key, 'task_id': '100001', 'cena': cena, 'updated_at': datetime(2025, 3, 1), 'is_deleted': False}
+        for key in keys
+    ]
+
+
+def test_upsert_counts_and_soft_delete(conn):
+    def upsert(batch, run_id):
+        return planfix_psycopg3.upsert_data_to_supabase(
+            conn, TABLE, 'composite_key', COLUMNS, batch, run_id=run_id, detect_changes=True
+        )
+
+    first = upsert(rows('a', 'b'), 'r1')
+    changed = rows('a', 'b', 'c')
+    changed[1]['cena'] = '13.00'
+    second = upsert(changed, 'r2')
+
+    assert (first['inserted'], first['updated'], first['unchanged']) == (2, 0, 0)
+    assert (second['inserted'], second['updated'], second['unchanged']) == (1, 1, 1)
+
+    assert planfix_psycopg3.mark_items_as_deleted_in_supabase(conn, TABLE, 'composite_key', ['a', 'c']) == 1
+    third = upsert(rows('a', 'b', 'c'), 'r3')
+
+    assert (third['inserted'], third['updated'], third['unchanged']) == (0, 1, 2)
+    deleted = conn.execute(f'SELECT count(*) FROM "{TABLE}" WHERE "is_deleted"').fetchone()[0]
+    assert deleted == 0
@@ -0,0 +1,49 @@
+"""Тесты набора запросов пересчета агрегатов rollup_statements (без Supabase)."""
+
+import scripts.planfix_rollups as planfix_rollups
+
+TABLE = 'planfix_analytics_produkty'
+
+
+def test_full_rebuild_truncates_every_rollup_table():
+    statements = planfix_rollups.rollup_statements(TABLE, None)
+
+    truncated = [sql for _, sql, _ in statements if sql.startswith('TRUNCATE')]
+    assert truncated == [
+        f'TRUNCATE "{table}"' for table in (
+            planfix_rollups.ORDER_PRODUCTS_TABLE, planfix_rollups.ORDERS_TABLE,
+            planfix_rollups.PRODUCTS_TABLE, planfix_rollups.CURRENCIES_TABLE,
+        )
+    ]
+    assert all(params == [] for _, _, params in statements)
+    assert not any('ANY(%s)' in sql for _, sql, _ in statements)
+
+
+def test_incremental_refresh_only_touches_given_orders():
+    statements = planfix_rollups.rollup_statements(TABLE, [100001, 100002])
+
+    assert not any(sql.startswith('TRUNCATE') for _, sql, _ in statements)
+    for _, sql, params in statements:
+        # Каждый запрос с фильтром по заказам получает ровно один параметр — список заказов
+        assert sql.count('%s') == len(params)
+        assert params in ([], [[100001, 100002]])
+    filtered = [sql for _, sql, params in statements if params]
+    assert any(f'DELETE FROM "{planfix_rollups.ORDER_PRODUCTS_TABLE}"' in sql for sql in filtered)
+    assert any(f'DELETE FROM "{planfix_rollups.ORDERS_TABLE}"' in sql for sql in filtered)
+
+
+def test_statements_report_each_rollup_level_once():
+    for task_ids in (None, [100001]):
+        keys = [key for key, _, _ in planfix_rollups.rollup_statements(TABLE, task_ids) if key]
+
+        assert keys == ['orders', 'products', 'currencies']
+
+
+def test_order_products_read_only_live_rows_of_the_source_table():
+    statements = planfix_rollups.rollup_statements(TABLE, None)
+
+    source = [sql for _, sql, _ in statements if f'FROM "{TABLE}"' in sql]
+    assert len(source) == 1
+    assert 'NOT "is_deleted"' in source[0]
+    for column in planfix_rollups.SUM_COLUMNS:
+        assert f'COALESCE(SUM("{column}"), 0)' in source[0]
@@ -0,0 +1,77 @@
+"""
+Реестр схем ensure_table_schema на настоящем Postgres. Нужна база из
+PLANFIX_TEST_DATABASE_URL (см. test_upsert_cycle); без нее тесты пропускаются.
+"""
+
+import os
+
+import pytest
+
+import scripts.planfix_schema as planfix_schema
+import scripts.planfix_utils as planfix_utils
+
+TEST_DATABASE_URL = os.environ.get('PLANFIX_TEST_DATABASE_URL')
+TABLE = '_planfix_test_schema'
+CREATE_SQL = f'CREATE TABLE IF NOT EXISTS "{TABLE}" ("id" TEXT PRIMARY KEY, "name" TEXT);'
+COLUMNS = {'id': 'TEXT', 'name': 'TEXT'}
+
+
+def test_fingerprint_depends_on_columns_and_create_sql():
+    fingerprint = planfix_schema.schema_fingerprint(COLUMNS, CREATE_SQL)
+
+    assert fingerprint == planfix_schema.schema_fingerprint(dict(reversed(COLUMNS.items())), CREATE_SQL)
+    assert fingerprint != planfix_schema.schema_fingerprint({**COLUMNS, 'cena': 'NUMERIC'}, CREATE_SQL)
+    assert fingerprint != planfix_schema.schema_fingerprint(COLUMNS)
+
+
+@pytest.fixture
+def conn():
+    if not TEST_DATABASE_URL:
+        pytest.skip('PLANFIX_TEST_DATABASE_URL is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+
+    def drop():
+        planfix_schema.invalidate_table_schema(conn, TABLE)
+        with conn.cursor() as cur:
+            cur.execute(f'DROP TABLE IF EXISTS "{TABLE}"')
+        conn.commit()
+
+    drop()
+    yield conn
+    conn.rollback()
+    drop()
+    conn.close()
+
+
+def test_registered_schema_skips_ddl_checks(conn, monkeypatch):
+    assert planfix_schema.ensure_table_schema(conn, TABLE, COLUMNS, CREATE_SQL) == ['id', 'name']
+
+    def no_ddl(*args):
+        pytest.fail('DDL checks ran for a registered schema')
+
+    monkeypatch.setattr(planfix_utils, 'add_missing_columns', no_ddl)
+    assert planfix_schema.ensure_table_schema(conn, TABLE, COLUMNS, CREATE_SQL) == ['id', 'name']
+
+
+def test_changed_schema_adds_missing_columns(conn):
+    planfix_schema.ensure_table_schema(conn, TABLE, COLUMNS, CREATE_SQL)
+
+    columns = planfix_schema.ensure_table_schema(conn, TABLE, {**COLUMNS, 'cena': 'NUMERIC'}, CREATE_SQL)
+
+    assert columns == ['id', 'name', 'cena']
+    assert planfix_schema.get_registered_columns(conn, TABLE) == ['id', 'name', 'cena']
+
+
+def test_recreated_table_is_checked_again(conn):
+    planfix_schema.ensure_table_schema(conn, TABLE, COLUMNS, CREATE_SQL)
+    with conn.cursor() as cur:
+        cur.execute(f'DROP TABLE "{TABLE}"; CREATE TABLE "{TABLE}" ("id" TEXT PRIMARY KEY)')
+    conn.commit()
+
+    assert planfix_schema.ensure_table_schema(conn, TABLE, COLUMNS, CREATE_SQL) == ['id', 'name']
+
+
+def test_columns_of_a_missing_table_raise(conn):
+    with pytest.raises(ValueError, match=TABLE):
+        planfix_schema.get_registered_columns(conn, TABLE)
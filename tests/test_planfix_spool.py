@@ -0,0 +1,51 @@
+"""Тесты спула сырых ответов Planfix: запись, чтение по ключу и поврежденный индекс."""
+
+import scripts.planfix_spool as planfix_spool
+
+
+def test_spool_round_trip(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    with planfix_spool.ResponseSpoolWriter(path) as writer:
+        writer.append('task.getList', 'template=2420917', 1, b'<response>1</response>')
+        writer.append('task.getList', 'template=2420917', 2, 'Zamówienie'.encode('utf-8'))
+        writer.append('analitic.getOptions', 'analitic=4867', 1, b'<response/>')
+
+    assert writer.records == 3
+    with planfix_spool.ResponseSpoolReader(path) as reader:
+        assert reader.get('task.getList', 'template=2420917', 2).decode('utf-8') == 'Zamówienie'
+        assert reader.get('analitic.getOptions', 'analitic=4867') == b'<response/>'
+        assert reader.get('task.getList', 'template=2420917', 3) is None
+
+
+def test_retried_request_replays_the_last_response(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    with planfix_spool.ResponseSpoolWriter(path) as writer:
+        writer.append('task.getList', '', 1, b'error')
+        writer.append('task.getList', '', 1, b'ok')
+        writer.append('task.getMulti', '', 1, b'tasks')
+
+    with planfix_spool.ResponseSpoolReader(path) as reader:
+        assert reader.get('task.getList') == b'ok'
+        responses = [(entry['method'], data) for entry, data in reader.iter_responses('task.getList')]
+
+    assert responses == [('task.getList', b'ok')]
+
+
+def test_damaged_index_line_is_skipped(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    with planfix_spool.ResponseSpoolWriter(path) as writer:
+        writer.append('task.getList', '', 1, b'ok')
+    with open(path + planfix_spool.INDEX_SUFFIX, 'a', encoding='utf-8') as f:
+        f.write('{"key": "task.getList||2", "off')
+
+    with planfix_spool.ResponseSpoolReader(path) as reader:
+        assert list(reader.index) == ['task.getList||1']
+        assert reader.get('task.getList') == b'ok'
+
+
+def test_empty_spool_returns_nothing(tmp_path):
+    path = str(tmp_path / 'run.spool')
+    planfix_spool.ResponseSpoolWriter(path).close()
+
+    with planfix_spool.ResponseSpoolReader(path) as reader:
+        assert reader.get('task.getList') is None
@@ -0,0 +1,105 @@
+"""Тесты дозапроса задач TaskResolver: task.getMulti подменяется, Planfix не нужен."""
+
+import re
+
+import pytest
+import requests
+
+import scripts.planfix_task_resolver as planfix_task_resolver
+
+ROW_FIELDS = ('id', 'name')
+
+
+class FakeTaskMulti:
+    """Подмена post_planfix_xml: отвечает списком ID из запроса, кроме absent."""
+
+    def __init__(self, absent=(), fail=False):
+        self.absent = set(absent)
+        self.fail = fail
+        self.batches = []
+
+    def __call__(self, method, body, spool_params, *args):
+        assert method == 'task.getMulti'
+        task_ids = [int(task_id) for task_id in re.findall(r'<task><id>(\d+)</id></task>', body)]
+        self.batches.append(task_ids)
+        if self.fail:
+            raise requests.exceptions.ConnectionError('down')
+        return [task_id for task_id in task_ids if task_id not in self.absent]
+
+
+def parse_rows(data):
+    return [(task_id, f'Zamówienie {task_id}') for task_id in data]
+
+
+@pytest.fixture
+def fake_multi(monkeypatch):
+    def install(**kwargs):
+        fake = FakeTaskMulti(**kwargs)
+        monkeypatch.setattr(planfix_task_resolver.planfix_utils, 'post_planfix_xml', fake)
+        return fake
+    return install
+
+
+def make_resolver(tasks_dict=None, **kwargs):
+    return planfix_task_resolver.TaskResolver(tasks_dict or {}, parse_rows, ROW_FIELDS, **kwargs)
+
+
+def test_known_tasks_are_not_requested(fake_multi):
+    fake = fake_multi()
+    resolver = make_resolver({1: {'id': 1, 'name': 'Znane'}})
+
+    resolver.resolve([1, 1, None])
+
+    assert fake.batches == []
+    assert resolver.get(1) == {'id': 1, 'name': 'Znane'}
+
+
+def test_missing_tasks_are_requested_once_in_batches(fake_multi):
+    fake = fake_multi()
+    resolver = make_resolver(batch_size=100)
+
+    resolver.resolve(range(1, 251))
+    resolver.resolve(range(1, 251))
+
+    assert [len(batch) for batch in fake.batches] == [100, 100, 50]
+    assert resolver.requests == 3
+    assert resolver.resolved == 250
+    assert resolver.get(250) == {'id': 250, 'name': 'Zamówienie 250'}
+    assert 250 in resolver
+
+
+def test_tasks_absent_from_planfix_are_not_requested_again(fake_multi):
+    fake = fake_multi(absent={2})
+    resolver = make_resolver()
+
+    resolver.resolve([1, 2])
+    resolver.resolve([2])
+
+    assert fake.batches == [[1, 2]]
+    assert 2 not in resolver
+    assert resolver.get(2, 'brak') == 'brak'
+
+
+def test_request_errors_do_not_stop_the_export(fake_multi):
+    fake = fake_multi(fail=True)
+    resolver = make_resolver(batch_size=2)
+
+    resolver.resolve([1, 2, 3])
+
+    assert fake.batches == [[1, 2], [3]]
+    assert resolver.resolved == 0
+    assert resolver.get(1) is None
+
+
+def test_cache_evicts_least_recently_used_tasks(fake_multi):
+    fake = fake_multi()
+    resolver = make_resolver(max_size=2)
+
+    resolver.resolve([1, 2])
+    resolver.get(1)
+    resolver.resolve([3])
+
+    assert 1 in resolver and 3 in resolver
+    assert 2 not in resolver
+    resolver.resolve([2])
+    assert fake.batches == [[1, 2], [3], [2]]
@@ -0,0 +1,172 @@
+"""Тесты вспомогательных функций planfix_utils, которым не нужны Planfix и Supabase."""
+
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+import scripts.planfix_utils as planfix_utils
+
+
+def test_collapse_duplicate_keys_keeps_last_row_at_first_position():
+    rows = [('a', 1), ('b', 2), ('a', 3), ('c', 4), ('b', 5)]
+
+    collapsed, dropped = planfix_utils.collapse_duplicate_keys(rows, [0])
+
+    assert collapsed == [('a', 3), ('b', 5), ('c', 4)]
+    assert dropped == 2
+
+
+def test_collapse_duplicate_keys_uses_all_key_columns():
+    rows = [('k', '2025-01-01', 1), ('k', '2025-02-01', 2), ('k', '2025-01-01', 3)]
+
+    collapsed, dropped = planfix_utils.collapse_duplicate_keys(rows, [0, 1])
+
+    assert collapsed == [('k', '2025-01-01', 3), ('k', '2025-02-01', 2)]
+    assert dropped == 1
+
+
+def test_collapse_duplicate_keys_accepts_iterators():
+    collapsed, dropped = planfix_utils.collapse_duplicate_keys(iter([(1,), (2,)]), [0])
+
+    assert collapsed == [(1,), (2,)]
+    assert dropped == 0
+
+
+def test_compute_row_hash_is_stable_and_sensitive_to_values():
+    row = ['ZAM/1/2025', Decimal('12.50'), datetime(2025, 3, 1, 10, 0), None, False]
+
+    assert planfix_utils.compute_row_hash(row) == planfix_utils.compute_row_hash(tuple(row))
+    assert planfix_utils.compute_row_hash(row) != planfix_utils.compute_row_hash(row[:-1] + [True])
+    assert planfix_utils.compute_row_hash(['a', 'b']) != planfix_utils.compute_row_hash(['b', 'a'])
+
+
+def test_compute_row_hash_distinguishes_none_from_empty_string():
+    assert planfix_utils.compute_row_hash([None]) != planfix_utils.compute_row_hash([''])
+
+
+def test_convert_polish_number():
+    assert planfix_utils.convert_polish_number('1 234,50') == '1234.50'
+    assert planfix_utils.convert_polish_number('12,5') == '12.5'
+    assert planfix_utils.convert_polish_number('') is None
+    assert planfix_utils.convert_polish_number(None) is None
+
+
+class FakeConnection:
+    def __init__(self, port=5432, backend_pid=101):
+        self.info = type('Info', (), {'port': port})()
+        self.backend_pid = backend_pid
+
+    def get_backend_pid(self):
+        return self.backend_pid
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+
+def test_prepared_statements_are_skipped_on_the_transaction_pooler(monkeypatch):
+    monkeypatch.setattr(planfix_utils, 'SUPABASE_PREPARED_STATEMENTS', 'auto')
+    assert planfix_utils.prepared_statements_enabled(FakeConnection(port=5432))
+    assert not planfix_utils.prepared_statements_enabled(FakeConnection(port=6543))
+
+    monkeypatch.setattr(planfix_utils, 'SUPABASE_PREPARED_STATEMENTS', '0')
+    assert not planfix_utils.prepared_statements_enabled(FakeConnection(port=5432))
+
+    monkeypatch.setattr(planfix_utils, 'SUPABASE_PREPARED_STATEMENTS', '1')
+    assert planfix_utils.prepared_statements_enabled(FakeConnection(port=6543))
+
+
+def test_prepared_statement_is_prepared_once_per_session(monkeypatch):
+    monkeypatch.setattr(planfix_utils, 'SUPABASE_PREPARED_STATEMENTS', 'auto')
+    conn = FakeConnection()
+    cursor = FakeCursor(conn)
+
+    first = planfix_utils._prepared_statement(cursor, 'SELECT $1', ['int'])
+    second = planfix_utils._prepared_statement(FakeCursor(conn), 'SELECT $1', ['int'])
+
+    assert first == second
+    assert cursor.statements == [f'PREPARE {first} (int) AS SELECT $1']
+
+    # Новая серверная сессия того же объекта соединения — запрос готовится заново
+    conn.backend_pid = 202
+    renewed = FakeCursor(conn)
+    planfix_utils._prepared_statement(renewed, 'SELECT $1', ['int'])
+    assert len(renewed.statements) == 1
+
+
+def test_prepared_statement_is_disabled_on_the_pooler(monkeypatch):
+    monkeypatch.setattr(planfix_utils, 'SUPABASE_PREPARED_STATEMENTS', 'auto')
+    cursor = FakeCursor(FakeConnection(port=6543))
+
+    assert planfix_utils._prepared_statement(cursor, 'SELECT 1') is None
+    assert cursor.statements == []
+
+
+def test_statuses_are_preloaded_from_the_status_sets_of_templates(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_request(method_name, params):
+        calls.append(method_name)
+        if method_name == 'task.get':
+            return f'<response status="ok"><task><id>{params["task"]["id"]}</id><statusSet>7</statusSet></task></response>'
+        assert method_name == 'taskStatus.getListOfSet'
+        return '<response status="ok"><taskStatuses><taskStatus><id>70</id><name>Nowe</name></taskStatus></taskStatuses></response>'
+
+    monkeypatch.setattr(planfix_utils, 'make_planfix_request', fake_request)
+    monkeypatch.setattr(planfix_utils, 'PLANFIX_STATUS_CACHE_PATH', str(tmp_path / 'statuses.json'))
+    planfix_utils.clear_planfix_status_cache()
+
+    assert planfix_utils.get_planfix_status_name('70', ['2420917', '2420918']) == 'Nowe'
+    assert planfix_utils.get_planfix_status_name('70', ['2420917', '2420918']) == 'Nowe'
+    # Оба шаблона используют один набор статусов; taskStatus.getSetList не нужен
+    assert calls == ['task.get', 'task.get', 'taskStatus.getListOfSet']
+    planfix_utils.clear_planfix_status_cache()
+
+
+def test_auto_loader_depends_on_batch_size(monkeypatch):
+    monkeypatch.setattr(planfix_utils, 'AUTO_VALUES_MAX_ROWS', 10)
+    monkeypatch.setattr(planfix_utils, 'AUTO_UNNEST_MAX_ROWS', 100)
+
+    assert planfix_utils.choose_upsert_loader(10) == 'values'
+    assert planfix_utils.choose_upsert_loader(11) == 'unnest'
+    assert planfix_utils.choose_upsert_loader(101) == 'copy'
+    # Размер потока заранее неизвестен — COPY
+    assert planfix_utils.choose_upsert_loader(None) == 'copy'
+
+
+def test_unknown_loader_is_rejected():
+    with pytest.raises(ValueError, match='bulk'):
+        planfix_utils.upsert_data_to_supabase(None, 'planfix_orders', 'task_id', ['task_id'], [{'task_id': 1}], loader='bulk')
+
+
+def test_stream_upsert_loads_one_chunk_at_a_time(monkeypatch):
+    chunks = []
+
+    def fake_upsert(conn, table_name, primary_key_column, column_names, data_list, **kwargs):
+        chunks.append([record['task_id'] for record in data_list])
+        return {'rows': len(data_list), 'inserted': len(data_list), 'updated': 0, 'unchanged': 0, 'collapsed': 0, 'quarantined': 0}
+
+    monkeypatch.setattr(planfix_utils, 'upsert_data_to_supabase', fake_upsert)
+    records = ({'task_id': task_id} for task_id in range(5))
+
+    totals = planfix_utils.upsert_stream_to_supabase(None, 'planfix_orders', 'task_id', ['task_id'], records, chunk_size=2)
+
+    assert chunks == [[0, 1], [2, 3], [4]]
+    assert (totals['rows'], totals['inserted'], totals['chunks']) == (5, 5, 3)
+
+
+def test_stream_upsert_drops_counts_the_loader_does_not_report(monkeypatch):
+    def fake_upsert(conn, table_name, primary_key_column, column_names, data_list, **kwargs):
+        return {'rows': len(data_list), 'inserted': None, 'updated': None, 'unchanged': None, 'collapsed': 0, 'quarantined': 0}
+
+    monkeypatch.setattr(planfix_utils, 'upsert_data_to_supabase', fake_upsert)
+
+    totals = planfix_utils.upsert_stream_to_supabase(None, 'planfix_orders', 'task_id', ['task_id'], [{'task_id': 1}], chunk_size=2)
+
+    assert (totals['rows'], totals['inserted'], totals['unchanged']) == (1, None, None)
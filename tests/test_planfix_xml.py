@@ -0,0 +1,58 @@
+"""Тесты слоя парсинга XML: выбор бэкенда и пул парсинга без воркеров."""
+
+import pytest
+
+import scripts.planfix_xml as planfix_xml
+
+RESPONSE = '<?xml version="1.0" encoding="UTF-8"?><response status="ok"><task><id>100001</id><name>Zamówienie</name></task></response>'
+
+
+def task_id(data):
+    return planfix_xml.fromstring(data).findtext('task/id')
+
+
+def test_stdlib_backend_parses_str_and_bytes():
+    backend = planfix_xml.get_xml_backend('stdlib')
+
+    for data in (RESPONSE, RESPONSE.encode('utf-8')):
+        root = backend.fromstring(data)
+        assert root.get('status') == 'ok'
+        assert root.findtext('task/name') == 'Zamówienie'
+    with pytest.raises(planfix_xml.ParseError):
+        backend.fromstring('<response>')
+
+
+def test_lxml_backend_matches_stdlib():
+    pytest.importorskip('lxml')
+    stdlib = planfix_xml.get_xml_backend('stdlib')
+    lxml = planfix_xml.get_xml_backend('lxml')
+
+    root = lxml.fromstring(RESPONSE)
+    assert root.findtext('task/name') == stdlib.fromstring(RESPONSE).findtext('task/name')
+    assert lxml.tostring(root.find('task')) == '<task><id>100001</id><name>Zamówienie</name></task>'
+    with pytest.raises(planfix_xml.ParseError):
+        lxml.fromstring('<response>')
+
+
+def test_backend_names():
+    assert planfix_xml.get_xml_backend(None).name == 'stdlib'
+    assert planfix_xml.get_xml_backend('AUTO').name == ('lxml' if planfix_xml.lxml_etree is not None else 'stdlib')
+    with pytest.raises(ValueError, match='expat'):
+        planfix_xml.get_xml_backend('expat')
+
+
+def test_parse_workers_from_environment(monkeypatch):
+    monkeypatch.setenv('PLANFIX_PARSE_WORKERS', '3')
+    assert planfix_xml.get_parse_workers() == 3
+    monkeypatch.setenv('PLANFIX_PARSE_WORKERS', 'many')
+    assert planfix_xml.get_parse_workers() == 0
+
+
+def test_inline_pool_returns_finished_futures():
+    with planfix_xml.ParsePool(workers=0) as pool:
+        assert not pool.parallel
+        assert pool.submit(task_id, RESPONSE).result() == '100001'
+        failed = pool.submit(task_id, '<response>')
+        assert failed.done()
+        with pytest.raises(planfix_xml.ParseError):
+            failed.result()
@@ -0,0 +1,131 @@
+"""
+Upsert с хешем строки и пометка удаленных на настоящем Postgres. Нужна база,
+в которой можно создавать таблицы: PLANFIX_TEST_DATABASE_URL (DSN psycopg2);
+без нее тесты пропускаются.
+"""
+
+import os
+from datetime import datetime
+
+import pytest
+
+import scripts.planfix_utils as planfix_utils
+
+TEST_DATABASE_URL = os.environ.get('PLANFIX_TEST_DATABASE_URL')
+TABLE = '_planfix_test_upsert_cycle'
+COLUMNS = ['composite_key', 'cena', 'updated_at', 'is_deleted']
+
+
+def test_conflict_clause_updates_soft_deleted_rows():
+    _, conflict_sql = planfix_utils._upsert_sql_parts(TABLE, 'composite_key', COLUMNS + [planfix_utils.ROW_HASH_COLUMN])
+
+    assert f'"{TABLE}"."row_hash" IS DISTINCT FROM EXCLUDED."row_hash" OR "{TABLE}"."is_deleted"' in conflict_sql
+
+
+@pytest.fixture
+def conn():
+    if not TEST_DATABASE_URL:
+        pytest.skip('PLANFIX_TEST_DATABASE_URL is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            DROP TABLE IF EXISTS "{TABLE}";
+            CREATE TABLE "{TABLE}" (
+                "composite_key" TEXT PRIMARY KEY,
+                "cena" NUMERIC,
+                "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+                "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+                "updated_at" TIMESTAMP,
+                "is_deleted" BOOLEAN DEFAULT FALSE
+            );
+        ''')
+    conn.commit()
+    yield conn
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute(f'DROP TABLE IF EXISTS "{TABLE}"')
+    conn.commit()
+    conn.close()
+
+
+def rows(*keys):
+    return [{'composite_key': key, 'cena': '12.50', 'updated_at': datetime(2025, 3, 1), 'is_deleted': False} for key in keys]
+
+
+def live_keys(conn):
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT "composite_key" FROM "{TABLE}" WHERE NOT "is_deleted" ORDER BY 1')
+        return [row[0] for row in cur.fetchall()]
+
+
+@pytest.mark.parametrize('loader', ['batch', 'values', 'unnest', 'copy'])
+def test_unchanged_row_comes_back_after_soft_delete(conn, loader):
+    def upsert(keys, run_id):
+        return planfix_utils.upsert_data_to_supabase(
+            conn, TABLE, 'composite_key', COLUMNS, rows(*keys),
+            loader=loader, run_id=run_id, detect_changes=True
+        )
+
+    upsert(['a', 'b'], 'r1')
+    assert planfix_utils.mark_items_as_deleted_in_supabase(conn, TABLE, 'composite_key', ['a']) == 1
+    assert live_keys(conn) == ['a']
+
+    stats = upsert(['a', 'b'], 'r2')
+
+    assert live_keys(conn) == ['a', 'b']
+    assert (stats['inserted'], stats['updated'], stats['unchanged']) == (0, 1, 1)
+
+
+@pytest.mark.parametrize('loader', ['batch', 'values', 'unnest', 'copy'])
+def test_loaders_count_inserted_updated_and_unchanged(conn, loader):
+    def upsert(batch, run_id):
+        return planfix_utils.upsert_data_to_supabase(
+            conn, TABLE, 'composite_key', COLUMNS, batch,
+            loader=loader, run_id=run_id, detect_changes=True
+        )
+
+    first = upsert(rows('a', 'b'), 'r1')
+    changed = rows('a', 'b', 'c')
+    changed[1]['cena'] = '13.00'
+    second = upsert(changed, 'r2')
+
+    assert (first['inserted'], first['updated'], first['unchanged']) == (2, 0, 0)
+    assert (second['inserted'], second['updated'], second['unchanged']) == (1, 1, 1)
+
+
+@pytest.fixture
+def partitioned_conn(conn):
+    """Та же таблица, секционированная по дате: RETURNING не может читать системные колонки."""
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            DROP TABLE IF EXISTS "{TABLE}";
+            CREATE TABLE "{TABLE}" (
+                "composite_key" TEXT,
+                "cena" NUMERIC,
+                "{planfix_utils.RUN_ID_COLUMN}" TEXT,
+                "{planfix_utils.ROW_HASH_COLUMN}" TEXT,
+                "updated_at" TIMESTAMP,
+                "is_deleted" BOOLEAN DEFAULT FALSE,
+                PRIMARY KEY ("composite_key", "updated_at")
+            ) PARTITION BY RANGE ("updated_at");
+            CREATE TABLE "{TABLE}_default" PARTITION OF "{TABLE}" DEFAULT;
+        ''')
+    conn.commit()
+    return conn
+
+
+@pytest.mark.parametrize('loader', ['batch', 'values', 'unnest', 'copy'])
+def test_loaders_count_rows_of_partitioned_tables(partitioned_conn, loader):
+    def upsert(batch, run_id):
+        return planfix_utils.upsert_data_to_supabase(
+            partitioned_conn, TABLE, ('composite_key', 'updated_at'), COLUMNS, batch,
+            loader=loader, run_id=run_id, detect_changes=True
+        )
+
+    upsert(rows('a', 'b'), 'r1')
+    changed = rows('a', 'b', 'c')
+    changed[1]['cena'] = '13.00'
+    second = upsert(changed, 'r2')
+
+    assert (second['inserted'], second['updated'], second['unchanged']) == (1, 1, 1)